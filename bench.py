@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+
+# Performance benchmarks. Usage:
+#     python bench.py              runs all benchmarks
+#     python bench.py name ...     runs the named ones
+# A benchmark with a regression guard exits non-zero when the guard fails.
+
+import os, subprocess, sys, time
+from collections import OrderedDict
+
+
+BENCHMARKS = OrderedDict()
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def best_of(repeat, fn, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        fn(*args)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def report(name, seconds, extra=''):
+    print '%-40s %10.2f ms %s' % (name, seconds * 1000, extra)
+
+
+IMPORT_BUDGET_MS = 150 # generous: importing the regex module alone takes ~50ms
+
+IMPORT_PROBE = '''
+import sys, time
+start = time.time()
+import oprex
+elapsed = time.time() - start
+eager = [name for name in ('ply', 'ply.lex', 'ply.yacc', 'oprex.parsetab') if name in sys.modules]
+print elapsed, sys.modules['oprex.oprex'].parser is None, ' '.join(eager)
+'''
+
+@benchmark
+def import_time():
+    timings = []
+    for _ in range(5):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_PROBE]).split()
+        timings.append(float(output[0]))
+        lazy = output[1] == 'True'
+        eager = output[2:]
+    elapsed = min(timings)
+    report('import oprex', elapsed)
+    if not lazy or eager:
+        raise SystemExit('import oprex eagerly built the parser or loaded: %s' % ' '.join(eager))
+    if elapsed * 1000 > IMPORT_BUDGET_MS:
+        raise SystemExit('import oprex took %.1fms, over the %dms budget' % (elapsed * 1000, IMPORT_BUDGET_MS))
+
+
+def nested_definitions_source(depth, width):
+    # every level defines `width` leaf variables plus the next, deeper level -- all used by its expression
+    lines = ['']
+    for level in range(depth):
+        names = ['v%d_%d' % (level, n) for n in range(width)]
+        if level < depth - 1:
+            names.append('v%d' % (level + 1))
+        expression = '/%s/' % '/'.join(names)
+        lines.append(' ' * level + ('v%d = %s' % (level, expression) if level else expression))
+        for n in range(width):
+            lines.append(' ' * (level + 1) + "v%d_%d = 'x%d'" % (level, n, n))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+@benchmark
+def nested_scopes():
+    import oprex
+    compiler = oprex.OprexCompiler()
+    for depth, width in ((100, 10), (200, 10), (400, 10), (800, 10)):
+        source = nested_definitions_source(depth, width)
+        elapsed = best_of(3, compiler.oprex, source)
+        report('nested scopes depth=%d width=%d' % (depth, width), elapsed, '(%d definitions)' % (depth * (width + 1)))
+
+
+def small_sources(count):
+    template = '''
+        /prefix/number/unit/
+            prefix = 'metric_%d='
+            number = @1.. of digit
+            unit = <<|
+                     |'ms'
+                     |'s'
+    '''
+    return [template % n for n in range(count)]
+
+
+@benchmark
+def batch_compile():
+    import oprex
+    sources = small_sources(2000)
+
+    def one_by_one():
+        for source in sources:
+            oprex.OprexCompiler().oprex(source)
+    report('2000 sources, fresh compiler each', best_of(3, one_by_one))
+
+    stats = oprex.BatchStats()
+    def batch():
+        for _ in oprex.OprexCompiler().compile_many(sources, stats):
+            pass
+    report('2000 sources, compile_many', best_of(3, batch), '(%d sources/s)' % (stats.throughput))
+
+
+@benchmark
+def directory_compile():
+    # one interpreter per file (the old CLI) vs. the pooled CLI, at 1..cpu_count jobs
+    import multiprocessing, shutil, subprocess, tempfile
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'oprex', 'oprex.py')
+    tempdir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for n, source in enumerate(small_sources(200)):
+            path = os.path.join(tempdir, 'pattern%03d.op' % n)
+            with open(path, 'w') as f:
+                f.write(source)
+            paths.append(path)
+
+        def per_file():
+            for path in paths[:20]:
+                subprocess.check_output([sys.executable, script, path])
+        report('20 files, one interpreter each', best_of(1, per_file), '(x10 for 200 files)')
+
+        jobs = 1
+        while True:
+            elapsed = best_of(3, subprocess.check_output, [sys.executable, script, tempdir, '--jobs', str(jobs)])
+            report('200 files, --jobs %d' % jobs, elapsed)
+            if jobs >= multiprocessing.cpu_count():
+                break
+            jobs = min(jobs * 2, multiprocessing.cpu_count())
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def mixed_source(count):
+    # `count` definitions of every kind: strings, charclasses, OR-blocks, lookarounds, quantifiers
+    lines = ['', '/%s/' % '/'.join('d%d' % n for n in range(count))]
+    for n in range(count):
+        kind = n % 4
+        if kind == 0:
+            lines.append("    d%d = 'literal %d' -- a comment" % (n, n))
+        elif kind == 1:
+            lines.append('    d%d = (ignorecase) @1.. of: a..f +digit :EM_DASH /Lu \\t' % n)
+        elif kind == 2:
+            indent = ' ' * len('    d%d = <<' % n) # aligns the bars
+            lines.extend(['    d%d = <<|' % n, indent + "|'x%d'" % n, indent + '|@2.. of alpha', ''])
+        else:
+            lines.extend(['    d%d = <@>' % n, '        <alpha|', '              |!/digit/>', ''])
+    lines.append('')
+    return '\n'.join(lines)
+
+
+@benchmark
+def lexing():
+    import oprex
+    source_lines = oprex.sanitize(mixed_source(4000))
+    for lexer in ('ply', 'scanner'):
+        compiler = oprex.OprexCompiler(lexer=lexer)
+        def drain():
+            lexer = compiler.build_lexer(source_lines)
+            count = 0
+            while lexer.token() is not None:
+                count += 1
+            drain.count = count
+        elapsed = best_of(3, drain)
+        report('lex 4000 definitions, %s' % lexer, elapsed, '(%d tokens/s)' % (drain.count / elapsed))
+
+
+@benchmark
+def parser_scaling():
+    import oprex
+    def orblock(count):
+        return '\n'.join(['', '<<|'] + ["  |'x%d'" % n for n in range(count)] + ['', ''])
+    def definitions(count):
+        names = ['v%d' % n for n in range(count)]
+        return '\n'.join(['', '/%s/' % '/'.join(names)] + ["    %s = 'x'" % name for name in names] + [''])
+    for parser in oprex.OprexCompiler.parsers:
+        compiler = oprex.OprexCompiler(parser=parser)
+        for count in (10, 100, 1000, 10000, 100000):
+            for kind, make_source in (('or-items', orblock), ('definitions', definitions)):
+                source = make_source(count)
+                elapsed = best_of(3, compiler.oprex, source) # one run at 100000 is too noisy to tell the scaling
+                report('%s, %d %s' % (parser, count, kind), elapsed, '(%.1f us/item)' % (elapsed * 1e6 / count))
+
+
+@benchmark
+def tracking():
+    import oprex
+    source_lines = oprex.sanitize(mixed_source(4000))
+    compiler = oprex.OprexCompiler()
+    for tracked in (True, False):
+        elapsed = best_of(3, compiler.compile_lines_with, source_lines, tracked)
+        report('compile 4000 definitions, %s' % ('tracked' if tracked else 'untracked'), elapsed)
+
+
+@benchmark
+def column_lookups():
+    import oprex
+    count = 20000
+    source = '\n'.join(['', '/alts/', '    alts = <<|'] + ["             |'x%d'" % n for n in range(count)] + ['', ''])
+    long_lines = '\n'.join(['', '/x/'] + [' '.join(["'%s'|" % ('x' * 40)] * 100) for _ in range(count // 100)] + ['']) # as many bars, 100 per line
+    for kind, data in (('one per line', source), ('100 per line', long_lines)):
+        positions = oprex.SourcePositions(data)
+        bars = [(index, positions.lineno(index)) for index, char in enumerate(data) if char == '|']
+        def by_rfind():
+            for lexpos, lineno in bars:
+                lexpos - data.rfind('\n', 0, lexpos)
+        def by_bisect():
+            for lexpos, lineno in bars:
+                positions.column(lexpos)
+        def by_lineno(): # as find_column() does, tokens know their line
+            for lexpos, lineno in bars:
+                positions.column(lexpos, lineno)
+        report('index a %d-line source' % len(positions.line_starts), best_of(3, oprex.SourcePositions, data))
+        report('%d bar columns, %s, rfind' % (len(bars), kind), best_of(3, by_rfind))
+        report('%d bar columns, %s, bisect' % (len(bars), kind), best_of(3, by_bisect))
+        report('%d bar columns, %s, token lineno' % (len(bars), kind), best_of(3, by_lineno))
+    compiler = oprex.OprexCompiler()
+    report('compile %d-item OR-block' % count, best_of(3, compiler.oprex, source))
+
+
+@benchmark
+def charclass_checks():
+    import oprex
+    lines = ['', '/%s/' % '/'.join('c%d' % n for n in range(2000))]
+    for n in range(2000):
+        lines.append('    c%d: a..f +digit :EM_DASH /Lu \\t , ; x..z' % n)
+    source_lines = oprex.sanitize('\n'.join(lines + ['']))
+    compiler = oprex.OprexCompiler()
+    for deferred in (False, True):
+        elapsed = best_of(3, compiler.compile_lines_with, source_lines, not deferred)
+        report('compile 2000 charclasses, checks %s' % ('deferred' if deferred else 'per item'), elapsed)
+
+
+@benchmark
+def keyword_trie():
+    import oprex, random, regex
+    rng = random.Random(5000)
+    def word():
+        return ''.join(rng.choice('etaoinshrdlucmfw') for _ in range(rng.randint(3, 9)))
+    keywords = sorted(set(word() for _ in range(5000)))
+    text = ' '.join(rng.choice(keywords) if rng.random() < 0.2 else word() for _ in range(20000))
+    source = '\n'.join(['', '/BOW/keyword/EOW/', '    keyword = <<|'] + ["                |'%s'" % kw for kw in keywords] + ['', ''])
+    for optimize in (False, True):
+        pattern = regex.compile(oprex.oprex(source, optimize=optimize))
+        elapsed = best_of(3, pattern.findall, text)
+        report('%d keywords, %s' % (len(keywords), 'trie' if optimize else 'flat'), elapsed,
+            '(%.2f MB/s, %d matches)' % (len(text) / elapsed / 1e6, len(pattern.findall(text))))
+
+
+@benchmark
+def charclass_algebra():
+    import oprex, random, regex
+    rng = random.Random(5000)
+    text = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 .,') for _ in range(1000000))
+    source = u'''
+        /consonant/hexword/
+            consonant: a..z A..Z not a e i o u A E I O U
+            hexword: +hexletter and /Alphabetic not +vowel
+                hexletter: 0..9 a..f A..F
+                vowel: a e i o u A E I O U
+    '''
+    for optimize in (False, True):
+        pattern = regex.compile(oprex.oprex(source, optimize=optimize))
+        elapsed = best_of(3, pattern.findall, text)
+        report('%s %s' % ('folded' if optimize else 'as written', pattern.pattern), elapsed,
+            '(%.2f MB/s, %d matches)' % (len(text) / elapsed / 1e6, len(pattern.findall(text))))
+
+
+@benchmark
+def possessive_logs():
+    # lines that almost match: the hex dump runs into a space instead of the colon
+    import oprex, random, regex
+    rng = random.Random(5000)
+    lines = ['2016-12-27 %s %s request done in %dms' % (
+        rng.choice(['INFO', 'WARN', 'ERROR']),
+        ''.join(rng.choice('0123456789abcdef') for _ in range(2 * rng.randint(20, 200))),
+        rng.randint(1, 999),
+    ) for _ in range(5000)]
+    source = '''
+        /date/space/level/space/dump/colon/space/duration/unit/
+            date = /year/dash/month/dash/day/
+                year = 4 of digit
+                month = 2 of digit
+                day = 2 of digit
+                dash = '-'
+            level = 1.. <<- of upper
+            dump = 1.. <<- of hexbyte
+                hexbyte = 2 of hex
+                    hex: 0..9 a..f
+            colon = <<|
+                      |':'
+                      |' ='
+
+            duration = 1.. <<- of digit
+            unit = 'ms'
+    '''
+    for optimize in (False, ['possessive']):
+        pattern = regex.compile(oprex.oprex(source, optimize=optimize))
+        def scan():
+            return sum(1 for line in lines if pattern.search(line))
+        elapsed = best_of(3, scan)
+        report('5000 failing lines, %s' % ('possessive' if optimize else 'as written'), elapsed,
+            '(%.1f us/line, %d matches) %s' % (elapsed * 1e6 / len(lines), scan(), pattern.pattern))
+
+
+
+@benchmark
+def prefilter_logs():
+    # 1 line in 20 has the ERROR the pattern requires
+    import oprex, random
+    rng = random.Random(5000)
+    lines = ['2016-12-27 %s worker-%d: %s' % (
+        'ERROR' if rng.random() < 0.05 else rng.choice(['INFO', 'WARN', 'DEBUG']),
+        rng.randint(1, 64),
+        ' '.join(rng.choice(['request', 'done', 'in', 'retry', 'code', 'disk', '42ms']) for _ in range(rng.randint(3, 12))),
+    ) for _ in range(50000)]
+    source = '''
+        /date/space/error/space/worker/colon/
+            date = /year/dash/month/dash/day/
+                year = 4 of digit
+                month = 2 of digit
+                day = 2 of digit
+                dash = '-'
+            error = 'ERROR'
+            worker = /name/hyphen/number/
+                name = 1.. <<- of lower
+                hyphen = '-'
+                number = 1.. <<- of digit
+            colon = ':'
+    '''
+    pattern = oprex.compile(source)
+    prefiltered = oprex.compile(source, prefilter=True)
+    for name, scan in [
+        ('Pattern.search', lambda: sum(1 for line in lines if pattern.search(line))),
+        ('Prefilter.search', lambda: sum(1 for line in lines if prefiltered.search(line))),
+        ('Prefilter.filter', lambda: sum(1 for line in prefiltered.filter(lines))),
+    ]:
+        elapsed = best_of(3, scan)
+        report('50000 log lines, %s' % name, elapsed,
+            '(%.2f us/line, %d matches)' % (elapsed * 1e6 / len(lines), scan()))
+
+
+@benchmark
+def start_scanner():
+    # ticket ids, rare among 2MB of words; the engine can't find where to start by itself when
+    # the pattern starts with BOW
+    import oprex, random
+    rng = random.Random(5000)
+    words = ['the', 'request', 'done', 'in', 'retry', 'code', 'disk', 'ms', 'worker', 'queue']
+    text = ' '.join(rng.choice(words) if rng.random() > 0.001 else 'JIRA-%d' % rng.randint(1, 9999) for _ in range(400000))
+    source = '''
+        /BOW/project/dash/number/
+            project = 2.. <<- of upper
+            dash = '-'
+            number = 1.. <<- of digit
+    '''
+    scanner = oprex.start_scanner(source)
+    for name, scan in [
+        ('Pattern.finditer', lambda: sum(1 for match in scanner.pattern.finditer(text))),
+        ('StartScanner.finditer', lambda: sum(1 for match in scanner.finditer(text))),
+    ]:
+        elapsed = best_of(3, scan)
+        report('2MB of words, %s' % name, elapsed,
+            '(%.2f MB/s, %d matches)' % (len(text) / elapsed / 1e6, scan()))
+
+
+@benchmark
+def classifier():
+    # 400 templates, one per component; each line matches one of them, WARN lines also the last
+    import oprex, random
+    from collections import OrderedDict
+    rng = random.Random(5000)
+    word = lambda: ''.join(rng.choice('etaoinshrdlucmfw') for _ in range(rng.randint(4, 9)))
+    components = sorted(set(word() for _ in range(450)))[:400]
+    lines = ['2016-12-27 %s %s[%d]: %s %s' % (
+        rng.choice(['INFO', 'WARN', 'ERROR']), rng.choice(components), rng.randint(1, 999), word(), word(),
+    ) for _ in range(5000)]
+    template = '''
+        /level/space/component/lbracket/pid/rbracket/colon/space/message/
+            level = <<|
+                      |'ERROR'
+                      |'WARN'
+
+            component = '%s'
+            lbracket = '['
+            [pid] = 1.. <<- of digit
+            rbracket = ']'
+            colon = ':'
+            [message] = 1.. <<- of alpha
+    '''
+    patterns = OrderedDict((component, template % component) for component in components)
+    patterns['warning'] = "\n/warn/space/word/\n    warn = 'WARN'\n    [word] = 1.. <<- of alnum\n"
+    start = time.time()
+    combined = oprex.Classifier(patterns)
+    report('Classifier of %d patterns' % len(patterns), time.time() - start, '(%d chars of regex)' % len(combined.regex))
+    compiled = [(name, oprex.compile(source)) for name, source in patterns.items()]
+    for name, scan in [
+        ('per-pattern loop', lambda: sum(1 for line in lines for name, pattern in compiled if pattern.search(line))),
+        ('Classifier.classify', lambda: sum(1 for line in lines if combined.classify(line))),
+        ('Classifier.classify_all', lambda: sum(len(combined.classify_all(line)) for line in lines)),
+    ]:
+        elapsed = best_of(3, scan)
+        report('5000 log lines, %s' % name, elapsed,
+            '(%.1f us/line, %d matches)' % (elapsed * 1e6 / len(lines), scan()))
+
+
+@benchmark
+def pattern_set():
+    # 1k and 10k templates, one per component, plus one without literals, which always runs
+    import oprex, random
+    from collections import OrderedDict
+    template = '''
+        /level/space/component/lbracket/pid/rbracket/
+            level = <<|
+                      |'ERROR'
+                      |'WARN'
+
+            component = '%s'
+            lbracket = '['
+            [pid] = 1.. <<- of digit
+            rbracket = ']'
+    '''
+    for count in (1000, 10000):
+        rng = random.Random(5000)
+        word = lambda: ''.join(rng.choice('etaoinshrdlucmfw') for _ in range(rng.randint(5, 10)))
+        components = sorted(set(word() for _ in range(count + count // 5)))[:count]
+        lines = ['2016-12-27 %s %s[%d]: %s %s' % (
+            rng.choice(['INFO', 'WARN', 'ERROR']), rng.choice(components), rng.randint(1, 999), word(), word(),
+        ) for _ in range(5000)]
+        patterns = OrderedDict((component, template % component) for component in components)
+        patterns['disk'] = "\n(ignorecase)\n'disk full'\n"
+        start = time.time()
+        pattern_set = oprex.PatternSet(patterns)
+        report('PatternSet of %d patterns' % len(patterns), time.time() - start,
+            '(%d literals, %d automaton states)' % (len(pattern_set.literals), len(pattern_set.automaton.goto)))
+        compiled = [(name, oprex.compile(source)) for name, source in patterns.items()]
+        for name, scan, sample in [
+            ('per-pattern loop', lambda lines: sum(1 for line in lines for name, pattern in compiled if pattern.search(line)), lines[:200]),
+            ('PatternSet.classify_all', lambda lines: sum(len(pattern_set.classify_all(line)) for line in lines), lines),
+        ]:
+            scan(sample) # compiles what's compiled on first use
+            elapsed = best_of(3, scan, sample)
+            report('%d patterns, %s' % (len(patterns), name), elapsed / len(sample) * 1000,
+                '(per 1000 lines, %d lines/s)' % (len(sample) / elapsed))
+
+
+@benchmark
+def stream():
+    # 20MB of log lines, read from a file object in 1MB chunks versus searched whole
+    import io, oprex, random
+    rng = random.Random(5000)
+    text = ''.join('2016-12-27 %s worker-%d: %s\n' % (
+        rng.choice(['INFO', 'WARN', 'ERROR']), rng.randint(1, 64),
+        ' '.join(rng.choice(['request', 'done', 'in', 'retry', 'code', 'disk', '42ms']) for _ in range(rng.randint(3, 12))),
+    ) for _ in range(300000))
+    for name, source in [('bounded', '''
+        /level/space/worker/
+            level = 'ERROR'
+            worker = /name/hyphen/number/
+                name = 'worker'
+                hyphen = '-'
+                number = 1..2 <<- of digit
+    '''), ('unbounded, by line', '''
+        /level/space/worker/
+            level = 'ERROR'
+            worker = /name/hyphen/number/
+                name = 1.. <<- of lower
+                hyphen = '-'
+                number = 1.. <<- of digit
+    ''')]:
+        matcher = oprex.stream_matcher(source)
+        for label, scan in [
+            ('Pattern.finditer', lambda: sum(1 for match in matcher.pattern.finditer(text))),
+            ('StreamMatcher.finditer', lambda: sum(1 for match in matcher.finditer(io.BytesIO(text)))),
+        ]:
+            elapsed = best_of(3, scan)
+            report('%dMB, %s, %s' % (len(text) >> 20, name, label), elapsed,
+                '(%.1f MB/s, %d matches)' % (len(text) / elapsed / 1e6, scan()))
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or BENCHMARKS.keys()
+    for name in names:
+        BENCHMARKS[name]()
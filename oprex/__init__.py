@@ -1,3 +1,5 @@
 from oprex import *
-from parsetab import *
-
+from store import PatternStore
+from aot import BuildError, build_module, write_module
+from classifier import Classifier, Classification
+from patternset import PatternSet
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# Ahead-of-time compilation: turns a directory of .op sources into a plain Python module
+# holding the emitted regexes as string constants, so production code can use them without
+# loading ply or building the oprex lexer/parser at startup.
+#
+# usage: python -m oprex.aot path/to/sources path/to/output_module.py
+
+import codecs, os, regex as regexlib
+from oprex import SOURCE_EXT, VERSION, OprexError, error_message, find_source_files, oprex
+
+MODULE_HEADER = '''# -*- coding: utf-8 -*-
+# Generated by oprex %(version)s from %(source_dir)s -- do not edit.
+
+'''
+
+MODULE_FOOTER = '''
+
+_compiled = {}
+
+def pattern(name):
+    """Return the compiled regex Pattern of the named constant, compiling it on first use."""
+    try:
+        return _compiled[name]
+    except KeyError:
+        import regex
+        compiled = _compiled[name] = regex.compile(PATTERNS[name][0])
+        return compiled
+'''
+
+MODULE_NAMES = ('PATTERNS', 'pattern', '_compiled') # defined by the module itself, see MODULE_FOOTER
+CONSTANT_SUFFIXES = ('', '_CAPTURE_NAMES', '_FLAGS') # the constants defined for each source
+
+
+class BuildError(Exception):
+    def __init__(self, path, error):
+        if not isinstance(path, unicode):
+            path = path.decode('utf-8', 'replace')
+        Exception.__init__(self, u'%s: %s' % (path, error_message(error).strip()))
+
+
+def constant_name(source_dir, path):
+    name = os.path.relpath(path, source_dir)[:-len(SOURCE_EXT)]
+    name = regexlib.sub(r'\W+', '_', name).upper()
+    if not name: # e.g. a file named just .op
+        raise BuildError(path, 'no constant name can be made of the file name')
+    if name[0].isdigit():
+        name = '_' + name
+    return name
+
+
+def compile_sources(source_dir, encoding='utf-8'):
+    compiled = []
+    seen = dict((name, 'the generated module') for name in MODULE_NAMES) # every name defined so far -> its source
+    for path in find_source_files([source_dir]):
+        name = constant_name(source_dir, path)
+        names = [name + suffix for suffix in CONSTANT_SUFFIXES]
+        for defined in names:
+            if defined in seen:
+                raise BuildError(path, "name '%s' clashes with %s" % (defined, seen[defined]))
+        seen.update(dict.fromkeys(names, path))
+        with codecs.open(path, 'r', encoding) as f:
+            source_code = f.read()
+        try:
+            compiled.append((name, oprex(source_code)))
+        except OprexError as e:
+            raise BuildError(path, e)
+    return compiled
+
+
+def build_module(source_dir, encoding='utf-8'):
+    compiled = compile_sources(source_dir, encoding)
+    lines = [MODULE_HEADER % dict(version=VERSION, source_dir=source_dir)]
+    for name, result in compiled:
+        lines.append('%s = %r\n' % (name, unicode(result)))
+        lines.append('%s_CAPTURE_NAMES = %r\n' % (name, result.capture_names))
+        lines.append('%s_FLAGS = %r\n\n' % (name, result.flags))
+
+    lines.append('PATTERNS = {\n')
+    for name, _ in compiled:
+        lines.append('    %r : (%s, %s_CAPTURE_NAMES, %s_FLAGS),\n' % (name, name, name, name))
+    lines.append('}\n')
+    lines.append(MODULE_FOOTER)
+    return ''.join(lines)
+
+
+def write_module(source_dir, output_path, encoding='utf-8'):
+    module_source = build_module(source_dir, encoding)
+    temp_path = output_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(module_source)
+    os.rename(temp_path, output_path) # never leave a half-written module behind
+
+
+if __name__ == '__main__':
+    import argparse # not loaded by importing oprex, which imports this module
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('path/to/source/dir')
+    argparser.add_argument('path/to/output/module')
+    argparser.add_argument('--encoding', help='encoding of the source files')
+    args = argparser.parse_args()
+
+    source_dir = getattr(args, 'path/to/source/dir')
+    output_path = getattr(args, 'path/to/output/module')
+    try:
+        write_module(source_dir, output_path, args.encoding or 'utf-8')
+    except BuildError as e:
+        raise SystemExit(unicode(e).encode('utf-8'))
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+# Static analysis of a compiled regex's IR for the shapes that make a backtracking engine take
+# exponential or polynomial time on text that almost matches (ReDoS):
+#   - a repeat within a repeat, where the inner one may end the outer's repetition and take the
+#     characters that start the next one, e.g. (?:\d+\s?)+ -- a run of digits may be split among
+#     repetitions in exponentially many ways, all tried before giving up;
+#   - alternatives that may match the same text within a repeat, e.g. (?:\w|\d)+;
+#   - repeats of the same characters side by side, e.g. \d+\d+ -- polynomial.
+# Atomic groups and possessive quantifiers are never backtracked into, so they're not reported.
+# The analysis is conservative: what can't be told apart here (backreferences, case-insensitive
+# scopes...) is assumed to overlap.
+
+from collections import namedtuple
+import charset, ir
+from passes import first_chars, is_fixed, literal_units, scoped_flags, single_chars
+
+
+Risk = namedtuple('Risk', 'name lineno kind reason') # name is None for the main expression
+
+UNBOUNDED = float('inf')
+
+
+def describe(risk):
+    subject = "'%s'" % risk.name if risk.name else 'The expression'
+    return 'Line %d: %s may backtrack %s: %s' % (risk.lineno, subject, risk.kind, risk.reason)
+
+
+def risks(root, definitions=(), main_lineno=0):
+    # The risks found in root, each attributed to the innermost of the definitions (Variables, in
+    # any order) whose value holds the offending node, or else to the main expression.
+    owners = []
+    for var in definitions:
+        node = ir_node(var.value)
+        owners.append((var, set(id(descendant) for descendant in ir.walk(node))))
+    owners.sort(key=lambda (var, ids): len(ids))
+
+    found = []
+    seen = set()
+    for node, kind, reason in findings(root):
+        for var, ids in owners:
+            if id(node) in ids:
+                risk = Risk(var.name, var.lineno, kind, reason)
+                break
+        else:
+            risk = Risk(None, main_lineno, kind, reason)
+        if risk not in seen:
+            seen.add(risk)
+            found.append(risk)
+    found.sort(key=lambda risk: risk.lineno)
+    return found
+
+
+def ir_node(regex):
+    node = getattr(regex, 'node', None)
+    return node if node is not None else ir.EMPTY
+
+
+def findings(root):
+    # yields (node, kind, reason) for every risky node
+    stack = [(root, root.flags)]
+    while stack:
+        node, flags = stack.pop()
+        flags = scoped_flags(node, flags)
+        if is_atomic(node):
+            continue
+        if isinstance(node, ir.Quantifier) and max_repeats(node.quantifier) > 1:
+            body_chars = first_chars(node.body, flags)[0]
+            for inner, inner_flags in ending_repeats(node.body, flags):
+                if overlap(alphabet(inner.body, inner_flags), body_chars, flags):
+                    yield node, 'exponentially', 'a repeat within a repeat, over the same characters'
+                    break
+            for alternation, alternation_flags in alternations(node.body, flags):
+                if ambiguous(alternation, alternation_flags, body_chars):
+                    yield node, 'exponentially', 'alternatives matching the same text, within a repeat'
+                    break
+        if isinstance(node, ir.Sequence):
+            for reason in adjacent_repeats(node, flags):
+                yield node, 'polynomially', reason
+                break
+        children = []
+        node.map(children.append)
+        stack.extend((child, flags) for child in reversed(children))
+
+
+def is_atomic(node):
+    if isinstance(node, ir.Group):
+        return node.opener == '(?>'
+    if isinstance(node, ir.Quantifier):
+        return len(node.quantifier) > 1 and node.quantifier.endswith('+')
+    return False
+
+
+def max_repeats(quantifier):
+    if quantifier[0] in '*+':
+        return UNBOUNDED
+    if quantifier[0] == '?':
+        return 1
+    bounds = quantifier[1:quantifier.index('}')].split(',')
+    return int(bounds[-1]) if bounds[-1] else UNBOUNDED
+
+
+def is_repeat(node):
+    return isinstance(node, ir.Quantifier) and not is_atomic(node) and max_repeats(node.quantifier) > 1
+
+
+def ending_repeats(node, flags):
+    # the repeats within node after which it may end, matching nothing more
+    flags = scoped_flags(node, flags)
+    if is_atomic(node):
+        return
+    if isinstance(node, ir.Quantifier):
+        if is_repeat(node):
+            yield node, flags
+        for repeat in ending_repeats(node.body, flags):
+            yield repeat
+    elif isinstance(node, ir.Group):
+        for repeat in ending_repeats(node.body, flags):
+            yield repeat
+    elif isinstance(node, ir.Alternation):
+        for item in node.items:
+            for repeat in ending_repeats(item, flags):
+                yield repeat
+    elif isinstance(node, ir.Sequence):
+        for item in reversed(node.items):
+            for repeat in ending_repeats(item, flags):
+                yield repeat
+            if not first_chars(item, flags)[1]:
+                break
+
+
+def alternations(node, flags):
+    # the alternations within node, outside of atomic groups and lookarounds
+    flags = scoped_flags(node, flags)
+    if is_atomic(node) or isinstance(node, ir.Lookaround):
+        return
+    if isinstance(node, ir.Alternation):
+        yield node, flags
+    children = []
+    node.map(children.append)
+    for child in children:
+        for alternation in alternations(child, flags):
+            yield alternation
+
+
+def ambiguous(alternation, flags, restart):
+    # Whether two of the alternatives may match the same text: their leading single characters
+    # overlap, position by position, up to where one of them ends or stops being fixed. When both
+    # are fixed but one is longer, e.g. a|aa, the rest of the longer one must also be told apart
+    # from restart, what starts the next repetition.
+    prefixes = [fixed_prefix(item, flags) for item in alternation.items]
+    for i, (a, a_complete) in enumerate(prefixes):
+        for b, b_complete in prefixes[i + 1:]:
+            length = min(len(a), len(b))
+            if not all(overlap(x, y, flags) for x, y in zip(a[:length], b[:length])):
+                continue # told apart by a character
+            if a_complete and b_complete and len(a) != len(b):
+                rest = max(a, b, key=len)[length]
+                if not overlap(rest, restart, flags):
+                    continue # e.g. a|ab, when b can't start a repetition
+            return True
+    return False
+
+
+def fixed_prefix(node, flags):
+    # The leading single-character matchers of node, as CharSets (or None, for unknown), and
+    # whether those are all of it.
+    flags = scoped_flags(node, flags)
+    if isinstance(node, ir.Literal):
+        units = literal_units(node.text) if node.text else ()
+        return [single_chars(unit, flags, is_literal=True) for unit in units], True
+    if isinstance(node, ir.CharClass):
+        return [single_chars(node.text, flags)], True
+    if isinstance(node, ir.Group) and not is_atomic(node):
+        return fixed_prefix(node.body, flags)
+    if isinstance(node, ir.Sequence):
+        prefix = []
+        for item in node.items:
+            item_prefix, complete = fixed_prefix(item, flags)
+            prefix.extend(item_prefix)
+            if not complete:
+                return prefix, False
+        return prefix, True
+    if isinstance(node, ir.Quantifier) and is_fixed(node):
+        count = int(node.quantifier[1:-1])
+        body_prefix, _ = fixed_prefix(node.body, flags)
+        return body_prefix * count, True
+    chars, nullable = first_chars(node, flags)
+    return ([] if nullable else [chars]), False
+
+
+def adjacent_repeats(sequence, flags):
+    # yields a reason for each unbounded repeat followed by another over the same characters,
+    # with only what may match nothing in between; either may be nested, e.g. in a definition's
+    # own sequence
+    items = sequence.items
+    for i, item in enumerate(items):
+        for repeat, repeat_flags in edge_repeats(item, flags, reversed):
+            chars = alphabet(repeat.body, repeat_flags)
+            for following in items[i + 1:]:
+                for following_repeat, following_flags in edge_repeats(following, flags, iter):
+                    if overlap(chars, alphabet(following_repeat.body, following_flags), flags):
+                        yield 'consecutive repeats over the same characters'
+                        return
+                if not first_chars(following, flags)[1]:
+                    break
+
+
+def edge_repeats(node, flags, order):
+    # The unbounded repeats node may start with, matching nothing before them; with order
+    # reversed, those it may end with. Looked for within groups (e.g. a capture's), sequences and
+    # alternations, as ending_repeats() does.
+    flags = scoped_flags(node, flags)
+    if is_atomic(node):
+        return
+    if isinstance(node, ir.Quantifier):
+        if is_repeat(node) and max_repeats(node.quantifier) == UNBOUNDED:
+            yield node, flags
+        else: # the body's, of its first or last repetition
+            for repeat in edge_repeats(node.body, flags, order):
+                yield repeat
+    elif isinstance(node, ir.Group):
+        for repeat in edge_repeats(node.body, flags, order):
+            yield repeat
+    elif isinstance(node, ir.Alternation):
+        for item in node.items:
+            for repeat in edge_repeats(item, flags, order):
+                yield repeat
+    elif isinstance(node, ir.Sequence):
+        for item in order(node.items):
+            for repeat in edge_repeats(item, flags, order):
+                yield repeat
+            if not first_chars(item, flags)[1]:
+                break
+
+
+def alphabet(node, flags):
+    # every character node may match, as a CharSet; None if that's not known here
+    flags = scoped_flags(node, flags)
+    if isinstance(node, ir.Literal):
+        chars = charset.CharSet()
+        for unit in (literal_units(node.text) if node.text else ()):
+            unit_chars = single_chars(unit, flags, is_literal=True)
+            if unit_chars is None:
+                return None
+            chars = chars.union(unit_chars)
+        return chars
+    if isinstance(node, ir.CharClass):
+        return single_chars(node.text, flags)
+    if isinstance(node, (ir.Group, ir.Quantifier, ir.Sequence, ir.Alternation)):
+        children = []
+        node.map(children.append)
+        chars = charset.CharSet()
+        for child in children:
+            child_chars = alphabet(child, flags)
+            if child_chars is None:
+                return None
+            chars = chars.union(child_chars)
+        return chars
+    if isinstance(node, (ir.Anchor, ir.Lookaround)):
+        return charset.CharSet() # zero-width
+    return None
+
+
+def overlap(a, b, flags=''):
+    if a is None or b is None:
+        return True
+    return not charset.disjoint(a, b, flags)
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+# Character classes as sets of code points, for evaluating their set operations at compile time
+# (see the charclass pass in passes.py). A class is parsed from its regex text (V1 syntax) into
+# sorted, non-overlapping code point intervals, plus the items whose members aren't known here --
+# \d, \w, \p{...} and the like, whose meaning depends on the regex engine's Unicode tables and
+# flags -- which are kept as they are, and only allowed in unions.
+
+import unicodedata, regex as regexlib
+from lazy import LazyRegex
+
+
+MAX_CODEPOINT = 0x10FFFF
+OPAQUE_NEGATIONS = {
+    r'\d' : r'\D', r'\D' : r'\d',
+    r'\s' : r'\S', r'\S' : r'\s',
+    r'\w' : r'\W', r'\W' : r'\w',
+}
+DISJOINT_OPAQUES = frozenset(
+    pair
+    for x, y in ((r'\d', r'\s'), (r'\w', r'\s'), (r'\d', r'\D'), (r'\s', r'\S'), (r'\w', r'\W'), (r'\d', r'\W'))
+    for pair in ((x, y), (y, x))
+)
+SINGLE_CHAR_ESCAPES = {
+    'a' : 0x07, 'b' : 0x08, 'f' : 0x0C, 'n' : 0x0A, 'r' : 0x0D, 't' : 0x09, 'v' : 0x0B,
+}
+ESCAPE_RE = LazyRegex(r'''(?x)\\
+    ( N\{(?P<name>[^}]*)\}
+    | U(?P<hex8>[0-9a-fA-F]{8})
+    | u(?P<hex4>[0-9a-fA-F]{4})
+    | x(?P<hex2>[0-9a-fA-F]{2})
+    | (?P<octal>[0-7]{1,3})
+    | (?P<opaque>[dDsSwW] | [pP]\{[^}]*\} | [pP][A-Za-z])
+    | (?P<char>.)
+    )''')
+CLASS_SPECIALS = frozenset('\\[]^-&|~')
+RESOLVE_LIMIT = 0x1000 # code points an opaque item is tested against, at most
+
+
+class Unfoldable(Exception): # the class can't be evaluated here, it's left as it is
+    pass
+
+
+class CharSet:
+    def __init__(self, intervals=(), opaques=()):
+        self.intervals = tuple(intervals) # sorted, non-overlapping, non-adjacent (lo, hi) pairs
+        self.opaques = tuple(opaques) # in order of appearance, no repeats
+
+    @staticmethod
+    def of(intervals):
+        # normalizes intervals given in any order, possibly overlapping
+        merged = []
+        for lo, hi in sorted(intervals):
+            if merged and lo <= merged[-1][1] + 1:
+                if hi > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], hi)
+            else:
+                merged.append((lo, hi))
+        return CharSet(merged)
+
+    def known(self):
+        if self.opaques:
+            raise Unfoldable
+        return self.intervals
+
+    def union(self, other):
+        opaques = self.opaques + tuple(item for item in other.opaques if item not in self.opaques)
+        return CharSet(CharSet.of(self.intervals + other.intervals).intervals, opaques)
+
+    def complement(self):
+        if not self.intervals and len(self.opaques) == 1 and negation(self.opaques[0]):
+            return CharSet(opaques=[negation(self.opaques[0])])
+        intervals = []
+        start = 0
+        for lo, hi in self.known():
+            if lo > start:
+                intervals.append((start, lo - 1))
+            start = hi + 1
+        if start <= MAX_CODEPOINT:
+            intervals.append((start, MAX_CODEPOINT))
+        return CharSet(intervals)
+
+    def intersection(self, other):
+        intervals = []
+        a, b = self.known(), other.known()
+        i = j = 0
+        while i < len(a) and j < len(b):
+            lo, hi = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+            if lo <= hi:
+                intervals.append((lo, hi))
+            if a[i][1] < b[j][1]:
+                i += 1
+            else:
+                j += 1
+        return CharSet(intervals)
+
+    def difference(self, other):
+        return self.intersection(other.complement())
+
+    def symmetric_difference(self, other):
+        return self.difference(other).union(other.difference(self))
+
+    def __eq__(self, other):
+        return self.intervals == other.intervals and self.opaques == other.opaques
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def resolve(charset, within, flags):
+    # The members of charset, an opaque one, among the few code points within the intervals,
+    # e.g. for [0-9a-f&&\p{Hex_Digit}]: the engine tells which of those its opaque items match.
+    if sum(hi - lo + 1 for lo, hi in within) > RESOLVE_LIMIT or 'L' in flags: # locale's is known at match time
+        raise Unfoldable
+    flags = ''.join(flag for flag in flags if flag in 'au') # those changing what \d \w \s match
+    try:
+        matcher = regexlib.compile(u'(?V1%s)[%s]' % (flags, ''.join(charset.opaques)))
+        members = [
+            (codepoint, codepoint)
+            for lo, hi in within
+            for codepoint in xrange(lo, hi + 1)
+            if matcher.match(unichr(codepoint))
+        ]
+    except (regexlib.error, ValueError): # ValueError: a narrow Python build's unichr() goes up to U+FFFF only
+        raise Unfoldable
+    return CharSet.of(charset.intervals + tuple(members))
+
+
+def disjoint(a, b, flags=''):
+    # whether no character is in both sets; False when that can't be told
+    if CharSet(a.intervals).intersection(CharSet(b.intervals)).intervals:
+        return False
+    for x, y in ((a, b), (b, a)):
+        if x.opaques and y.intervals:
+            try:
+                if resolve(CharSet(opaques=x.opaques), y.intervals, flags).intervals:
+                    return False
+            except Unfoldable:
+                return False
+    return all((x, y) in DISJOINT_OPAQUES for x in a.opaques for y in b.opaques)
+
+
+def negation(opaque):
+    # e.g. \D for \d, \P{L} for \p{L}
+    if opaque in OPAQUE_NEGATIONS:
+        return OPAQUE_NEGATIONS[opaque]
+    if opaque[:2] in (r'\p', r'\P'):
+        return opaque.swapcase()[:2] + opaque[2:]
+    return None
+
+
+def parse(text, flags=''):
+    # A class's regex text into (negated, CharSet), given the flags it's matched with; raises
+    # Unfoldable if it isn't understood. When matching case-insensitively, the engine applies set
+    # operations and nested negations to the case-folded characters, not to those written, so only
+    # plain unions are evaluated then.
+    if not text.startswith('['): # ., \d, \p{L} and the like have nothing to evaluate
+        raise Unfoldable
+    parser = Parser(text, flags)
+    negated, charset = parser.set()
+    if parser.pos != len(text) or ('i' in flags and parser.operated):
+        raise Unfoldable
+    return negated, charset
+
+
+class Parser:
+    # Set operators, by increasing precedence: || ~~ && -- and then the implicit union of items
+    operators = (
+        ('||', lambda parser, a, b: a.union(b)),
+        ('~~', lambda parser, a, b: a.symmetric_difference(b)),
+        ('&&', lambda parser, a, b: parser.intersection(a, b)),
+        ('--', lambda parser, a, b: parser.difference(a, b)),
+    )
+
+    def __init__(self, text, flags):
+        self.text = text
+        self.flags = flags
+        self.pos = 0
+        self.operated = False # whether there's any set operation or nested set
+
+    def peek(self, length=1):
+        return self.text[self.pos:self.pos + length]
+
+    def set(self):
+        # [...] or [^...] -- not yet negated, so it can still be emitted with its opaque items
+        self.pos += 1
+        negated = self.peek() == '^'
+        if negated:
+            self.pos += 1
+        charset = self.operation(0)
+        if self.peek() != ']':
+            raise Unfoldable
+        self.pos += 1
+        return negated, charset
+
+    def operation(self, level):
+        if level == len(self.operators):
+            return self.items()
+        operator, apply = self.operators[level]
+        start = self.pos
+        charset = self.operation(level + 1)
+        while self.peek(2) == operator:
+            self.pos += 2
+            self.operated = True
+            operand = self.operation(level + 1)
+            try:
+                charset = apply(self, charset, operand)
+            except Unfoldable: # kept as a nested set, it may still be resolved by an outer operation
+                operation = self.text[start:self.pos]
+                if operation.startswith('^'): # a literal one, not to be read as a negation
+                    operation = '\\' + operation
+                charset = CharSet(opaques=['[%s]' % operation])
+        return charset
+
+    def items(self):
+        charset = CharSet()
+        after_range = False
+        while self.peek() and self.peek() != ']' and self.peek(2) not in ('||', '~~', '&&', '--'):
+            if self.peek() == '[':
+                self.operated = True
+                start = self.pos
+                negated, item = self.set()
+                if negated:
+                    try:
+                        item = item.complement()
+                    except Unfoldable:
+                        item = CharSet(opaques=[self.text[start:self.pos]])
+                after_range = False
+            elif after_range and self.peek() == '-': # a - right after a range is a literal, e.g. [a-c-e]
+                self.pos += 1
+                item = CharSet([(ord('-'), ord('-'))])
+                after_range = False
+            else:
+                item = self.item()
+                after_range = False
+                if self.peek() == '-' and self.peek(2) != '--' and self.peek(2)[1:] not in ('', ']', '['):
+                    self.pos += 1
+                    end = self.item()
+                    (lo, _), = item.known()
+                    (hi, _), = end.known()
+                    if lo > hi:
+                        raise Unfoldable
+                    item = CharSet([(lo, hi)])
+                    after_range = True
+            charset = charset.union(item)
+        if not charset.intervals and not charset.opaques:
+            raise Unfoldable # e.g. [] or a dangling operator
+        return charset
+
+    def intersection(self, a, b):
+        if a.opaques and b.opaques:
+            raise Unfoldable
+        if a.opaques:
+            a = resolve(a, b.intervals, self.flags)
+        elif b.opaques:
+            b = resolve(b, a.intervals, self.flags)
+        return a.intersection(b)
+
+    def difference(self, a, b):
+        if b.opaques:
+            b = resolve(b, a.known(), self.flags)
+        return a.difference(b)
+
+    def item(self):
+        # a single character, or an opaque item like \d
+        if self.peek() != '\\':
+            char = self.peek()
+            if not char or char in '[]':
+                raise Unfoldable
+            self.pos += 1
+            return CharSet([(ord(char), ord(char))])
+        match = ESCAPE_RE.match(self.text, self.pos)
+        if not match:
+            raise Unfoldable
+        self.pos = match.end()
+        if match.group('opaque'):
+            return CharSet(opaques=[match.group()])
+        if match.group('name') is not None:
+            try:
+                codepoint = ord(unicodedata.lookup(match.group('name')))
+            except (KeyError, TypeError): # unknown here -- maybe not to the engine, it's newer
+                return CharSet(opaques=[match.group()])
+        elif match.group('char'):
+            char = match.group('char')
+            if char.isalnum():
+                codepoint = SINGLE_CHAR_ESCAPES.get(char)
+                if codepoint is None:
+                    raise Unfoldable
+            else:
+                codepoint = ord(char)
+        else:
+            digits = match.group('hex8') or match.group('hex4') or match.group('hex2')
+            codepoint = int(digits, 16) if digits else int(match.group('octal'), 8)
+            if codepoint > MAX_CODEPOINT:
+                raise Unfoldable
+        return CharSet([(codepoint, codepoint)])
+
+
+def char_text(codepoint, in_class):
+    if 0x20 < codepoint < 0x7F:
+        char = chr(codepoint)
+        if in_class:
+            return '\\' + char if char in CLASS_SPECIALS else char
+        return regexlib.escape(char, special_only=True) if char != '#' else r'\#' # '#' starts a verbose comment
+    if codepoint == 0x20:
+        return ' ' if in_class else r'\ '
+    for char, escaped in SINGLE_CHAR_ESCAPES.iteritems():
+        if escaped == codepoint and char != 'b': # \b is backspace only within a class
+            return '\\' + char
+    if codepoint <= 0xFF:
+        return r'\x%02x' % codepoint
+    if codepoint <= 0xFFFF:
+        return r'\u%04x' % codepoint
+    return r'\U%08x' % codepoint
+
+
+def intervals_text(intervals):
+    parts = []
+    for lo, hi in intervals:
+        parts.append(char_text(lo, in_class=True))
+        if hi == lo + 1:
+            parts.append(char_text(hi, in_class=True))
+        elif hi > lo:
+            parts.append('-' + char_text(hi, in_class=True))
+    return ''.join(parts)
+
+
+def text(negated, charset, flags=''):
+    # the shortest class text matching the same as a parsed one, or None if there's none (empty);
+    # case-insensitive classes are kept in brackets and as negated as they were
+    intervals, opaques = charset.intervals, charset.opaques
+    if 'i' in flags:
+        if not intervals and not opaques:
+            return None
+        return '[%s%s%s]' % ('^' if negated else '', intervals_text(intervals), ''.join(opaques))
+    if not opaques:
+        if not intervals:
+            return None
+        complement = charset.complement().intervals
+        if len(complement) < len(intervals): # e.g. [^a] rather than [\x00-`b-\U0010ffff]
+            negated, intervals = not negated, complement
+            if not intervals:
+                return None
+    if not negated:
+        if not opaques and len(intervals) == 1 and intervals[0][0] == intervals[0][1]:
+            return char_text(intervals[0][0], in_class=False)
+        if not intervals and len(opaques) == 1:
+            return opaques[0]
+    elif not intervals and len(opaques) == 1 and negation(opaques[0]):
+        return negation(opaques[0])
+    return '[%s%s%s]' % ('^' if negated else '', intervals_text(intervals), ''.join(opaques))
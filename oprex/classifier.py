@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+# Many oprex patterns combined into a single regex, each one an alternative captured by a group
+# of its own (p0, p1...), so classifying text -- e.g. a log line against the templates of every
+# kind of line -- takes one search rather than one per pattern. The captures of pattern i are
+# renamed p<i>_<name> so those of different patterns don't clash, and the flags set by some of
+# the patterns only are scoped to their alternatives.
+
+from collections import namedtuple
+import charset, ir, regex as regexlib
+from oprex import Flagset, oprex
+from starts import start_chars
+
+
+GLOBAL_FLAGS = tuple(sorted(Flagset.globals.values())) # apply to the whole regex, can't be scoped to an alternative
+BLOCK = 32 # alternatives of the regexes looking for what the combined one doesn't report, see later_matches()
+
+# name: the pattern's, as given to Classifier; captures: its named groups, by their own names
+Classification = namedtuple('Classification', 'name span captures')
+
+
+class Classifier:
+    # patterns: a mapping of name to oprex source, or (name, source) pairs; the order they come
+    # in decides which one classify() reports when several match at the same position
+    def __init__(self, patterns, optimize=False):
+        if hasattr(patterns, 'items'):
+            patterns = patterns.items()
+        self.names = []
+        roots = []
+        for name, source in patterns:
+            node = oprex(source, optimize).node
+            if node is None:
+                raise ValueError("Pattern '%s' has no IR to combine" % name)
+            self.names.append(name)
+            roots.append(node)
+        if not roots:
+            raise ValueError('No patterns to combine')
+
+        self.global_flags = global_flags(self.names, roots)
+        turned = [scoped(root.flags) for root in roots] # (turn_ons, turn_offs) of each
+        common_ons = set.intersection(*[set(ons) for ons, offs in turned])
+        common_offs = set.intersection(*[set(offs) for ons, offs in turned])
+        self.flags = flagset(self.global_flags + ''.join(flag for flag in turned[0][0] if flag in common_ons),
+            ''.join(flag for flag in turned[0][1] if flag in common_offs))
+        self.captures = [] # per pattern, (group name, capture name) pairs
+        self.branches = []
+        for i, root in enumerate(roots):
+            body = ir.transform(root.body, lambda node: renamed(node, i))
+            ons, offs = turned[i]
+            own_flags = flagset(''.join(flag for flag in ons if flag not in common_ons),
+                ''.join(flag for flag in offs if flag not in common_offs))
+            if own_flags:
+                body = ir.Group('(?%s:' % own_flags, body)
+            self.branches.append(ir.emit(ir.Group('(?P<p%d>' % i, body)))
+            self.captures.append([(capture_name(i, node.capture_name), node.capture_name)
+                for node in ir.walk(root) if isinstance(node, ir.Group) and node.capture_name])
+
+        self.regex = self.alternation(0, len(self.branches))
+        self.pattern = regexlib.compile(self.regex)
+        self.alternations = {} # (start, stop) -> compiled alternation of those branches
+
+        # whether a later pattern may match where pattern i does, so the combined regex, taking
+        # the first alternative that matches, may not report it
+        self.shadows = [False] * len(roots)
+        later = charset.CharSet()
+        for i in reversed(xrange(len(roots))):
+            chars = start_chars(roots[i])
+            self.shadows[i] = later is None or chars is None or not charset.disjoint(chars, later)
+            later = None if later is None or chars is None else later.union(chars)
+
+    def alternation(self, start, stop):
+        return u'(?%s)(?:%s)' % (self.flags, '|'.join(self.branches[start:stop]))
+
+    def compiled(self, start, stop):
+        try:
+            return self.alternations[start, stop]
+        except KeyError:
+            pattern = self.alternations[start, stop] = regexlib.compile(self.alternation(start, stop))
+            return pattern
+
+    def classification(self, match):
+        i = branch(match)
+        captures = dict((name, match.group(group)) for group, name in self.captures[i])
+        return Classification(self.names[i], match.span(), captures)
+
+    def classify(self, text, pos=None, endpos=None):
+        # the name of the pattern matching first in text, None if none does; of those matching
+        # at the same position, the one that comes first
+        match = self.pattern.search(text, pos, endpos)
+        return self.names[branch(match)] if match else None
+
+    def search(self, text, pos=None, endpos=None):
+        # classify()'s pattern, as a Classification of its match
+        match = self.pattern.search(text, pos, endpos)
+        return self.classification(match) if match else None
+
+    def classify_all(self, text, pos=None, endpos=None):
+        # the names of every pattern matching in text, in the order they come
+        return [classification.name for classification in self.search_all(text, pos, endpos)]
+
+    def search_all(self, text, pos=None, endpos=None):
+        # A Classification of every pattern matching in text, of its first match, as its own
+        # search() would find. The combined regex is run at every position (overlapped), finding
+        # the first pattern matching there; the others matching at the same position, which only
+        # a later pattern can, are then looked for at those positions only.
+        found = {}
+        for match in self.pattern.finditer(text, pos, endpos, overlapped=True):
+            i = branch(match)
+            if i not in found:
+                found[i] = match
+            if self.shadows[i]:
+                for later in self.later_matches(text, match.start(), endpos, i):
+                    found.setdefault(branch(later), later)
+        return [self.classification(found[i]) for i in sorted(found)]
+
+    def later_matches(self, text, pos, endpos, i):
+        # The matches at pos of the patterns after i. Those are looked for by alternations of
+        # BLOCK patterns at most, each starting after the previous match, rather than by one of
+        # all the patterns after i: there would be one such regex per pattern, each of them big.
+        end = len(text) if endpos is None else endpos
+        start = i + 1
+        while start < len(self.branches):
+            stop = min((start // BLOCK + 1) * BLOCK, len(self.branches))
+            match = self.compiled(start, stop).match(text, pos, end)
+            if match:
+                yield match
+                start = branch(match) + 1
+            else:
+                start = stop
+
+
+def branch(match):
+    # the index of the pattern matched; its group closes last, after the captures within it
+    return int(match.lastgroup[1:])
+
+
+def capture_name(i, name):
+    return 'p%d_%s' % (i, name)
+
+
+def renamed(node, i):
+    # node, with the names of pattern i's captures made unique to it
+    if isinstance(node, ir.Group) and node.capture_name:
+        return ir.Group('(?P<%s>' % capture_name(i, node.capture_name), node.body)
+    if isinstance(node, ir.Backref):
+        return ir.Backref(capture_name(i, node.name))
+    if isinstance(node, ir.Subroutine):
+        return ir.Subroutine(capture_name(i, node.name))
+    if isinstance(node, ir.Conditional):
+        return ir.Conditional(capture_name(i, node.name), node.then, node.else_)
+    return node
+
+
+def scoped(flags):
+    # the flags among a Root's that may be scoped to an alternative, as (turn_ons, turn_offs),
+    # e.g. ('wi', '') for V1wi, ('', 'w') for V1-w
+    turn_ons, _, turn_offs = flags.partition('-')
+    for flag in GLOBAL_FLAGS:
+        turn_ons = turn_ons.replace(flag, '')
+    return turn_ons, turn_offs
+
+
+def flagset(turn_ons, turn_offs):
+    return turn_ons + '-' + turn_offs if turn_offs else turn_ons
+
+
+def global_flags(names, roots):
+    # the flags that apply to the whole regex, which must be the same for every pattern
+    flags = [''.join(flag for flag in GLOBAL_FLAGS if flag in root.flags.partition('-')[0]) for root in roots]
+    for name, root, own in zip(names, roots, flags):
+        if 'r' in own:
+            raise ValueError("Pattern '%s' is reversed, its matches can't be combined with others'" % name)
+        if own != flags[0]:
+            raise ValueError("Patterns '%s' and '%s' have different global flags: %s and %s" % (
+                names[0], name, flags[0] or '(none)', own or '(none)'))
+    return flags[0]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# The intermediate representation of a compiled regex: a tree of nodes, built by the parser
+# rules alongside the regex strings (it's Regex.node), which optimization passes (see passes.py)
+# can rewrite before emit() turns it back into a regex. Every node is immutable, a pass rebuilds
+# the parts of the tree it changes.
+
+from collections import namedtuple
+
+
+class Leaf(object):
+    __slots__ = ()
+    def map(self, fn):
+        return self
+
+
+class Literal(Leaf, namedtuple('Literal', 'text')): # a string, already escaped
+    __slots__ = ()
+
+class CharClass(Leaf, namedtuple('CharClass', 'text')): # a single-character matcher, e.g. [a-f], \d, \p{L}, .
+    __slots__ = ()
+
+class Anchor(Leaf, namedtuple('Anchor', 'text')): # zero-width, e.g. \b, ^, \A
+    __slots__ = ()
+
+class Raw(Leaf, namedtuple('Raw', 'text')): # anything else, e.g. \X
+    __slots__ = ()
+
+class Backref(Leaf, namedtuple('Backref', 'name')):
+    __slots__ = ()
+
+class Subroutine(Leaf, namedtuple('Subroutine', 'name')): # a call to a group still being defined
+    __slots__ = ()
+
+
+class Sequence(namedtuple('Sequence', 'items')):
+    __slots__ = ()
+    def map(self, fn):
+        return Sequence(tuple(map(fn, self.items)))
+
+class Alternation(namedtuple('Alternation', 'items')):
+    __slots__ = ()
+    def map(self, fn):
+        return Alternation(tuple(map(fn, self.items)))
+
+class Group(namedtuple('Group', 'opener body')): # opener is e.g. (?: (?> (?P<name> (?i:
+    __slots__ = ()
+    def map(self, fn):
+        return Group(self.opener, fn(self.body))
+
+    @property
+    def capture_name(self):
+        return self.opener[4:-1] if self.opener.startswith('(?P<') else None
+
+class Quantifier(namedtuple('Quantifier', 'body quantifier')): # body is an atom, grouped if needed
+    __slots__ = ()
+    def map(self, fn):
+        return Quantifier(fn(self.body), self.quantifier)
+
+class Lookaround(namedtuple('Lookaround', 'opener body')): # opener is one of (?= (?! (?<= (?<!
+    __slots__ = ()
+    openers = ('(?=', '(?!', '(?<=', '(?<!')
+    def map(self, fn):
+        return Lookaround(self.opener, fn(self.body))
+
+class Conditional(namedtuple('Conditional', 'name then else_')):
+    __slots__ = ()
+    def map(self, fn):
+        return Conditional(self.name, fn(self.then), fn(self.else_))
+
+class Root(namedtuple('Root', 'flags body')): # the global flags, e.g. V1w, and the expression
+    __slots__ = ()
+    def map(self, fn):
+        return Root(self.flags, fn(self.body))
+
+
+EMPTY = Literal('')
+
+
+def transform(node, fn):
+    # rebuilds the tree bottom-up, replacing each node with fn(node)
+    return fn(node.map(lambda child: transform(child, fn)))
+
+
+def walk(node):
+    # yields every node of the tree, parents before their children
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        children = []
+        node.map(children.append)
+        stack.extend(reversed(children))
+
+
+def emit(node):
+    return EMITTERS[node.__class__](node)
+
+
+def emit_conditional(node):
+    then, else_ = emit(node.then), emit(node.else_)
+    if else_:
+        return '(?(%s)%s|%s)' % (node.name, then, else_)
+    return '(?(%s)%s)' % (node.name, then)
+
+
+EMITTERS = {
+    Literal     : lambda node: node.text,
+    CharClass   : lambda node: node.text,
+    Anchor      : lambda node: node.text,
+    Raw         : lambda node: node.text,
+    Backref     : lambda node: '(?P=%s)' % node.name,
+    Subroutine  : lambda node: '(?&%s)' % node.name,
+    Sequence    : lambda node: ''.join(map(emit, node.items)),
+    Alternation : lambda node: '|'.join(map(emit, node.items)),
+    Group       : lambda node: node.opener + emit(node.body) + ')',
+    Quantifier  : lambda node: emit(node.body) + node.quantifier,
+    Lookaround  : lambda node: node.opener + emit(node.body) + ')',
+    Conditional : emit_conditional,
+    Root        : lambda node: '(?%s)%s' % (node.flags, emit(node.body)),
+}
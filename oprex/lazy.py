@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+import regex as regexlib
+
+
+class LazyRegex:
+    # compiles on first use, keeping regex compilation out of import time
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name):
+        attr = getattr(regexlib.compile(self.pattern, self.flags), name)
+        setattr(self, name, attr) # later lookups bypass __getattr__
+        return attr
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# The shortest and longest text a compiled regex's IR (see ir.py) may match, e.g. 10 and 10 for
+# /year/dash/month/dash/day/, 1 and UNBOUNDED for 1.. of digit. The bounds may be loose, never
+# too tight: what can't be told here (e.g. \X, a group calling itself) may match anything.
+
+import ir
+from backtracking import UNBOUNDED, max_repeats
+from passes import literal_units, min_repeats, scoped_flags
+
+
+FOLDED = 3 # under ignorecase, full case-folding may match a character to up to 3, e.g. ﬃ to ffi
+
+
+def match_lengths(root):
+    # (shortest, longest) of what root matches; the longest may be UNBOUNDED
+    return lengths(root, '', groups(root))
+
+
+def definition_lengths(root, definitions):
+    # (shortest, longest) of each definition's value, by name, from its (name, IR) pairs; a name
+    # defined in several scopes gets the bounds of all its values. A value is measured under the
+    # flags around each of its uses, e.g. (ignorecase) /x/ may match x's value case-folded; one
+    # not found in root (e.g. rewritten by an optimization pass) under every flags root has.
+    captures = groups(root)
+    uses = {} # id of a node -> the flags around it, at each of its uses
+    for node, flags in flagged(root):
+        uses.setdefault(id(node), set()).add(flags)
+    all_flags = set(flags for node_flags in uses.values() for flags in node_flags)
+    found = {}
+    for name, node in definitions:
+        for flags in uses.get(id(node), all_flags):
+            shortest, longest = lengths(node, flags, captures)
+            if name in found:
+                shortest, longest = min(shortest, found[name][0]), max(longest, found[name][1])
+            found[name] = shortest, longest
+    return found
+
+
+def variable_lookbehinds(root):
+    # the lookbehinds whose length isn't fixed, as regex text: the regex module takes them, most
+    # engines don't (e.g. re requires a fixed width)
+    captures = groups(root)
+    found = []
+    for node, flags in flagged(root):
+        if isinstance(node, ir.Lookaround) and node.opener.startswith('(?<'):
+            shortest, longest = lengths(node.body, flags, captures)
+            if shortest != longest:
+                found.append(ir.emit(node))
+    return tuple(found)
+
+
+def reach(root):
+    # How far past the start of a match, and before it, the engine may look to find it: the
+    # longest match counting what lookaheads look at, and the longest lookbehind; each plus one
+    # character, for the likes of \b and $ testing the one next to it.
+    captures = groups(root)
+    ahead = lengths(root, '', captures, lookaheads=True)[1] + 1
+    behind = max([lengths(node.body, flags, captures, lookaheads=True)[1]
+        for node, flags in flagged(root) if isinstance(node, ir.Lookaround) and node.opener.startswith('(?<')] or [0]) + 1
+    return behind, ahead
+
+
+def groups(root):
+    # the capture groups by name, with the flags in effect around them, for backreferences and
+    # subroutine calls to take their lengths
+    return dict((node.capture_name, (node, flags)) for node, flags in flagged(root)
+        if isinstance(node, ir.Group) and node.capture_name)
+
+
+def flagged(root):
+    # yields every node with the flags in effect around it, parents first
+    stack = [(root, '')]
+    while stack:
+        node, flags = stack.pop()
+        yield node, flags
+        flags = root.flags if node is root else scoped_flags(node, flags)
+        children = []
+        node.map(children.append)
+        stack.extend((child, flags) for child in reversed(children))
+
+
+def lengths(node, flags, captures, lookaheads=False, calling=()):
+    # calling: the groups being called, a call within them recurses
+    flags = scoped_flags(node, flags)
+    if isinstance(node, ir.Root):
+        return lengths(node.body, node.flags, captures, lookaheads, calling)
+    if isinstance(node, ir.Literal):
+        count = len(literal_units(node.text)) if node.text else 0
+        return folded(0 if 'x' in flags else count, count, flags) # under verbose, whitespace may be ignored
+    if isinstance(node, ir.CharClass):
+        return folded(1, 1, flags)
+    if isinstance(node, ir.Anchor):
+        return 0, 0
+    if isinstance(node, ir.Lookaround):
+        if lookaheads and not node.opener.startswith('(?<'): # looks at what follows, without matching it
+            return 0, lengths(node.body, flags, captures, lookaheads, calling)[1]
+        return 0, 0
+    if isinstance(node, ir.Group):
+        return lengths(node.body, flags, captures, lookaheads, calling)
+    if isinstance(node, ir.Quantifier):
+        shortest, longest = lengths(node.body, flags, captures, lookaheads, calling)
+        count = max_repeats(node.quantifier)
+        return shortest * min_repeats(node.quantifier), (longest * count if count and longest else 0)
+    if isinstance(node, ir.Sequence):
+        items = [lengths(item, flags, captures, lookaheads, calling) for item in node.items]
+        return sum(shortest for shortest, _ in items), sum(longest for _, longest in items)
+    if isinstance(node, (ir.Alternation, ir.Conditional)):
+        items = node.items if isinstance(node, ir.Alternation) else (node.then, node.else_)
+        items = [lengths(item, flags, captures, lookaheads, calling) for item in items]
+        return min(shortest for shortest, _ in items), max(longest for _, longest in items)
+    if isinstance(node, (ir.Backref, ir.Subroutine)):
+        if node.name not in captures or node.name in calling:
+            return 0, UNBOUNDED
+        group, group_flags = captures[node.name]
+        shortest, longest = lengths(group, group_flags, captures, lookaheads, calling + (node.name,))
+        if isinstance(node, ir.Backref): # matches the same text, but maybe case-folded
+            return folded(shortest, longest, flags)
+        return shortest, longest
+    if isinstance(node, ir.Raw) and node.text == r'\X': # a grapheme cluster
+        return 1, UNBOUNDED
+    return 0, UNBOUNDED
+
+
+def folded(shortest, longest, flags):
+    if 'i' in flags:
+        return -(-shortest // FOLDED), longest * FOLDED
+    return shortest, longest
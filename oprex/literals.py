@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# The literal strings every match of a compiled regex contains, found on its IR (see ir.py), so
+# text can be checked with str.find/in before running the regex engine on it (see prefilter.py).
+# E.g. for /'ERROR' digits ':'/ every match contains 'ERROR' and ':', and starts with 'ERROR'.
+# What can't be told here, e.g. case-insensitive scopes or backreferences, requires nothing.
+
+from collections import namedtuple
+import ir
+from passes import FIXED_QUANTIFIER_RE, literal_units, min_repeats, scoped_flags, single_chars
+
+
+# exact: the one string node matches, or None if it may match different ones
+# prefix, suffix: what every match of node starts/ends with, maybe empty
+# required: strings every match of node contains
+Info = namedtuple('Info', 'exact prefix suffix required')
+
+UNKNOWN = Info(None, u'', u'', frozenset())
+ZERO_WIDTH = Info(u'', u'', u'', frozenset())
+
+
+def required_literals(root):
+    # the literals every match contains, longest first, none of them within another
+    literals = set(literal for literal in info(root, '').required if literal)
+    literals = [literal for literal in literals if not any(
+        literal != other and literal in other for other in literals)]
+    return tuple(sorted(literals, key=lambda literal: (-len(literal), literal)))
+
+
+def literal_prefix(root):
+    # the literal every match starts with, maybe empty
+    return info(root, '').prefix
+
+
+def info(node, flags):
+    flags = scoped_flags(node, flags)
+    if isinstance(node, ir.Root):
+        return info(node.body, node.flags)
+    if isinstance(node, ir.Literal):
+        return exactly(literal_text(node.text, flags))
+    if isinstance(node, ir.CharClass):
+        return exactly(class_char(node.text, flags))
+    if isinstance(node, (ir.Anchor, ir.Lookaround)):
+        return ZERO_WIDTH
+    if isinstance(node, ir.Group):
+        return info(node.body, flags)
+    if isinstance(node, ir.Quantifier):
+        return repeated(info(node.body, flags), node.quantifier)
+    if isinstance(node, ir.Sequence):
+        return concatenated([info(item, flags) for item in node.items])
+    if isinstance(node, ir.Alternation):
+        return alternated([info(item, flags) for item in node.items])
+    if isinstance(node, ir.Conditional):
+        return alternated([info(node.then, flags), info(node.else_, flags)])
+    return UNKNOWN # backreferences, subroutine calls, \X
+
+
+def exactly(text):
+    if text is None:
+        return UNKNOWN
+    return Info(text, text, text, frozenset([text]))
+
+
+def literal_text(text, flags):
+    # the string a literal's regex text matches, None if not known
+    if 'i' in flags:
+        return None
+    chars = []
+    for unit in literal_units(text):
+        if len(unit) == 2 and not unit[1].isalnum(): # e.g. \.
+            unit = unit[1]
+        char = unit if len(unit) == 1 else class_char(unit, '')
+        if char is None or 'x' in flags and (char.isspace() or char == '#'): # maybe not escaped
+            return None
+        chars.append(char)
+    return u''.join(chars)
+
+
+def class_char(text, flags):
+    # the one character a single-character matcher matches, None if it may match several
+    chars = single_chars(text, flags)
+    if chars is None or len(chars.intervals) != 1:
+        return None
+    low, high = chars.intervals[0]
+    return unichr(low) if low == high else None
+
+
+def repeated(body, quantifier):
+    count = min_repeats(quantifier)
+    if count == 0:
+        return UNKNOWN
+    if body.exact is None:
+        return body._replace(required=body.required | set([body.prefix, body.suffix]))
+    text = body.exact * count
+    exact = text if FIXED_QUANTIFIER_RE.match(quantifier) else None
+    return Info(exact, text, text, frozenset([text]))
+
+
+def concatenated(items):
+    exact, prefix = u'', u''
+    required = set()
+    run = u'' # the literal being built, across exact items
+    for item in items:
+        required |= item.required
+        if item.exact is not None:
+            run += item.exact
+            if exact is not None:
+                exact += item.exact
+            continue
+        required.add(run + item.prefix)
+        if exact is not None:
+            prefix = exact + item.prefix
+            exact = None
+        run = item.suffix
+    required.add(run)
+    if exact is not None:
+        return exactly(exact)
+    return Info(None, prefix, run, frozenset(required))
+
+
+def alternated(items):
+    exacts = set(item.exact for item in items)
+    if len(exacts) == 1 and None not in exacts:
+        return exactly(exacts.pop())
+    prefix = common_prefix([item.prefix for item in items])
+    suffix = common_prefix([item.suffix[::-1] for item in items])[::-1]
+    required = frozenset.intersection(*[item.required for item in items]) | set([prefix, suffix])
+    return Info(None, prefix, suffix, required)
+
+
+def common_prefix(texts):
+    shortest = min(texts, key=len)
+    for i, char in enumerate(shortest):
+        if any(text[i] != char for text in texts):
+            return shortest[:i]
+    return shortest
@@ -1,18 +1,203 @@
 # -*- coding: utf-8 -*-
 
-import argparse, codecs, unicodedata, regex as regexlib
-from ply import lex, yacc
-from collections import namedtuple, deque
+import bisect, copy, hashlib, sys, threading, time, unicodedata, regex as regexlib
+from collections import namedtuple, deque, OrderedDict
+import backtracking, ir, passes
+from lazy import LazyRegex
+from lengths import definition_lengths, match_lengths, variable_lookbehinds
+from literals import literal_prefix, required_literals # not the module itself, ply's lexer reads a `literals` global
+from prefilter import Prefilter
+from starts import StartScanner, start_chars
+from stream import StreamMatch, StreamMatcher
 
 
-def oprex(source_code):
+VERSION = '0.1.1'
+
+
+def oprex(source_code, optimize=False, strict=False, parser=None):
+    # optimize: True, or the names of the optimization passes to run (see passes.py)
+    # strict: raise OprexBacktrackingError rather than return a regex with backtracking_risks()
+    # parser: 'lalr' or 'descent' (see OprexCompiler), rather than the thread's compiler's; both
+    # give the same results, so they share the cache
     source_lines = sanitize(source_code)
-    lexer = build_lexer(source_lines)
-    result = parse(lexer=lexer)
-    cleanup(lexer=lexer)
+    pipeline = passes.pipeline(optimize)
+    key = CompileCache.key(source_lines, *pipeline)
+    result = compile_cache.get(key)
+    if result is None:
+        result = thread_compiler(parser).compile_lines(source_lines, pipeline, strict)
+        compile_cache.put(key, result)
+    if strict:
+        check_backtracking(source_lines, result)
     return result
 
 
+def compile(source_code, optimize=False, strict=False, prefilter=False, **opts):
+    # like oprex() followed by regex.compile(), with both steps cached under a single key
+    # prefilter: return the Pattern wrapped in a Prefilter, checking text for the literals every
+    # match contains, and its length, before running the regex on it
+    source_lines = sanitize(source_code)
+    key = CompileCache.key(source_lines, *(passes.pipeline(optimize) + tuple(sorted(opts.items()))))
+    pattern = pattern_cache.get(key)
+    if pattern is None:
+        pattern = regexlib.compile(oprex(source_code, optimize, strict), **opts)
+        pattern_cache.put(key, pattern)
+    elif strict:
+        check_backtracking(source_lines)
+    if prefilter:
+        result = oprex(source_code, optimize)
+        return Prefilter(pattern, result.required_literals, result.literal_prefix, result.match_lengths[0])
+    return pattern
+
+
+def start_scanner(source_code, optimize=False, numpy=False, **opts):
+    # compile() for scanning byte buffers, entering the engine only where a match may start
+    return StartScanner(compile(source_code, optimize, **opts), oprex(source_code, optimize).start_chars, numpy)
+
+
+def stream_matcher(source_code, optimize=False, **opts):
+    # compile() for finding matches in a file, or in chunks of text, as they're read (see stream.py)
+    return StreamMatcher(compile(source_code, optimize, **opts), oprex(source_code, optimize).node)
+
+
+def backtracking_risks(source_code):
+    # the parts of the source whose regex may backtrack catastrophically, see backtracking.py
+    return lines_backtracking_risks(sanitize(source_code))
+
+
+def lines_backtracking_risks(source_lines):
+    key = CompileCache.key(source_lines)
+    risks = risk_cache.get(key)
+    if risks is None:
+        risks = tuple(thread_compiler().backtracking_risks(source_lines))
+        risk_cache.put(key, risks)
+    return risks
+
+
+def check_backtracking(source_lines, result=None):
+    # result: the source's, whose risks were found as it was compiled if that was in strict mode
+    risks = result.metadata.get('backtracking_risks') if result is not None else None
+    if risks is None:
+        risks = lines_backtracking_risks(source_lines)
+    else:
+        risk_cache.put(CompileCache.key(source_lines), risks)
+    if risks:
+        raise OprexBacktrackingError(risks)
+
+
+class OprexResult(unicode):
+    # The emitted regex, plus metadata about it. What's found by analyzing the IR the regex was
+    # emitted from (node) is computed on first use, unless given in metadata (e.g. by PatternStore).
+    # definitions: (name, IR) of each definition's value, as parsed.
+    __slots__ = ('capture_names', 'node', 'definitions', 'metadata')
+    def __new__(cls, regex, capture_names, node=None, definitions=(), **metadata):
+        result = unicode.__new__(cls, regex)
+        result.capture_names = tuple(sorted(capture_names))
+        result.node = node
+        result.definitions = tuple(definitions)
+        result.metadata = metadata
+        return result
+
+    def analyzed(self, name, analysis):
+        try:
+            return self.metadata[name]
+        except KeyError:
+            node = self.node if self.node is not None else ir.Raw(self) # not known, nothing is found
+            value = self.metadata[name] = analysis(node)
+            return value
+
+    @property
+    def required_literals(self): # strings every match contains, for prefiltering text (see literals.py)
+        return tuple(self.analyzed('required_literals', required_literals))
+
+    @property
+    def literal_prefix(self): # what every match starts with
+        return self.analyzed('literal_prefix', literal_prefix)
+
+    @property
+    def start_chars(self): # the CharSet of what every match starts with, None if not known (see starts.py)
+        return self.analyzed('start_chars', start_chars)
+
+    @property
+    def match_lengths(self): # (shortest, longest) of a match, the longest maybe inf (see lengths.py)
+        return tuple(self.analyzed('match_lengths', match_lengths))
+
+    @property
+    def definition_lengths(self): # match_lengths of each definition, by name
+        lengths = self.analyzed('definition_lengths', lambda node: definition_lengths(node, self.definitions))
+        return dict((name, tuple(bounds)) for name, bounds in lengths.iteritems())
+
+    @property
+    def variable_lookbehinds(self): # those other engines than regex may reject
+        return tuple(self.analyzed('variable_lookbehinds', variable_lookbehinds))
+
+    @property
+    def flags(self):
+        return self[2:self.index(')')] # the output always starts with the global (?flags)
+
+
+class CompileCache:
+    # Bounded LRU of compile results, keyed by a fingerprint of the sanitized source. Bounded in
+    # entries (maxsize), and in the total size of the results (maxchars, by size(), e.g. a regex's
+    # length): a few huge patterns can't grow it without limit either. A result bigger than
+    # maxchars on its own isn't kept at all. maxchars=None bounds the entries only.
+    # Only what size() counts is bounded: for an OprexResult, the regex string -- the IR, the
+    # definitions and the metadata kept with it aren't counted, though they grow with it.
+    def __init__(self, maxsize, maxchars=None, size=len):
+        self.maxsize = maxsize
+        self.maxchars = maxchars
+        self.size = size
+        self.chars = 0 # the total size of the results kept
+        self.entries = OrderedDict() # key -> (result, its size)
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def key(source_lines, *options):
+        source = '\n'.join(source_lines)
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        fingerprint = hashlib.sha1(source)
+        for part in (VERSION, DEFAULT_FLAGS) + options:
+            fingerprint.update('\0' + str(part))
+        return fingerprint.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries[key] = entry # re-insert as the most recently used
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        if self.maxsize <= 0:
+            return
+        size = self.size(result) if self.maxchars is not None else 0
+        if self.maxchars is not None and size > self.maxchars:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.chars -= previous[1]
+            self.entries[key] = result, size
+            self.chars += size
+            while len(self.entries) > self.maxsize or self.maxchars is not None and self.chars > self.maxchars:
+                self.chars -= self.entries.popitem(last=False)[1][1] # the least recently used
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.chars = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class OprexError(Exception):
     def __init__(self, lineno, msg):
         msg = msg.replace('\t', ' ')
@@ -23,6 +208,11 @@ class OprexError(Exception):
 class OprexSyntaxError(OprexError): pass
 class OprexInternalError(OprexError): pass
 
+class OprexBacktrackingError(OprexError): # raised in strict mode, see backtracking_risks()
+    def __init__(self, risks):
+        self.risks = risks
+        OprexError.__init__(self, None, '\n'.join(map(backtracking.describe, risks)))
+
 
 def sanitize(source_code):
     # oprex requires the source code to have leading and trailing blank lines to make
@@ -113,7 +303,7 @@ t_SLASH      = r'\/'
 t_ignore = '' # oprex is whitespace-significant, no ignored characters
 
 
-ESCAPE_SEQUENCE_RE = regexlib.compile(r'''\\
+ESCAPE_SEQUENCE_RE = LazyRegex(r'''\\
     ( .
     | N\{[^}]++\} # Unicode character name
     | U\d{8}      # 8-digit hex escapes
@@ -123,7 +313,7 @@ ESCAPE_SEQUENCE_RE = regexlib.compile(r'''\\
     )''', regexlib.VERBOSE)
 
 
-OVERESCAPED_RE = regexlib.compile(r'''\\\\
+OVERESCAPED_RE = LazyRegex(r'''\\\\
     ( \\\\          # Escaped backslash
     | ['"abfnrtv]   # Single-character escapes
     | N\\\{[^}]++\} # Unicode character name
@@ -176,14 +366,50 @@ class Block(namedtuple('Block', 'variables starting_lineno')):
 
 
 class Scope(dict):
+    # A scope holds only its own definitions and links to its parent rather than copying it,
+    # so creating one is O(1). Lookups walk up the chain, the nearest definition wins.
+    # The chain also shares the set of names visible from its innermost scope, so misses --
+    # e.g. the redefinition check of every new variable -- are answered without walking it.
     types = ('ROOTSCOPE', 'BLOCKSCOPE', 'FLAGSCOPE')
     ROOTSCOPE, BLOCKSCOPE, FLAGSCOPE = range(3)
-    __slots__ = ('starting_lineno', 'type')
+    __slots__ = ('starting_lineno', 'type', 'parent', 'visible_names')
     def __init__(self, type, starting_lineno, parent_scope):
         self.starting_lineno = starting_lineno
         self.type = type
-        if parent_scope:
-            self.update(parent_scope)
+        self.parent = parent_scope
+        if parent_scope is None:
+            self.visible_names = set()
+        elif type == Scope.ROOTSCOPE: # on top of a compiler's shared builtins, which must not see the source's names
+            self.visible_names = set(parent_scope.visible_names)
+        else:
+            self.visible_names = parent_scope.visible_names
+
+    def __setitem__(self, varname, var):
+        if varname not in self: # shadowing (i.e. flags redefining builtins) does not add a name
+            self.visible_names.add(varname)
+        dict.__setitem__(self, varname, var)
+
+    def update(self, **variables):
+        for varname, var in variables.iteritems():
+            self[varname] = var
+
+    def __missing__(self, varname): # called by dict.__getitem__ when not defined in this scope itself
+        if varname in self.visible_names:
+            scope = self.parent
+            while scope is not None:
+                if dict.__contains__(scope, varname):
+                    return dict.__getitem__(scope, varname)
+                scope = scope.parent
+        raise KeyError(varname)
+
+    def __contains__(self, varname):
+        return varname in self.visible_names
+
+    def close(self):
+        # called once the scope's block ends; variables can't be redefined while visible, so
+        # every name defined here was introduced here
+        for varname in self:
+            self.visible_names.remove(varname)
 
 
 class Flagset(unicode):
@@ -231,30 +457,56 @@ class Expr:
 
 
 class Regex(unicode):
-    __slots__ = ('base_value', 'grouped', 'quantifier')
+    __slots__ = ('base_value', 'grouped', 'quantifier', 'node') # node: the same regex, as IR (see ir.py)
     def __new__(cls, base_value, modifier=None): # modifier can be one of: quantifier, scoped flags, or grouping
         value = base_value
         grouped = False
         quantifier = None
+        node = ir_node(base_value)
         if modifier:
             if modifier.startswith('(?'): # scoped flags/grouping -- without the closing paren
                 value = modifier + base_value + ')' # add the closing paren
                 grouped = True
+                if modifier in ir.Lookaround.openers:
+                    node = ir.Lookaround(modifier, node)
+                else:
+                    node = ir.Group(modifier, node)
             else: # modifier is quantifier
                 quantifier = modifier
                 value += quantifier
+                node = ir.Quantifier(node, quantifier)
         expr = unicode.__new__(cls, value)
         expr.base_value = base_value
         expr.grouped = grouped
         expr.quantifier = quantifier
+        expr.node = node
         return expr
 
 
+def ir_node(regex):
+    try:
+        return regex.node
+    except AttributeError: # a plain string
+        return ir.Raw(regex) if regex else ir.EMPTY
+
+
+def with_node(regex, node):
+    regex.node = node
+    return regex
+
+
+def concat(regexes):
+    return with_node(Regex(''.join(regexes)), ir.Sequence(tuple(map(ir_node, regexes))))
+
+
 class Alternation(Regex):
     __slots__ = ('grouping_unnecessary',)
     def __new__(cls, subexpressions, is_atomic):
         alternation = Regex.__new__(cls, '|'.join(subexpressions), modifier='(?>' if is_atomic else None)
         alternation.grouping_unnecessary = is_atomic or len(subexpressions) == 1
+        alternation.node = ir.Alternation(tuple(map(ir_node, subexpressions)))
+        if is_atomic:
+            alternation.node = ir.Group('(?>', alternation.node)
         return alternation
 
 
@@ -294,6 +546,7 @@ class CharClass(Regex):
         }.get(value, value)
         charclass = Regex.__new__(cls, value)
         charclass.is_set_op = is_set_op
+        charclass.node = ir.CharClass(value)
         return charclass
     
     def negated(self):
@@ -319,85 +572,119 @@ class CCItem(namedtuple('CCItem', 'source type value')):
 
     @staticmethod
     def token(t, type, value):
-        source = t.value
-        if type not in ('include', 'op'): # testing these types requires parser context
-            try:
-                regexlib.compile('[' + value + ']')
-            except regexlib.error as e:
-                raise OprexSyntaxError(t.lineno, 
-                    '%s compiles to %s which is rejected by the regex engine with error message: %s' % (source, value, e.message))
         t.type = 'CHAR'
-        t.value = CCItem(source, type, value)
+        t.value = CCItem(t.value, type, value)
+        if not t.lexer.defer_checks:
+            check_charitems([t.value], t.lineno)
         return t
 
 
-Builtin   = lambda name, value, modifier=None: Variable(name, Regex(value, modifier), lineno=0)
+def check_charitems(items, lineno):
+    # Checks charclass items with the regex engine. With lexer.defer_checks, those of a whole
+    # charclass line are checked together in one compile, rather than one each as they're lexed.
+    # The engine's error offset then tells which item it rejected, that one is compiled on its
+    # own for the exact error message.
+    checked = [item for item in items if item.type not in ('include', 'op')] # these need parser context
+    sets = ['[%s]' % item.value for item in checked]
+    try:
+        regexlib.compile(''.join(sets))
+    except regexlib.error as e:
+        candidates = checked
+        if e.pos is not None:
+            set_starts = []
+            offset = 0
+            for set in sets:
+                set_starts.append(offset)
+                offset += len(set)
+            candidates = [checked[bisect.bisect_right(set_starts, e.pos) - 1]] + checked
+        for item in candidates:
+            try:
+                regexlib.compile('[%s]' % item.value)
+            except regexlib.error as e:
+                compiled = '[%s]' % item.value if item.type == 'range' else item.value
+                raise OprexSyntaxError(lineno,
+                    '%s compiles to %s which is rejected by the regex engine with error message: %s' % (item.source, compiled, e.message))
+
+
+def builtin_atom(value):
+    if value in ('.', r'\X'):
+        node = ir.CharClass(value) if value == '.' else ir.Raw(value)
+    else: # the rest are anchors, or empty
+        node = ir.Anchor(value) if value else ir.EMPTY
+    return with_node(Regex(value), node)
+
+
+Builtin   = lambda name, value, modifier=None: Variable(name, Regex(builtin_atom(value), modifier), lineno=0)
 BuiltinCC = lambda name, value:                Variable(name, CharClass(value, is_set_op=False), lineno=0)
-BUILTINS  = [
-    BuiltinCC('alpha',         r'[a-zA-Z]'),
-    BuiltinCC('upper',         r'[A-Z]'),
-    BuiltinCC('lower',         r'[a-z]'),
-    BuiltinCC('alnum',         r'[a-zA-Z0-9]'),
-    BuiltinCC('padchar',       r'[ \t]'),
-    BuiltinCC('backslash',     r'\\'),
-    BuiltinCC('tab',           r'\t'),
-    BuiltinCC('digit',         r'\d'),
-    BuiltinCC('whitechar',     r'\s'),
-    BuiltinCC('wordchar',      r'\w'),
-    Builtin('BOW',             r'\m'),
-    Builtin('EOW',             r'\M'),
-    Builtin('WOB',             r'\b'),
-    Builtin('non-WOB',         r'\B'),
-    Builtin('BOS',             r'\A'),
-    Builtin('EOS',             r'\Z'),
-    Builtin('uany',            r'\X'),
-    Builtin('FAIL!',           r'', modifier='(?!'),
-]
-FLAG_DEPENDENT_BUILTINS = dict(
-    m = { # MULTILINE
-        True  : [
-            Builtin('BOL', '^'),
-            Builtin('EOL', '$'),
-        ],
-        False : [
-            Builtin('BOL', '^', modifier='(?m:'),
-            Builtin('EOL', '$', modifier='(?m:'),
-        ],
-    },
-    s = { # DOTALL
-        True  : [
-            Builtin('any',          '.'),
-            Builtin('non-linechar', '.', modifier='(?-s:'),
-        ],
-        False : [
-            Builtin('any',          '.', modifier='(?s:'),
-            Builtin('non-linechar', '.'),
-        ],
-    },
-    w = { # WORD
-        True  : [
-            BuiltinCC('linechar', r'[\r\n\x0B\x0C]'),
-        ],
-        False : [
-            BuiltinCC('linechar', r'\n'),
-        ],
-    },
-    x = { # VERBOSE
-        True  : [
-            BuiltinCC('space',  '[ ]'),
-        ],
-        False : [
-            BuiltinCC('space',  ' '),
-        ],
-    },
-)
+BUILTINS  = []                # both are populated by define_builtins(),
+FLAG_DEPENDENT_BUILTINS = {}  # on first use rather than at import time
 DEFAULT_FLAGS = 'w'
-for flag in FLAG_DEPENDENT_BUILTINS:
-    for var in FLAG_DEPENDENT_BUILTINS[flag][flag in DEFAULT_FLAGS]:
-        BUILTINS.append(var)
 
-def flags_redef_builtins(flags, flag_dependent_builtins, scope):
+def define_builtins():
+    BUILTINS[:] = [
+        BuiltinCC('alpha',         r'[a-zA-Z]'),
+        BuiltinCC('upper',         r'[A-Z]'),
+        BuiltinCC('lower',         r'[a-z]'),
+        BuiltinCC('alnum',         r'[a-zA-Z0-9]'),
+        BuiltinCC('padchar',       r'[ \t]'),
+        BuiltinCC('backslash',     r'\\'),
+        BuiltinCC('tab',           r'\t'),
+        BuiltinCC('digit',         r'\d'),
+        BuiltinCC('whitechar',     r'\s'),
+        BuiltinCC('wordchar',      r'\w'),
+        Builtin('BOW',             r'\m'),
+        Builtin('EOW',             r'\M'),
+        Builtin('WOB',             r'\b'),
+        Builtin('non-WOB',         r'\B'),
+        Builtin('BOS',             r'\A'),
+        Builtin('EOS',             r'\Z'),
+        Builtin('uany',            r'\X'),
+        Builtin('FAIL!',           r'', modifier='(?!'),
+    ]
+    FLAG_DEPENDENT_BUILTINS.update(
+        m = { # MULTILINE
+            True  : [
+                Builtin('BOL', '^'),
+                Builtin('EOL', '$'),
+            ],
+            False : [
+                Builtin('BOL', '^', modifier='(?m:'),
+                Builtin('EOL', '$', modifier='(?m:'),
+            ],
+        },
+        s = { # DOTALL
+            True  : [
+                Builtin('any',          '.'),
+                Builtin('non-linechar', '.', modifier='(?-s:'),
+            ],
+            False : [
+                Builtin('any',          '.', modifier='(?s:'),
+                Builtin('non-linechar', '.'),
+            ],
+        },
+        w = { # WORD
+            True  : [
+                BuiltinCC('linechar', r'[\r\n\x0B\x0C]'),
+            ],
+            False : [
+                BuiltinCC('linechar', r'\n'),
+            ],
+        },
+        x = { # VERBOSE
+            True  : [
+                BuiltinCC('space',  '[ ]'),
+            ],
+            False : [
+                BuiltinCC('space',  ' '),
+            ],
+        },
+    )
     for flag in FLAG_DEPENDENT_BUILTINS:
+        for var in FLAG_DEPENDENT_BUILTINS[flag][flag in DEFAULT_FLAGS]:
+            BUILTINS.append(var)
+
+def flags_redef_builtins(flags, flag_dependent_builtins, scope):
+    for flag in flag_dependent_builtins:
         if flag in flags:
             for var in flag_dependent_builtins[flag][flag in flags.turn_ons]:
                 scope[var.name] = var
@@ -482,18 +769,19 @@ def t_FLAGSET(t):
             raise OprexSyntaxError(t.lineno, "Unknown flag '%s'. Supported flags are: %s" % (flag, ' '.join(sorted(Flagset.all_flags.keys()))))
 
     flags = Flagset(turn_ons, turn_offs)
-    try:
-        test = '(?%s)' % flags
-        if 'V' in flags:
-            regexlib.compile(test)
-        else:
-            regexlib.compile('(?V1)' + test)
-    except Exception as e:
-        raise OprexSyntaxError(t.lineno, '%s compiles to %s which is rejected by the regex engine with error message: %s' % 
-            (t.value, test, str(e.message)))
-    else:
-        t.type = 'LPAREN'
-        t.extra_tokens = [ExtraToken(t, 'FLAGSET', value=flags), ExtraToken(t, 'RPAREN')]
+    if flags not in t.lexer.checked_flagsets: # a flagset is the same whatever the source, check it just once
+        try:
+            test = '(?%s)' % flags
+            if 'V' in flags:
+                regexlib.compile(test)
+            else:
+                regexlib.compile('(?V1)' + test)
+        except Exception as e:
+            raise OprexSyntaxError(t.lineno, '%s compiles to %s which is rejected by the regex engine with error message: %s' % 
+                (t.value, test, str(e.message)))
+        t.lexer.checked_flagsets.add(flags)
+    t.type = 'LPAREN'
+    t.extra_tokens = [ExtraToken(t, 'FLAGSET', value=flags), ExtraToken(t, 'RPAREN')]
     return t
 
 
@@ -572,6 +860,7 @@ def t_INITIAL_ORBLOCK_OF(t):
     return t
 
 
+# Scanner.scan_whitespace() does the same for the Scanner, keep the two in sync
 def t_ANY_comments_whitespace(t):
     r'''(?mx)
     (
@@ -717,7 +1006,7 @@ def p_oprex(t):
     if 'V' not in flags: # use V1 by default
         flags = 'V1' + flags # put at the front so it can easily be trimmed-out if unwanted
 
-    t[0] = '(?%s)%s' % (flags, expression)
+    t[0] = with_node(Regex('(?%s)%s' % (flags, expression)), ir.Root(flags, ir_node(expression)))
 
 
 def p_root_expression(t):
@@ -750,7 +1039,7 @@ def p_global_flags(t):
             alnum    = Variable('alnum',    CharClass(r'\p{Alphanumeric}',               is_set_op=False), lineno=0),
             linechar = Variable('linechar', CharClass(r'[\r\n\x0B\x0C\x85\u2028\u2029]', is_set_op=False), lineno=0),
         )
-        t.lexer.flag_dependent_builtins = FLAG_DEPENDENT_BUILTINS.copy()
+        t.lexer.flag_dependent_builtins = t.lexer.flag_dependent_builtins.copy()
         t.lexer.flag_dependent_builtins['w'] = t.lexer.flag_dependent_builtins['w'].copy()
         t.lexer.flag_dependent_builtins['w'][True] = [
             root_scope['linechar']
@@ -792,22 +1081,26 @@ def p_expr(t):
 class StringExpr(Expr):
     def apply(self, scope):
         references = []
-        return Regex(self.value), references
+        return with_node(Regex(self.value), self.node), references
 
 def p_string_expr(t):
     '''string_expr :       STRING       NEWLINE
                    |       STRING str_b NEWLINE
                    | str_b STRING       NEWLINE
                    | str_b STRING str_b NEWLINE'''
-    t[0] = StringExpr(value=''.join(t[1:-1]))
+    nodes = [part if isinstance(part, ir.Anchor) else ir.Literal(part) for part in t[1:-1]]
+    t[0] = StringExpr(
+        value = ''.join(node.text for node in nodes),
+        node = nodes[0] if len(nodes) == 1 else ir.Sequence(tuple(nodes)),
+    )
 
 def p_str_b(t):
     '''str_b : DOT
              | UNDERSCORE'''
-    t[0] = {
+    t[0] = ir.Anchor({
         '.'  : '\\b',
         '_'  : '\\B',
-    }[t[1]]
+    }[t[1]])
 
 
 class QuantifiedExpr(Expr):
@@ -926,7 +1219,7 @@ def quantify(expr, quantifier):
         if unneeded:
             return expr # unchanged
         else:
-            return '(?:%s)' % expr
+            return Regex(expr, modifier='(?:')
 
     try:
         return Regex(strip_old_quantifier(), modifier=merge_quantifiers())
@@ -1016,7 +1309,7 @@ def p_oritem(t):
               | or expr
               | or NEWLINE''' # --> allow the alternation to match empty string
     t_last = t[len(t)-1]
-    expr = t_last if isinstance(t_last, Expr) else StringExpr(value='')
+    expr = t_last if isinstance(t_last, Expr) else StringExpr(value='', node=ir.EMPTY)
     if len(t) > 3:
         t[0] = ConditionalExpr(condition=t[2], then_expr=expr)
     else:
@@ -1033,7 +1326,8 @@ class ConditionalExpr(Expr):
         value = '(%s)%s' % (self.condition.varname, then_regex)
         if else_regex:
             value += '|' + else_regex
-        return Regex(value, modifier='(?'), refs
+        node = ir.Conditional(self.condition.varname, ir_node(then_regex), ir_node(else_regex))
+        return with_node(Regex(value, modifier='(?'), node), refs
 
 
 def p_condition(t):
@@ -1059,7 +1353,7 @@ class LookaroundExpr(Expr):
             subexpressions.append(Regex(expression, modifier=lookitem.type))
             references.extend(refs)
 
-        regex = Regex(''.join(subexpressions))
+        regex = concat(subexpressions)
         return regex, references
 
 
@@ -1136,6 +1430,12 @@ def p_lookitem(t):
         t[0] = '', lookup_expr
 
 
+def ref_regex(node, optional):
+    # a backreference or subroutine call, optionally with the ? quantifier
+    regex = Regex(ir.emit(node) + optional)
+    return with_node(regex, ir.Quantifier(node, optional) if optional else node)
+
+
 class LookupExpr(Expr):
     def apply(self, scope):
         is_single_lookup = len(self.items) == 1
@@ -1146,7 +1446,7 @@ class LookupExpr(Expr):
                     return scope[lookup.varname].value
                 elif lookup.varname in self.ongoing_declarations:
                     self.ongoing_declarations[lookup.varname].capture = True
-                    return Regex('(?&%s)%s' % (lookup.varname, lookup.optional)) 
+                    return ref_regex(ir.Subroutine(lookup.varname), lookup.optional)
                 else:
                     raise OprexSyntaxError(lookup.lineno, "'%s' is not defined" % lookup.varname)
 
@@ -1161,7 +1461,7 @@ class LookupExpr(Expr):
                     raise OprexSyntaxError(lookup.lineno, "'non-%s': '%s' is not a character-class" % (lookup.varname, lookup.varname))
 
             if isinstance(lookup, Backreference): 
-                return Regex('(?P=%s)%s' % (lookup.varname, lookup.optional))
+                return ref_regex(ir.Backref(lookup.varname), lookup.optional)
             elif isinstance(lookup, NegatedLookup):
                 value = negated_lookup()
             elif isinstance(lookup, VariableLookup):
@@ -1177,7 +1477,7 @@ class LookupExpr(Expr):
         if is_single_lookup:
             regex = resolve(self.items[0])
         else:
-            regex = Regex(''.join(map(resolve, self.items)))
+            regex = concat(map(resolve, self.items))
         if self.atomize:
             regex = Regex(regex, modifier='(?>')
         return regex, self.items
@@ -1353,6 +1653,8 @@ class CharClassExpr(Expr):
 
 def p_charclass(t):
     '''charclass : charitems NEWLINE'''
+    if t.lexer.defer_checks:
+        check_charitems(t[1], lineno=t.lineno(2))
     t[0] = CharClassExpr(items=t[1], lineno=t.lineno(1))
 
 
@@ -1383,13 +1685,10 @@ def p_ranged_char(t):
     for type in (L_type, R_type):
         if type in ('include', 'prop'):
             raise OprexSyntaxError(t.lineno(0), 'Invalid character range: ' + source)
-    try:
-        regexlib.compile('[%s]' % value)
-    except regexlib.error as e:
-        raise OprexSyntaxError(t.lineno(0), 
-            '%s compiles to [%s] which is rejected by the regex engine with error message: %s' % (source, value, e.message))
 
     t[0] = CCItem(source, 'range', value)
+    if not t.lexer.defer_checks:
+        check_charitems([t[0]], t.lineno(0))
 
 
 def p_period_char(t):
@@ -1408,7 +1707,7 @@ def p_optional_subblock(t):
     if len(t) > 1:
         t[0] = Block(
             variables = t[2],
-            starting_lineno = t.lineno(0),
+            starting_lineno = t.lexer.scopes[-1].starting_lineno, # the scope begun by begin_subblock
         )
 
 
@@ -1428,13 +1727,18 @@ def optional_subblock_cleanup(lexer, subblock, reffed_varnames):
         lexer.end_a_scope(Scope.BLOCKSCOPE, at=subblock.starting_lineno)
 
 
+Definitions = deque
+
+
 def p_definitions(t):
     '''definitions : definition
                    | definition definitions'''
     try:
-        t[0] = t[1] + t[2]
+        definitions = t[2]
     except IndexError:
-        t[0] = t[1]
+        definitions = Definitions()
+    definitions.extendleft(reversed(t[1])) # rather than list concatenation, quadratic on long lists
+    t[0] = definitions
 
 
 def p_definition(t):
@@ -1442,10 +1746,10 @@ def p_definition(t):
                   | GLOBALMARK assignment'''
     if t[1] == GLOBALMARK:
         assignment = t[2]
-        scopes = t.lexer.scopes # global variable, define in all scopes
+        scope = t.lexer.scopes[0] # global variable, define in the root scope, visible from every scope
     else:
         assignment = t[1]
-        scopes = t.lexer.scopes[-1:] # non-global, define in the deepest (current) scope only
+        scope = t.lexer.scopes[-1] # non-global, define in the deepest (current) scope only
 
     def variable_from(declaration):
         def make_var():
@@ -1457,17 +1761,17 @@ def p_definition(t):
             return Variable(varname, value, assignment.lineno)
 
         var = make_var()
-        try: # check the deepest scope for varname (every scope supersets its parent, so checking only the deepeset is sufficient)
-            prev_def = scopes[-1][var.name]
-        except KeyError: # not already defined, OK to define it
-            for scope in scopes:
-                scope[var.name] = var
+        current_scope = t.lexer.scopes[-1] # sees the definitions of all its parents too
+        if var.name not in current_scope: # not already defined, OK to define it
+            scope[var.name] = var
         else: # already defined
+            prev_def = current_scope[var.name]
             raise OprexSyntaxError(t.lineno(1),
                 "'%s' is a non-redefinable built-in variable" % var.name
                 if prev_def.is_builtin() else
                     "Names must be unique within a scope, '%s' is already defined (previous definition at line %d)"
                         % (var.name, prev_def.lineno))
+        t.lexer.definitions.append(var)
         return var
 
     list_of_variables = map(variable_from, assignment.declarations)
@@ -1479,7 +1783,7 @@ def p_assignment(t):
                   | declaration equals expression
                   | declaration COLON  charclass  optional_subblock'''
     declaration = t[1]
-    lineno = t.lineno(1)
+    lineno = declaration.lineno # not t.lineno(1), nonterminals have no position when untracked
     del t.lexer.ongoing_declarations[declaration.varname]
     if isinstance(t[3], Assignment):
         assignment = t[3]
@@ -1510,7 +1814,7 @@ def p_declaration(t):
     try:
         ongoing = t.lexer.ongoing_declarations[varname]
     except KeyError: # no parent declaration with the same name, safe to declare
-        declaration = VariableDeclaration(varname, t.lineno(0), capture)
+        declaration = VariableDeclaration(varname, t.lineno(1), capture)
         t.lexer.ongoing_declarations[varname] = declaration
         t[0] = declaration
     else:
@@ -1537,33 +1841,104 @@ def p_error(t):
 
 
 def find_column(t, index=None):
-    lexpos = t.lexpos(index) if index else t.lexpos
-    last_newline = t.lexer.lexdata.rfind('\n', 0, lexpos)
-    if last_newline < 0:
-        last_newline = 0
-    return lexpos - last_newline
-
+    if index:
+        lexpos, lineno = t.lexpos(index), t.lineno(index)
+    else:
+        lexpos, lineno = t.lexpos, t.lineno
+    return t.lexer.positions.column(lexpos, lineno)
+
+
+class SourcePositions:
+    # Where each line of a source starts, found once so that line and column lookups are a
+    # bisect rather than a scan for the previous newline.
+    def __init__(self, data):
+        self.line_starts = line_starts = [0]
+        newline = data.find('\n')
+        while newline >= 0:
+            line_starts.append(newline + 1)
+            newline = data.find('\n', newline + 1)
+
+    def lineno(self, lexpos):
+        return bisect.bisect_right(self.line_starts, lexpos)
+
+    def column(self, lexpos, lineno=None):
+        # lineno, if known (e.g. a token's), saves the bisect -- when lexpos is on that line: a
+        # token's lineno is that of its first line, so after one spanning several (e.g. an
+        # unclosed string) it lags behind
+        line_starts = self.line_starts
+        if not (0 < lineno <= len(line_starts) and line_starts[lineno - 1] <= lexpos
+                and (lineno == len(line_starts) or lexpos < line_starts[lineno])):
+            lineno = self.lineno(lexpos)
+        if lineno == 1: # the first line is counted from 0, not 1 -- it's always empty anyway
+            return lexpos
+        return lexpos - line_starts[lineno - 1] + 1
+
+
+lexer0 = parser = None # built on first use, by init_ply_lexer() and init() respectively
+init_lock = threading.Lock()
+
+def init():
+    # Builds the scanner rules, the parser and the builtins. The parser tables are read from
+    # the packaged parsetab and never written back, so read-only installs work and no
+    # parser.out debug file is produced.
+    global parser
+    with init_lock:
+        if parser is None:
+            from ply import yacc
+            import parsetab
+            define_builtins()
+            Scanner.compile_rules()
+            parser = yacc.yacc(module=sys.modules[__name__], tabmodule=parsetab, write_tables=False, debug=False)
+
+
+def init_ply_lexer():
+    # the ply lexer is only built for OprexCompiler(lexer='ply')
+    global lexer0
+    with init_lock:
+        if lexer0 is None:
+            from ply import lex
+            lexer0 = lex.lex(module=sys.modules[__name__])
+
+
+def lalr_parser():
+    if parser is None:
+        init()
+    return parser
+
+
+def grammar_version():
+    import parsetab
+    return parsetab._lr_signature.encode('hex')
+
+
+class BaseLexer:
+    # the mode and scope bookkeeping the t_* and p_* rules do through t.lexer
+    def start_mode(self, mode):
+        self.mode = mode
+        self.modes.append(mode)
 
-lexer0 = lex.lex()
-def build_lexer(source_lines):
-    lexer = CustomLexer(lexer0.clone())
-    lexer.source_lines = source_lines
-    lexer.input('\n'.join(source_lines)) # all newlines are now just \n, simplifying the lexer
-    lexer.indent_stack = [0] # for keeping track of indentation depths
-    lexer.ongoing_declarations = {}
-    lexer.capture_names = set()
-    lexer.references = []
-    lexer.flag_dependent_builtins = FLAG_DEPENDENT_BUILTINS
+    def end_mode(self, mode):
+        if mode != self.mode:
+            raise OprexInternalError(self.lineno, "Trying to end mode '%s' but current mode is '%s'" % (mode, self.mode))
+        self.modes.pop()
+        self.mode = self.modes[-1]
 
-    root_scope = Scope(type=Scope.ROOTSCOPE, starting_lineno=0, parent_scope=None)
-    for var in BUILTINS:
-        root_scope[var.name] = var
-    lexer.scopes = [root_scope]
+    def begin_a_scope(self, type):
+        current_scope = self.scopes[-1]
+        new_scope = Scope(type=type, starting_lineno=self.lineno, parent_scope=current_scope)
+        self.scopes.append(new_scope)
+        return new_scope
 
-    return lexer
+    def end_a_scope(self, type, at):
+        removed_scope = self.scopes.pop()
+        removed_scope.close()
+        if type != removed_scope.type or at != removed_scope.starting_lineno:
+            raise OprexInternalError(self.lineno, 'end-of-scope for type=%s line=%d, but active scope is type=%s line=%d' % 
+                (Scope.types[type], at, Scope.types[removed_scope.type], removed_scope.starting_lineno))
 
 
-class CustomLexer:
+class CustomLexer(BaseLexer):
+    # the ply lexer, plus the extra tokens its rules produce
     def __init__(self, real_lexer):
         self.__dict__ = real_lexer.__dict__
         self.real_lexer = real_lexer
@@ -1599,33 +1974,845 @@ class CustomLexer:
         self.real_lexer.input(input_str)
 
     def start_mode(self, mode):
-        self.mode = mode
-        self.modes.append(mode)
+        BaseLexer.start_mode(self, mode)
         self.real_lexer.push_state(mode)
 
     def end_mode(self, mode):
-        if mode != self.mode:
-            raise OprexInternalError(self.lineno, "Trying to end mode '%s' but current mode is '%s'" % (mode, self.mode))
-        self.modes.pop()
-        self.mode = self.modes[-1]
+        BaseLexer.end_mode(self, mode)
         self.real_lexer.pop_state()
 
-    def begin_a_scope(self, type):
-        current_scope = self.scopes[-1]
-        new_scope = Scope(type=type, starting_lineno=self.lineno, parent_scope=current_scope)
-        self.scopes.append(new_scope)
-        return new_scope
 
-    def end_a_scope(self, type, at):
-        removed_scope = self.scopes.pop()
-        if type != removed_scope.type or at != removed_scope.starting_lineno:
-            raise OprexInternalError(self.lineno, 'end-of-scope for type=%s line=%d, but active scope is type=%s line=%d' % 
-                (Scope.types[type], at, Scope.types[removed_scope.type], removed_scope.starting_lineno))
+class Token:
+    # the scanner's counterpart of ply's LexToken, for the t_* rules to modify
+    def __init__(self, type, value, lineno, lexpos, lexer):
+        self.type = type
+        self.value = value
+        self.lineno = lineno
+        self.lexpos = lexpos
+        self.lexer = lexer
+
+
+class Scanner(BaseLexer):
+    # A single-pass replacement of the ply lexer, producing the very same tokens. Rather than
+    # trying one big alternation of every rule, it tries only the rules that can start with the
+    # character at hand -- in ply's order, running the same t_* actions. Whitespace, and the
+    # NEWLINE/INDENT/DEDENT/GLOBALMARK/END_OF_* tokens it implies, is handled by scan_whitespace().
+    rules = None # per mode: character -> candidate (regex, token type, action)s, see compile_rules()
+    whitespace_re = of_re = None
+
+    def __init__(self):
+        self.modes = []
+        self.start_mode('INITIAL')
+        self.lineno = 1
+        self.lexpos = 0 # like ply's, the end of the latest match -- the parser uses it for empty productions
+        self.indentchar = None
+
+    def input(self, data):
+        self.lexdata = data
+        self.token = self.scan(data).next
+
+    @staticmethod
+    def compile_rules():
+        # Lists each mode's rules in ply's order: function rules by line number, then string
+        # rules by decreasing length; the ORBLOCK and LOOKAROUND modes include the INITIAL rules
+        # after their own. The regexes are compiled the way ply does it, with re rather than
+        # regex, whose \w and \s are not ASCII-only.
+        import re, string
+        rule_re = lambda rule: re.compile(rule.__doc__ if callable(rule) else rule, re.VERBOSE)
+        Scanner.whitespace_re = rule_re(t_ANY_comments_whitespace)
+        Scanner.of_re = rule_re(t_INITIAL_ORBLOCK_OF)
+        ascii_word = string.ascii_letters + string.digits + '_'
+        non_whitespace = None # stands for any character except re's \s
+
+        # (first characters, regex -- None for single-character rules, token type, action)
+        initial = [
+            (':', None, 'COLON', t_COLON),
+            ('(', rule_re(t_FLAGSET), 'FLAGSET', t_FLAGSET),
+            ('<', rule_re(t_BEGIN_LOOKAROUND), 'BEGIN_LOOKAROUND', t_BEGIN_LOOKAROUND),
+            ('<@', rule_re(t_BEGIN_ORBLOCK), 'BEGIN_ORBLOCK', t_BEGIN_ORBLOCK),
+            ('"\'', rule_re(t_STRING), 'STRING', t_STRING),
+            ('n', rule_re(t_NON), 'NON', None),
+            ('F', rule_re(t_FAIL), 'FAIL', None),
+            (string.ascii_letters + '_', rule_re(t_VARNAME), 'VARNAME', None),
+            (' \t', Scanner.of_re, 'OF', None),
+            (' \t\n', Scanner.whitespace_re, 'WHITESPACE', None),
+            (string.digits, rule_re(t_NUMBER), 'NUMBER', None),
+        ]
+        this_module = sys.modules[__name__]
+        for type in tokens:
+            rule = getattr(this_module, 't_' + type, None)
+            if isinstance(rule, str) and len(rule) == 2 and rule[0] == '\\': # e.g. t_AT = r'\@'
+                initial.append((rule[1], None, type, None))
+
+        charclass = [
+            ('.', None, 'DOT', None),
+            ('na', rule_re(t_CHARCLASS_op), 'op', t_CHARCLASS_op),
+            (ascii_word, rule_re(t_CHARCLASS_varname), 'varname', t_CHARCLASS_varname),
+            ('+', rule_re(t_CHARCLASS_include), 'include', t_CHARCLASS_include),
+            ('/', rule_re(t_CHARCLASS_prop), 'prop', t_CHARCLASS_prop),
+            (':', rule_re(t_CHARCLASS_name), 'name', t_CHARCLASS_name),
+            ('\\', rule_re(t_CHARCLASS_escape), 'escape', t_CHARCLASS_escape),
+            ('\\', rule_re(t_CHARCLASS_bad_escape), 'bad_escape', t_CHARCLASS_bad_escape),
+            (non_whitespace, None, 'literal', t_CHARCLASS_literal),
+            (' \t\n', Scanner.whitespace_re, 'WHITESPACE', None),
+        ]
+        lookaround = [rule for rule in initial if rule[2] != 'OF'] # its own whitespace rule comes first
+
+        def dispatch_table(rules):
+            table = ModeRules()
+            for first_chars, regex, type, action in rules:
+                if first_chars is non_whitespace:
+                    table.non_whitespace = ((regex, type, action),)
+                    for char in string.printable:
+                        if not char.isspace():
+                            table[char] = table.get(char, ()) + table.non_whitespace
+                else:
+                    for char in first_chars:
+                        table[char] = table.get(char, ()) + ((regex, type, action),)
+            return table
+
+        Scanner.rules = dict(
+            INITIAL    = dispatch_table(initial),
+            ORBLOCK    = dispatch_table(initial),
+            LOOKAROUND = dispatch_table(lookaround),
+            CHARCLASS  = dispatch_table(charclass),
+        )
+
+    def scan(self, data):
+        rules = self.rules
+        end = len(data)
+        pos = 0
+        while pos < end:
+            char = data[pos]
+            for regex, type, action in rules[self.mode][char]:
+                if regex is None:
+                    value = char
+                    break
+                match = regex.match(data, pos)
+                if match:
+                    value = match.group()
+                    break
+            else:
+                t_ANY_error(Token('error', data[pos:], self.lineno, pos, self))
+
+            self.lexpos = pos + len(value)
+            if action:
+                token = action(Token(type, value, self.lineno, pos, self))
+                yield token
+                if action is t_FLAGSET:
+                    for token in token.extra_tokens:
+                        yield token
+            elif type == 'WHITESPACE':
+                for token in self.scan_whitespace(value, pos):
+                    yield token
+            elif type == 'OF': # the whitespace before "of" is a token of its own
+                yield LexToken('WHITESPACE', value, self.lineno, pos, self)
+                yield LexToken('OF', value, self.lineno, pos + value.index('of'), self)
+            else:
+                yield LexToken(reserved.get(value, type), value, self.lineno, pos, self)
+            pos += len(value)
+
+        self.lexpos = end + 1
+        dedent = LexToken('DEDENT', 'EOF', len(self.source_lines), end, self)
+        for _ in range(len(self.indent_stack) - 1):
+            yield dedent
+        while True:
+            yield None
+
+    def scan_whitespace(self, value, pos):
+        # t_ANY_comments_whitespace's logic, returning its token and the extra tokens
+        lineno = self.lineno
+        num_newlines = value.count('\n')
+        if num_newlines == 0:
+            if GLOBALMARK in value: # globalmark must be put at the beginning of a line, i.e. requires newline
+                raise OprexSyntaxError(lineno, 'Syntax error: ' + self.source_lines[lineno-1])
+            return [LexToken('WHITESPACE', value, lineno, pos, self)]
+
+        tokens = [LexToken('NEWLINE', value, lineno, pos, self)]
+        self.lineno = lineno = lineno + num_newlines
+        is_finale = pos + len(value) == len(self.lexdata)
+        indentation = '' if is_finale else value[value.rindex('\n') + 1:]
+
+        if self.mode == 'CHARCLASS': # NEWLINE ends the charclass-mode
+            self.end_mode('CHARCLASS')
+        if is_finale or num_newlines > 1: # empty line ends ORBLOCK/LOOKAROUND
+            if self.mode == 'ORBLOCK':
+                tokens.append(LexToken('END_OF_ORBLOCK', value, lineno, pos, self))
+                self.end_mode('ORBLOCK')
+            elif self.mode == 'LOOKAROUND':
+                tokens.append(LexToken('END_OF_LOOKAROUND', value, lineno, pos, self))
+                self.end_mode('LOOKAROUND')
+
+        has_globalmark = GLOBALMARK in indentation
+        if indentation:
+            if indentation == GLOBALMARK:
+                raise OprexSyntaxError(lineno, 'Syntax error: ' + indentation)
+            indent_using_space = ' ' in indentation
+            if indent_using_space and '\t' in indentation:
+                raise OprexSyntaxError(lineno, 'Cannot mix space and tab for indentation')
+            indentchar = ' ' if indent_using_space else '\t'
+            if self.indentchar is None: # the first indent, further indents must use the same character
+                self.indentchar = indentchar
+            elif indentchar != self.indentchar:
+                raise OprexSyntaxError(lineno, 'Inconsistent indentation character')
+            if has_globalmark:
+                if indentation.count(GLOBALMARK) > 1:
+                    raise OprexSyntaxError(lineno, 'Syntax error: ' + indentation)
+                if not indentation.startswith(GLOBALMARK):
+                    raise OprexSyntaxError(lineno, "The GLOBALMARK %s must be put at the line's beginning" % GLOBALMARK)
+                indentation = indentation.replace(GLOBALMARK, '  ' if indentchar == ' ' else '')
+
+        if self.mode == 'INITIAL':
+            indentlen = len(indentation)
+            indent_stack = self.indent_stack
+            if indentlen > indent_stack[-1]: # deeper indentation, start of a new scope
+                indent_stack.append(indentlen)
+                tokens.append(LexToken('INDENT', value, lineno, pos, self))
+            else:
+                while indentlen < indent_stack[-1]: # close all scopes having deeper indentation
+                    indent_stack.pop()
+                    tokens.append(LexToken('DEDENT', value, lineno, pos, self))
+                if indentlen != indent_stack[-1]: # the indentation tries to return to a nonexistent level
+                    raise OprexSyntaxError(lineno, 'Indentation error')
+
+        if has_globalmark:
+            tokens.append(LexToken('GLOBALMARK', GLOBALMARK, lineno, pos, self))
+        return tokens
+
+
+class ModeRules(dict):
+    # characters no rule starts with get the mode's "any non-whitespace" rules, if it has them
+    non_whitespace = ()
+    def __missing__(self, char):
+        if char in ' \t\n\r\f\v':
+            return ()
+        return self.non_whitespace
+
+
+class Symbol:
+    # a nonterminal, like ply's YaccSymbol: its value and where it starts
+    def __init__(self, lineno, lexpos):
+        self.value = None
+        self.lineno = lineno
+        self.lexpos = lexpos
+
+
+class Production:
+    # what the p_* rules get from the DescentParser, like ply's YaccProduction
+    def __init__(self, lexer, slice):
+        self.lexer = lexer
+        self.slice = slice
+
+    def __getitem__(self, n):
+        return self.slice[n].value
+
+    def __setitem__(self, n, value):
+        self.slice[n].value = value
+
+    def __getslice__(self, i, j):
+        return [symbol.value for symbol in self.slice[i:j]]
+
+    def __len__(self):
+        return len(self.slice)
+
+    def lineno(self, n):
+        return self.slice[n].lineno
+
+    def lexpos(self, n):
+        return self.slice[n].lexpos
+
+
+EXPR_FIRST = frozenset([
+    'STRING', 'DOT', 'UNDERSCORE', 'AT', 'NUMBER', 'SLASH', 'VARNAME', 'FAIL', 'NON', 'EQUALSIGN',
+    'LPAREN', 'BEGIN_ORBLOCK', 'BEGIN_LOOKAROUND',
+])
+LOOKUP_ITEM_FIRST = frozenset(['VARNAME', 'FAIL', 'NON', 'EQUALSIGN'])
+DEFINITION_FIRST = frozenset(['VARNAME', 'LBRACKET', 'GLOBALMARK'])
+DEFINITION_FOLLOW = DEFINITION_FIRST | frozenset(['DEDENT'])
+SUBBLOCK_FOLLOW = DEFINITION_FOLLOW | frozenset(['$end'])
+DECLARATION_FOLLOW = frozenset(['WHITESPACE', 'EQUALSIGN', 'COLON'])
+ORITEM_AFTER_BAR = EXPR_FIRST | frozenset(['LBRACKET', 'NEWLINE'])
+
+
+class DescentParser:
+    # A recursive-descent alternative to the LALR parser. It runs the same p_* rules on the same
+    # tokens and, with its single token of lookahead, in the same order as the LALR parser does,
+    # so a rule sees the same lexer state. The lists -- definitions, OR-block items, lookaround
+    # items, charclass items, lookup chains, chained assignments -- are read in a loop, and their
+    # right-recursive rules then applied from the last item back: the stack depth doesn't grow
+    # with a list's length, only with the nesting of subblocks.
+    def parse(self, lexer, tracking=True):
+        # tracking: as with ply, untracked nonterminals have no position of their own (0), only
+        # the tokens do -- so the rules behave as they would under the LALR parser
+        self.lexer = lexer
+        self.tracking = tracking
+        self.next_token = lexer.token
+        self.lookahead = lexer.token()
+        return self.oprex().value
+
+    def type(self):
+        return self.lookahead.type if self.lookahead else '$end'
+
+    def shift(self):
+        token = self.lookahead
+        self.lookahead = self.next_token()
+        return token
+
+    def expect(self, type):
+        if self.type() != type:
+            p_error(self.lookahead)
+        return self.shift()
+
+    def check(self, types):
+        # a rule that may raise is only applied if the LALR parser would apply it too, i.e.
+        # after seeing a token that can follow it -- otherwise the syntax error comes first
+        if self.type() not in types:
+            p_error(self.lookahead)
+
+    def reduce(self, rule, *children):
+        if not self.tracking:
+            symbol = Symbol(0, 0)
+        elif children:
+            symbol = Symbol(children[0].lineno, children[0].lexpos)
+        else: # an empty production is where the lexer is at
+            symbol = Symbol(self.lexer.lineno, self.lexer.lexpos)
+        rule(Production(self.lexer, (symbol,) + children))
+        return symbol
+
+    def fold(self, rule, items, last=()):
+        # applies a right-recursive list rule, e.g. "items : item | item items", on the items read,
+        # popping them: no copy of the list is made, and each item is let go once it's applied
+        symbol = self.reduce(rule, *(items.pop() + last))
+        while items:
+            symbol = self.reduce(rule, *(items.pop() + (symbol,)))
+        return symbol
+
+    def oprex(self):
+        type = self.type()
+        if type == '$end':
+            return self.reduce(p_oprex)
+        if type == 'WHITESPACE':
+            children = (self.shift(),)
+        else:
+            newline = self.expect('NEWLINE')
+            type = self.type()
+            if type == '$end':
+                children = (newline,)
+            elif type == 'INDENT':
+                indent = self.shift()
+                children = (newline, indent, self.root_expression(), self.expect('DEDENT'))
+            else:
+                children = (newline, self.root_expression())
+        self.check(['$end'])
+        return self.reduce(p_oprex, *children)
+
+    def root_expression(self):
+        if self.type() != 'LPAREN':
+            return self.reduce(p_root_expression, self.expression())
+        flags = (self.shift(), self.expect('FLAGSET'), self.expect('RPAREN'))
+        if self.type() == 'WHITESPACE': # scoped, not global, flags
+            return self.reduce(p_root_expression, self.expression(self.scoped_flags(flags)))
+        global_flags = self.reduce(p_global_flags, *(flags + (self.expect('NEWLINE'),)))
+        if self.type() in ('$end', 'DEDENT'):
+            return self.reduce(p_root_expression, global_flags)
+        return self.reduce(p_root_expression, global_flags, self.expression())
+
+    def expression(self, scoped_flags=None, varname=None):
+        expr = self.expr(scoped_flags, varname)
+        return self.reduce(p_expression, expr, self.optional_subblock())
+
+    def expr(self, scoped_flags=None, varname=None):
+        if scoped_flags:
+            expr = self.reduce(p_flagged_expr, scoped_flags, self.expr())
+        elif varname:
+            expr = self.lookup_expr(self.reduce(p_lookup, self.lookup_item(varname)))
+        else:
+            type = self.type()
+            if type in ('STRING', 'UNDERSCORE'):
+                expr = self.string_expr()
+            elif type in LOOKUP_ITEM_FIRST or type == 'SLASH':
+                expr = self.lookup_expr(self.lookup())
+            elif type == 'DOT': # a word boundary before a string, or the start of a lookup chain
+                dot = self.shift()
+                if self.type() == 'SLASH':
+                    expr = self.lookup_expr(self.lookup(dot))
+                else:
+                    self.check(['STRING'])
+                    expr = self.string_expr(self.reduce(p_str_b, dot))
+            elif type == 'AT': # a possessive quantifier, or an atomic lookup chain
+                at = self.shift()
+                if self.type() == 'NUMBER':
+                    expr = self.quantified_expr(at)
+                else:
+                    expr = self.lookup_expr(self.lookup(at))
+            elif type == 'NUMBER':
+                expr = self.quantified_expr()
+            elif type == 'LPAREN':
+                flags = (self.shift(), self.expect('FLAGSET'), self.expect('RPAREN'), self.expect('WHITESPACE'))
+                expr = self.reduce(p_flagged_expr, self.scoped_flags(flags), self.expr())
+            elif type == 'BEGIN_ORBLOCK':
+                expr = self.orblock_expr()
+            elif type == 'BEGIN_LOOKAROUND':
+                expr = self.lookaround_expr()
+            else:
+                p_error(self.lookahead)
+        return self.reduce(p_expr, expr)
+
+    def scoped_flags(self, flags):
+        if len(flags) == 3:
+            flags += (self.expect('WHITESPACE'),)
+        self.check(EXPR_FIRST)
+        return self.reduce(p_scoped_flags, *flags)
+
+    def string_expr(self, str_b=None):
+        children = (str_b,) if str_b else ()
+        if not str_b and self.type() == 'UNDERSCORE':
+            underscore = self.shift()
+            self.check(['STRING'])
+            children = (self.reduce(p_str_b, underscore),)
+        children += (self.expect('STRING'),)
+        if self.type() in ('DOT', 'UNDERSCORE'):
+            children += (self.reduce(p_str_b, self.shift()),)
+        children += (self.expect('NEWLINE'),)
+        return self.reduce(p_string_expr, *children)
+
+    def quantified_expr(self, at=None):
+        number = self.expect('NUMBER')
+        if at:
+            if self.type() == 'DOT':
+                repeat = self.reduce(p_repeat_range, at, self.numrange(number), self.of())
+            else:
+                repeat = self.reduce(p_repeat_N_times, at, number, self.of())
+        elif self.type() == 'DOT':
+            numrange = self.numrange(number)
+            repeat = self.reduce(p_repeat_range, numrange, self.backtrack(), self.expect('MINUS'), self.of())
+        else:
+            whitespace = self.expect('WHITESPACE')
+            if self.type() == 'OF':
+                repeat = self.reduce(p_repeat_N_times, number, self.reduce(p_of, whitespace, self.shift()))
+            else:
+                backtrack = self.backtrack(whitespace)
+                children = (number, backtrack, self.expect('PLUS'), self.expect('DOT'), self.expect('DOT'))
+                if self.type() == 'NUMBER':
+                    children += (self.shift(),)
+                repeat = self.reduce(p_repeat_range, *(children + (self.of(),)))
+
+        quantifier = self.reduce(p_quantifier, repeat)
+        if self.type() == 'COLON':
+            colon = self.shift()
+            return self.reduce(p_quantified_expr, quantifier, colon, self.charclass())
+        whitespace = self.expect('WHITESPACE')
+        return self.reduce(p_quantified_expr, quantifier, whitespace, self.expr())
+
+    def numrange(self, number):
+        children = (number, self.expect('DOT'), self.expect('DOT'))
+        if self.type() == 'NUMBER':
+            children += (self.shift(),)
+        return self.reduce(p_numrange, *children)
+
+    def backtrack(self, whitespace=None):
+        whitespace = whitespace or self.expect('WHITESPACE')
+        return self.reduce(p_backtrack, whitespace, self.expect('LT'), self.expect('LT'))
+
+    def of(self):
+        whitespace = self.expect('WHITESPACE')
+        return self.reduce(p_of, whitespace, self.expect('OF'))
+
+    def orblock_expr(self):
+        begin = self.shift()
+        newline = self.expect('NEWLINE')
+        items = []
+        while True:
+            items.append((self.oritem(),))
+            if self.type() != 'BAR':
+                break
+        self.check(['END_OF_ORBLOCK'])
+        oritems = self.fold(p_oritems, items)
+        return self.reduce(p_orblock_expr, begin, newline, oritems, self.shift())
+
+    def oritem(self):
+        bar = self.expect('BAR')
+        self.check(ORITEM_AFTER_BAR)
+        or_ = self.reduce(p_or, bar)
+        type = self.type()
+        if type == 'LBRACKET':
+            condition = self.reduce(p_condition, self.shift(), self.expect('VARNAME'), self.expect('RBRACKET'))
+            children = (or_, condition, self.expect('WHITESPACE'), self.expect('QUESTMARK'))
+            if self.type() == 'WHITESPACE':
+                whitespace = self.shift()
+                children += (whitespace, self.expr())
+            else:
+                children += (self.expect('NEWLINE'),)
+            return self.reduce(p_oritem, *children)
+        if type == 'NEWLINE':
+            return self.reduce(p_oritem, or_, self.shift())
+        return self.reduce(p_oritem, or_, self.expr())
+
+    def lookaround_expr(self):
+        begin = self.shift()
+        newline = self.expect('NEWLINE')
+        items = []
+        while True:
+            lookitem = self.lookitem()
+            items.append((lookitem, self.expect('NEWLINE')))
+            if self.type() not in ('BAR', 'LT'):
+                break
+        self.check(['END_OF_LOOKAROUND'])
+        lookitems = self.fold(p_lookitems, items)
+        return self.reduce(p_lookaround_expr, begin, newline, lookitems, self.shift())
+
+    def lookitem(self):
+        type = self.type()
+        if type not in ('BAR', 'LT'):
+            p_error(self.lookahead)
+        children = (self.shift(),)
+        if self.type() == 'EXCLAMARK':
+            children += (self.shift(),)
+        children += (self.lookup(),)
+        if type == 'LT' or len(children) == 3:
+            children += (self.expect('GT' if type == 'BAR' else 'BAR'),)
+        elif self.type() in ('GT', 'BAR'):
+            children += (self.shift(),)
+        else:
+            p_error(self.lookahead)
+        self.check(['NEWLINE'])
+        return self.reduce(p_lookitem, *children)
+
+    def lookup_expr(self, lookup):
+        return self.reduce(p_lookup_expr, lookup, self.expect('NEWLINE'))
+
+    def lookup(self, first=None):
+        if not first and self.type() in LOOKUP_ITEM_FIRST:
+            return self.reduce(p_lookup, self.lookup_item())
+
+        chain_begin = (first,) if first else ()
+        if not first and self.type() in ('AT', 'DOT'):
+            chain_begin = (self.shift(),)
+        if chain_begin and chain_begin[-1].type == 'DOT':
+            chain_begin += (self.expect('SLASH'),)
+        elif self.type() == 'DOT' and chain_begin: # @./
+            chain_begin += (self.shift(), self.expect('SLASH'))
+        else:
+            chain_begin += (self.expect('SLASH'),)
+            if self.type() == 'SLASH':
+                chain_begin += (self.shift(),)
+        chain_begin = self.reduce(p_chain_begin, *chain_begin)
+
+        items = []
+        while True:
+            lookup_item = self.lookup_item()
+            items.append((lookup_item, self.expect('SLASH')))
+            if self.type() not in LOOKUP_ITEM_FIRST:
+                break
+        lookup_chain = self.fold(p_lookup_chain, items)
+
+        if self.type() in ('SLASH', 'DOT'):
+            chain_end = self.reduce(p_chain_end, self.shift())
+        else:
+            chain_end = self.reduce(p_chain_end)
+        return self.reduce(p_lookup, chain_begin, lookup_chain, chain_end)
+
+    def lookup_item(self, varname=None):
+        type = varname.type if varname else self.type()
+        if type in ('VARNAME', 'FAIL'):
+            lookup_type = self.reduce(p_variable_lookup, varname or self.shift())
+        elif type == 'NON':
+            lookup_type = self.reduce(p_negated_lookup, self.shift(), self.expect('VARNAME'))
+        elif type == 'EQUALSIGN':
+            lookup_type = self.reduce(p_backreference, self.shift(), self.expect('VARNAME'))
+        else:
+            p_error(self.lookahead)
+        lookup_type = self.reduce(p_lookup_type, lookup_type)
+        if self.type() == 'QUESTMARK':
+            return self.reduce(p_lookup_item, lookup_type, self.shift())
+        return self.reduce(p_lookup_item, lookup_type)
+
+    def charclass(self):
+        items = []
+        while True:
+            whitespace = self.expect('WHITESPACE')
+            items.append((whitespace, self.charitem()))
+            if self.type() != 'WHITESPACE':
+                break
+        self.check(['NEWLINE'])
+        charitems = self.fold(p_charitems, items)
+        return self.reduce(p_charclass, charitems, self.shift())
+
+    def charitem(self):
+        type = self.type()
+        if type == 'CHAR':
+            char = self.shift()
+            if self.type() == 'DOT':
+                children = (char, self.shift(), self.expect('DOT'), self.expect('CHAR'))
+                self.check(['WHITESPACE', 'NEWLINE'])
+                charitem = self.reduce(p_ranged_char, *children)
+            else:
+                charitem = self.reduce(p_single_char, char)
+        elif type == 'DOT':
+            charitem = self.reduce(p_period_char, self.shift())
+        else:
+            p_error(self.lookahead)
+        return self.reduce(p_charitem, charitem)
+
+    def optional_subblock(self):
+        if self.type() != 'INDENT':
+            self.check(SUBBLOCK_FOLLOW) # as the LALR parser, which reduces the empty subblock on these only
+            return self.reduce(p_optional_subblock)
+        begin = self.reduce(p_begin_subblock, self.shift())
+        items = []
+        while True:
+            if self.type() == 'GLOBALMARK':
+                children = (self.shift(), self.assignment())
+            else:
+                children = (self.assignment(),)
+            self.check(DEFINITION_FOLLOW)
+            items.append((self.reduce(p_definition, *children),))
+            if self.type() not in DEFINITION_FIRST:
+                break
+        self.check(['DEDENT'])
+        definitions = self.fold(p_definitions, items)
+        end = self.reduce(p_end_subblock, self.shift())
+        return self.reduce(p_optional_subblock, begin, definitions, end)
+
+    def assignment(self):
+        # "a = b = value", or with a charclass: "a = b: x y z"
+        items = []
+        declaration = self.declaration()
+        while True:
+            if self.type() == 'COLON':
+                colon = self.shift()
+                charclass = self.charclass()
+                last = (declaration, colon, charclass, self.optional_subblock())
+                break
+            equals = self.equals()
+            type = self.type()
+            if type == 'LBRACKET':
+                items.append((declaration, equals))
+                declaration = self.declaration()
+                continue
+            if type == 'VARNAME': # another declaration, or a lookup
+                varname = self.shift()
+                if self.type() in DECLARATION_FOLLOW:
+                    items.append((declaration, equals))
+                    declaration = self.declaration(varname)
+                    continue
+                last = (declaration, equals, self.expression(varname=varname))
+            else:
+                last = (declaration, equals, self.expression())
+            break
+
+        if not items:
+            return self.reduce(p_assignment, *last)
+        return self.fold(p_assignment, items, last=(self.reduce(p_assignment, *last),))
+
+    def declaration(self, varname=None):
+        if varname:
+            children = (varname,)
+        elif self.type() == 'LBRACKET':
+            children = (self.shift(), self.expect('VARNAME'), self.expect('RBRACKET'))
+        else:
+            children = (self.expect('VARNAME'),)
+        self.check(DECLARATION_FOLLOW)
+        return self.reduce(p_declaration, *children)
+
+    def equals(self):
+        children = ()
+        if self.type() == 'WHITESPACE':
+            children += (self.shift(),)
+        children += (self.expect('EQUALSIGN'),)
+        if self.type() == 'WHITESPACE':
+            children += (self.shift(),)
+        return self.reduce(p_equals, *children)
+
+
+class OprexCompiler:
+    # Owns its lexer, its parser state and its builtin tables, so separate instances can compile
+    # concurrently without locking. Only the read-only lexer rules and parse tables are shared.
+    # A single instance is not reentrant: use one per thread (see thread_compiler()).
+    # lexer='ply' lexes with the ply lexer rather than the Scanner; both produce the same tokens.
+    # parser='descent' parses with the DescentParser rather than the LALR one; both give the same
+    # results, but the former is faster on long lists (e.g. OR-blocks of thousands of items).
+    lexers = ('scanner', 'ply')
+    parsers = ('lalr', 'descent')
+    def __init__(self, lexer='scanner', parser='lalr'):
+        if lexer not in self.lexers:
+            raise ValueError('Unknown lexer: %r, supported are: %s' % (lexer, ', '.join(self.lexers)))
+        if parser not in self.parsers:
+            raise ValueError('Unknown parser: %r, supported are: %s' % (parser, ', '.join(self.parsers)))
+        self.lalr_parser = copy.copy(lalr_parser()) # ply keeps the parse stacks on the parser object
+        self.parser = self.lalr_parser if parser == 'lalr' else DescentParser()
+        if lexer == 'ply':
+            if lexer0 is None:
+                init_ply_lexer()
+            self.lexer0 = lexer0.clone()
+        else:
+            self.lexer0 = None
+        self.builtins = list(BUILTINS)
+        self.flag_dependent_builtins = dict(
+            (flag, dict(versions)) for flag, versions in FLAG_DEPENDENT_BUILTINS.iteritems()
+        )
+        self.checked_flagsets = set() # those the regex engine accepted, see t_FLAGSET
+        # never modified after this; each source gets its own root scope on top of it
+        self.builtin_scope = Scope(type=Scope.ROOTSCOPE, starting_lineno=0, parent_scope=None)
+        for var in self.builtins:
+            self.builtin_scope[var.name] = var
+
+    def oprex(self, source_code, optimize=False, strict=False):
+        source_lines = sanitize(source_code)
+        result = self.compile_lines(source_lines, passes.pipeline(optimize), strict)
+        if strict and result.metadata['backtracking_risks']:
+            raise OprexBacktrackingError(result.metadata['backtracking_risks'])
+        return result
+
+    def backtracking_risks(self, source_lines):
+        # analyzes the regex's IR, unoptimized, where each definition's value is still its own subtree
+        try:
+            lexer, regex = self.parse_lines(source_lines, False)
+        except OprexError: # for the exact error, as in compile_lines()
+            lexer, regex = self.parse_lines(source_lines, True)
+        return backtracking.risks(regex.node, lexer.definitions, main_expression_lineno(source_lines))
+
+    def compile_many(self, sources, stats=None):
+        # Compiles each source in turn, yielding a BatchResult per source. Compile errors are
+        # reported in the results rather than raised, so one bad source doesn't abort the batch.
+        if stats is None:
+            stats = BatchStats()
+        for index, source_code in enumerate(sources):
+            yield self.batch_result(index, source_code, stats)
+
+    def batch_result(self, index, source_code, stats):
+        start = time.time()
+        try:
+            result = self.oprex(source_code)
+        except OprexError as e:
+            result, error = None, e
+            stats.failed += 1
+        else:
+            error = None
+            stats.compiled += 1
+        stats.elapsed += time.time() - start
+        return BatchResult(index, source_code, result, error)
+
+    def compile_lines(self, source_lines, pipeline=(), strict=False):
+        # Parses without position tracking first, which is faster. A successful compile only needs
+        # the tokens' own line numbers, but error messages need the positions of nonterminals too,
+        # so on error the source is compiled again, tracked, to raise the exact error. The first
+        # pass also defers the regex engine checks of charclass items (see check_charitems()).
+        # strict: find the backtracking risks too, kept in the result's metadata -- from the IR as
+        # parsed, before the passes, with no second parse as backtracking_risks() takes.
+        try:
+            return self.compile_lines_with(source_lines, False, pipeline, strict)
+        except OprexError:
+            return self.compile_lines_with(source_lines, True, pipeline, strict)
+
+    def compile_lines_with(self, source_lines, tracking, pipeline=(), strict=False):
+        lexer, regex = self.parse_lines(source_lines, tracking)
+        node = regex.node
+        metadata = {}
+        if strict:
+            metadata['backtracking_risks'] = tuple(backtracking.risks(node, lexer.definitions, main_expression_lineno(source_lines)))
+        if pipeline:
+            node = passes.run(node, pipeline)
+            regex = ir.emit(node)
+        definitions = [(var.name, ir_node(var.value)) for var in lexer.definitions]
+        return OprexResult(regex, capture_names=lexer.capture_names, node=node, definitions=definitions, **metadata)
+
+    def parse_lines(self, source_lines, tracking):
+        # the lexer, with what it collected along the way, and the parsed Regex
+        lexer = self.build_lexer(source_lines, defer_checks=not tracking)
+        try:
+            regex = self.parse(lexer, tracking)
+        except RuntimeError as e:
+            if self.parser is self.lalr_parser or 'recursion' not in str(e):
+                raise
+            # subblocks nested deeper than the DescentParser can recurse, start over with LALR
+            lexer = self.build_lexer(source_lines, defer_checks=not tracking)
+            regex = self.lalr_parser.parse(lexer=lexer, tracking=tracking)
+        cleanup(lexer=lexer)
+        return lexer, regex
+
+    def build_lexer(self, source_lines, defer_checks=False):
+        # defer_checks: charclass items are checked by the regex engine a line at a time, rather
+        # than as they're lexed -- faster, but then an error later on the line may be reported first
+        lexer = CustomLexer(self.lexer0.clone()) if self.lexer0 else Scanner()
+        lexer.source_lines = source_lines
+        source = '\n'.join(source_lines) # all newlines are now just \n, simplifying the lexer
+        lexer.positions = SourcePositions(source)
+        lexer.input(source)
+        lexer.indent_stack = [0] # for keeping track of indentation depths
+        lexer.ongoing_declarations = {}
+        lexer.capture_names = set()
+        lexer.references = []
+        lexer.definitions = [] # the Variables defined in the source
+        lexer.flag_dependent_builtins = self.flag_dependent_builtins
+        lexer.checked_flagsets = self.checked_flagsets
+        lexer.defer_checks = defer_checks
+
+        lexer.scopes = [Scope(type=Scope.ROOTSCOPE, starting_lineno=0, parent_scope=self.builtin_scope)]
+
+        return lexer
+
+    def parse(self, lexer, tracking=True):
+        return self.parser.parse(lexer=lexer, tracking=tracking) # the Regex, with its IR
+
+
+BatchResult = namedtuple('BatchResult', 'index source result error')
+
+
+class BatchStats:
+    def __init__(self):
+        self.compiled = 0
+        self.failed = 0
+        self.elapsed = 0.0 # seconds spent compiling
+
+    @property
+    def throughput(self): # sources per second
+        total = self.compiled + self.failed
+        return total / self.elapsed if self.elapsed else 0.0
+
+
+def compile_many(sources, stats=None):
+    # each source is compiled by the compiler of the thread advancing the generator, so it may be
+    # consumed on another thread than the one that made it
+    if stats is None:
+        stats = BatchStats()
+    for index, source_code in enumerate(sources):
+        yield thread_compiler().batch_result(index, source_code, stats)
+
+
+compilers = threading.local()
+
+def thread_compiler(parser=None):
+    # parser: the thread's compiler using that parser, rather than its default one
+    if parser is not None:
+        try:
+            by_parser = compilers.by_parser
+        except AttributeError:
+            by_parser = compilers.by_parser = {}
+        if parser not in by_parser:
+            by_parser[parser] = OprexCompiler(parser=parser)
+        return by_parser[parser]
+    try:
+        return compilers.current
+    except AttributeError:
+        compilers.current = OprexCompiler()
+        return compilers.current
 
 
-parser = yacc.yacc()
-def parse(lexer):
-    return unicode(parser.parse(lexer=lexer, tracking=True))
+compile_cache = CompileCache(maxsize=1024, maxchars=1 << 22) # characters of regex
+pattern_cache = CompileCache(maxsize=1024, maxchars=1 << 22, size=lambda pattern: len(pattern.pattern))
+risk_cache = CompileCache(maxsize=1024) # its results, the risks found, are small
+
+
+GLOBAL_FLAGS_LINE_RE = LazyRegex(r'\([\w\s-]*\)$')
+
+def main_expression_lineno(source_lines):
+    # the first line that's not blank, a comment, or the global flags
+    for lineno, line in enumerate(source_lines, 1):
+        line = line.strip()
+        if line and not line.startswith('--') and not GLOBAL_FLAGS_LINE_RE.match(line):
+            return lineno
+    return 0
 
 
 def cleanup(lexer):
@@ -1644,17 +2831,101 @@ def cleanup(lexer):
     check_unclosed_scope()
 
 
+SOURCE_EXT = '.op'
+
+
+def find_source_files(paths):
+    # expands directories (recursively, .op files only) and glob patterns, in a stable order
+    import glob, os
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith(SOURCE_EXT):
+                        yield os.path.join(dirpath, filename)
+        elif glob.has_magic(path):
+            for filename in sorted(glob.glob(path)):
+                yield filename
+        else:
+            yield path
+
+
+def compile_file(path, encoding='utf-8', strict=False):
+    # returns a JSON-able record, with the error message in it rather than raised
+    import codecs
+    start = time.time()
+    record = dict(path=path, regex=None, capture_names=None, error=None)
+    try:
+        with codecs.open(path, 'r', encoding) as f:
+            source_code = f.read()
+        result = thread_compiler().oprex(source_code, strict=strict)
+    except (OprexError, IOError, UnicodeError) as e:
+        record['error'] = error_message(e).strip()
+    else:
+        record['regex'] = unicode(result) # plain types only, records get pickled across processes
+        record['capture_names'] = list(result.capture_names)
+    record['time'] = time.time() - start
+    return record
+
+
+def error_message(e):
+    # as unicode: str() fails on a unicode message with non-ASCII in it (e.g. quoting the source),
+    # unicode() on a byte string one (e.g. an IOError's path)
+    try:
+        return unicode(e)
+    except UnicodeDecodeError:
+        return str(e).decode('utf-8', 'replace')
+
+
+def compile_file_star(args): # Pool.imap passes a single argument
+    return compile_file(*args)
+
+
+def compile_files(paths, encoding='utf-8', jobs=None, strict=False):
+    # Yields compile_file() records, in order, fanning the files out over a process pool.
+    # Every worker process builds its compiler once, up front, and reuses it for all its files.
+    import multiprocessing
+    paths = list(find_source_files(paths))
+    jobs = jobs or multiprocessing.cpu_count()
+    if jobs == 1 or len(paths) < 2:
+        for path in paths:
+            yield compile_file(path, encoding, strict)
+        return
+
+    pool = multiprocessing.Pool(min(jobs, len(paths)), initializer=thread_compiler)
+    try:
+        chunksize = max(1, len(paths) // (jobs * 4))
+        for record in pool.imap(compile_file_star, [(path, encoding, strict) for path in paths], chunksize):
+            yield record
+    finally:
+        pool.terminate()
+
+
 if __name__ == "__main__":
+    import argparse, codecs, json, os
     argparser = argparse.ArgumentParser()
-    argparser.add_argument('path/to/source/file')
+    argparser.add_argument('paths', metavar='path/to/source/file', nargs='+',
+        help='directories and glob patterns expand to the .op files in them')
     argparser.add_argument('--encoding', help='encoding of the source file')
+    argparser.add_argument('--jobs', type=int, help='number of worker processes (default: one per CPU)')
+    argparser.add_argument('--strict', action='store_true',
+        help='reject the sources whose regex may backtrack catastrophically')
+    argparser.add_argument('--jsonl', action='store_true',
+        help='print a JSON object per file (path, regex, capture_names, time, error); implied for several files')
     args = argparser.parse_args()
 
-    source_file = getattr(args, 'path/to/source/file')
     default_encoding = 'utf-8'
     encoding = args.encoding or default_encoding
 
-    with codecs.open(source_file, 'r') as f:
-        source_code = f.read()
+    if len(args.paths) == 1 and os.path.isfile(args.paths[0]) and not args.jsonl:
+        with codecs.open(args.paths[0], 'r', encoding) as f:
+            source_code = f.read()
 
-    print oprex(source_code)
+        print oprex(source_code, strict=args.strict)
+    else:
+        failed = False
+        for record in compile_files(args.paths, encoding, args.jobs, args.strict):
+            print json.dumps(record)
+            failed = failed or record['error'] is not None
+        sys.exit(1 if failed else 0)
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+# Optimization passes over the IR (see ir.py), run on a compiled regex when compiling with the
+# optimize option. A pass takes the root node and returns it, rebuilt where it changed anything.
+# optimize=True runs every registered pass, in the order they were registered; otherwise it
+# names the passes to run, e.g. optimize=['flatten'].
+
+from collections import OrderedDict
+import charset, ir, regex as regexlib
+from lazy import LazyRegex
+
+
+PASSES = OrderedDict()
+
+def register(name):
+    def register_pass(fn):
+        PASSES[name] = fn
+        return fn
+    return register_pass
+
+
+def pipeline(optimize):
+    if not optimize:
+        return ()
+    if optimize is True:
+        return tuple(PASSES)
+    if isinstance(optimize, basestring):
+        optimize = [optimize]
+    for name in optimize:
+        if name not in PASSES:
+            raise ValueError('Unknown optimization pass: %r, registered are: %s' % (name, ', '.join(PASSES)))
+    return tuple(optimize)
+
+
+def run(node, pipeline):
+    for name in pipeline:
+        node = PASSES[name](node)
+    return node
+
+
+@register('flatten')
+def flatten(root):
+    # Splices nested sequences into their parent and drops the empty items. The emitted regex
+    # doesn't change, but the other passes then see each sequence's items side by side.
+    def flatten_sequence(node):
+        if not isinstance(node, ir.Sequence):
+            return node
+        items = []
+        for item in node.items:
+            if isinstance(item, ir.Sequence):
+                items.extend(item.items)
+            elif item.__class__ is not ir.Literal or item.text: # nodes compare as tuples, EMPTY == Raw('')
+                items.append(item)
+        if not items:
+            return ir.EMPTY
+        if len(items) == 1:
+            return items[0]
+        return ir.Sequence(tuple(items))
+    return ir.transform(root, flatten_sequence)
+
+
+
+FLAG_GROUP_RE = LazyRegex(r'\(\?([a-zA-Z]*)(?:-([a-zA-Z]*))?:$') # e.g. (?i: or (?s-x:
+LITERAL_UNIT_RE = LazyRegex(r'''(?sx)\\
+    ( N\{[^}]*\}          # Unicode character name
+    | U[0-9a-fA-F]{8}     # 8-digit hex escapes
+    | u[0-9a-fA-F]{4}     # 4-digit hex escapes
+    | x[0-9a-fA-F]{2}     # 2-digit hex escapes
+    | [0-7]{1,3}          # Octal escapes
+    | .
+    ) | .''')
+
+
+def scoped_flags(node, flags):
+    # the flags in effect inside node, given those in effect around it
+    if isinstance(node, ir.Group):
+        match = FLAG_GROUP_RE.match(node.opener)
+        if match:
+            turn_ons, turn_offs = match.group(1), match.group(2) or ''
+            flags = ''.join(flag for flag in flags if flag not in turn_offs) + turn_ons
+    return flags
+
+
+def is_flag_scope(node):
+    return isinstance(node, ir.Group) and node.opener != '(?:' and FLAG_GROUP_RE.match(node.opener)
+
+
+def literal_units(text):
+    # the regex text of a literal, split into the characters it matches; those written as an
+    # escaped punctuation or as-is are normalized into a single form, so they compare equal
+    units = []
+    for match in LITERAL_UNIT_RE.finditer(text):
+        unit = match.group()
+        if len(unit) == 2 and not unit[1].isalnum(): # e.g. \. or \#
+            unit = unit[1]
+        if len(unit) == 1:
+            unit = regexlib.escape(unit, special_only=True)
+        units.append(unit)
+    return tuple(units)
+
+
+def is_plain(unit): # i.e. not an escape sequence like \t or \x41, which may match the same as another unit
+    return not (unit[0] == '\\' and unit[1].isalnum())
+
+
+@register('trie')
+def trie(root):
+    # Factors out the common prefixes of an alternation's literal branches, e.g. foo|foobar|fox
+    # becomes fo(?:o(?:|bar)|x), so the engine no longer tries each branch in turn.
+    #
+    # The branches are still tried in the same order: a prefix's group stands where the first of
+    # its branches was, and keeps its own branches in their original order. Two branches starting
+    # with different characters can't both match at the same position, so their relative order
+    # doesn't matter and branches may be gathered from anywhere in the alternation -- unless it's
+    # case-insensitive or matches in reverse, then only adjacent branches are factored. Other
+    # branches, including empty ones, can match anything, so no branch is ever moved across them.
+    # Verbose-mode alternations are left as they are, a # in a literal would start a comment.
+    #
+    # Within scoped flags, an alternation isn't factored into a single branch: the regex engine
+    # (as of 2016.12.27) may apply the scope's flags to what follows when the scope holds a literal
+    # followed by a group, e.g. (?i:a(?:b|c))a matches ABA -- but not when it's an alternation.
+    def factor(node, flags, in_flag_scope):
+        flags = scoped_flags(node, flags)
+        in_flag_scope = in_flag_scope or is_flag_scope(node)
+        node = node.map(lambda child: factor(child, flags, in_flag_scope))
+        if isinstance(node, ir.Alternation) and 'x' not in flags:
+            reorderable = 'i' not in flags and 'r' not in flags
+            return factor_alternation(node, reorderable, single_branch=not in_flag_scope)
+        return node
+
+    def factor_alternation(node, reorderable, single_branch):
+        items = []
+        keys = [] # the literal branches since the last other branch
+        seen = set()
+        for item in node.items:
+            if isinstance(item, ir.Literal) and item.text:
+                key = literal_units(item.text)
+                if key not in seen: # a repeated branch would only fail again
+                    seen.add(key)
+                    keys.append(key)
+            else:
+                items.extend(branches(keys, reorderable))
+                items.append(item)
+                keys = []
+        items.extend(branches(keys, reorderable))
+        if not any(isinstance(item, ir.Sequence) and item not in node.items for item in items):
+            return node # nothing to factor
+        if len(items) == 1 and not single_branch:
+            return node
+        return ir.Alternation(tuple(items))
+
+    def branches(keys, reorderable):
+        # the alternatives matching keys, in the same order, with the keys sharing a prefix
+        # grouped into one; an empty key ends the keys that can be grouped together
+        alternatives = []
+        segment = []
+        for key in keys + [()]:
+            if key:
+                segment.append(key)
+                continue
+            for group in groups(segment, reorderable):
+                alternatives.append(branch(group, reorderable))
+            segment = []
+            alternatives.append(ir.EMPTY)
+        return alternatives[:-1] # without the () sentinel's
+
+    def groups(keys, reorderable):
+        if reorderable and all(is_plain(key[0]) for key in keys):
+            by_first_unit = OrderedDict()
+            for key in keys:
+                by_first_unit.setdefault(key[0], []).append(key)
+            return by_first_unit.values()
+        adjacent = []
+        for key in keys:
+            if adjacent and adjacent[-1][0][0] == key[0]:
+                adjacent[-1].append(key)
+            else:
+                adjacent.append([key])
+        return adjacent
+
+    def branch(keys, reorderable):
+        if len(keys) == 1:
+            return ir.Literal(''.join(keys[0]))
+        prefix = common_prefix(keys)
+        suffixes = [key[len(prefix):] for key in keys]
+        alternatives = branches(suffixes, reorderable)
+        return ir.Sequence((ir.Literal(''.join(prefix)), ir.Group('(?:', ir.Alternation(tuple(alternatives)))))
+
+    def common_prefix(keys):
+        prefix = keys[0]
+        for key in keys[1:]:
+            length = 0
+            for a, b in zip(prefix, key):
+                if a != b:
+                    break
+                length += 1
+            prefix = prefix[:length]
+        return prefix
+
+    return factor(root, root.flags, in_flag_scope=False)
+
+
+@register('charclass')
+def charclass(root):
+    # Evaluates the set operations of character classes, e.g. [a-z--aeiou] becomes
+    # [b-df-hj-np-tv-z], and writes each class in a canonical form: merged ranges, a single
+    # character without the brackets, [^...] when the complement is shorter -- so the engine
+    # no longer evaluates the operations at every character, and classes matching the same
+    # characters are written the same. Version 0 regexes don't have set operations. Items whose
+    # members aren't known here (\d, \p{L}...) are kept as they are, unless intersected with or
+    # subtracted from a few known characters -- the engine then tells which of those they match.
+    if 'V0' in root.flags:
+        return root
+
+    def fold(node, flags):
+        flags = scoped_flags(node, flags)
+        node = node.map(lambda child: fold(child, flags))
+        if isinstance(node, ir.CharClass):
+            try:
+                negated, chars = charset.parse(node.text, flags)
+            except charset.Unfoldable:
+                return node
+            text = charset.text(negated, chars, flags)
+            if text:
+                return ir.CharClass(text)
+        return node
+
+    return fold(root, root.flags)
+
+
+GREEDY_QUANTIFIER_RE = LazyRegex(r'(?:[*+?]|\{(\d*),\d*\})$') # not {n}, nor already lazy or possessive
+FIXED_QUANTIFIER_RE = LazyRegex(r'\{\d+\}$') # e.g. {2}
+ANYCHAR = charset.CharSet([(0, charset.MAX_CODEPOINT)])
+
+
+def first_chars(node, flags, skip_zero_width=False):
+    # The characters node may start matching with, as a CharSet, and whether it may match the
+    # empty string; None for the characters when that's not known here. Anchors, lookarounds,
+    # backreferences and the like make it not known, matching them depends on the position --
+    # unless skip_zero_width, then anchors and lookarounds are taken as matching the empty string,
+    # for a superset of the characters.
+    flags = scoped_flags(node, flags)
+    if isinstance(node, ir.Root):
+        return first_chars(node.body, flags, skip_zero_width)
+    if isinstance(node, ir.Literal):
+        if not node.text:
+            return charset.CharSet(), True
+        return single_chars(literal_units(node.text)[0], flags, is_literal=True), False
+    if isinstance(node, ir.CharClass):
+        return single_chars(node.text, flags), False
+    if isinstance(node, ir.Group):
+        return first_chars(node.body, flags, skip_zero_width)
+    if isinstance(node, ir.Quantifier):
+        chars, nullable = first_chars(node.body, flags, skip_zero_width)
+        return chars, nullable or min_repeats(node.quantifier) == 0
+    if isinstance(node, (ir.Sequence, ir.Alternation)):
+        chars, nullable = charset.CharSet(), isinstance(node, ir.Sequence)
+        for item in node.items:
+            item_chars, item_nullable = first_chars(item, flags, skip_zero_width)
+            chars = chars.union(item_chars) if chars is not None and item_chars is not None else None
+            if isinstance(node, ir.Sequence):
+                if not item_nullable:
+                    return chars, False
+            elif item_nullable:
+                nullable = True
+        return chars, nullable
+    if skip_zero_width and isinstance(node, (ir.Anchor, ir.Lookaround)):
+        return charset.CharSet(), True
+    return None, False
+
+
+def single_chars(text, flags, is_literal=False):
+    # what a single-character matcher matches, e.g. a, \t, [a-f], \d, .
+    if 'i' in flags or is_literal and 'x' in flags: # case-folded, or maybe a verbose mode's whitespace
+        return None
+    if text == '.':
+        return ANYCHAR if 's' in flags else charset.CharSet([(0, 9), (11, charset.MAX_CODEPOINT)])
+    try:
+        negated, chars = charset.parse(text if text.startswith('[') else '[%s]' % text, flags)
+        return chars.complement() if negated else chars
+    except charset.Unfoldable:
+        return None
+
+
+def min_repeats(quantifier):
+    if quantifier[0] in '*?':
+        return 0
+    if quantifier[0] == '{':
+        return int(quantifier[1:].split(',')[0].rstrip('}') or 0)
+    return 1
+
+
+def is_fixed(node):
+    # whether node matches one fixed sequence of single characters: no alternatives, no repeats
+    if isinstance(node, ir.Literal):
+        return bool(node.text)
+    if isinstance(node, ir.CharClass):
+        return True
+    if isinstance(node, ir.Group):
+        return is_fixed(node.body)
+    if isinstance(node, ir.Sequence):
+        return all(is_fixed(item) for item in node.items)
+    if isinstance(node, ir.Quantifier):
+        return bool(FIXED_QUANTIFIER_RE.match(node.quantifier)) and is_fixed(node.body)
+    return False
+
+
+def is_single_char(node):
+    return isinstance(node, ir.CharClass) or isinstance(node, ir.Literal) and len(literal_units(node.text)) == 1
+
+
+@register('possessive')
+def possessive(root):
+    # Makes a greedy quantifier possessive when giving back a repetition can't help what follows
+    # to match, e.g. (?:[0-9a-f]{2})+ followed by a space: (?:[0-9a-f]{2})++ fails as soon as the
+    # space doesn't match, rather than retrying it after each of the repetitions.
+    #
+    # That's when each repetition is a fixed sequence of characters, like (?:ab) or (?:\d{2}),
+    # and none of the characters that may follow the quantifier can start a repetition -- giving
+    # one back would then have what follows start matching at one. What follows is found from
+    # the enclosing sequences, up to the end of the regex, after which nothing is matched. It's
+    # not known after anchors or lookarounds, nor past a group that may also be called as a
+    # subroutine, nor in case-insensitive or reverse matching -- then the quantifier is kept.
+    #
+    # A repeated single character, like \d+, is left as it is: the regex engine (as of 2016.12.27)
+    # already doesn't backtrack into it needlessly, and it's much slower when written possessive.
+    if 'r' in root.flags:
+        return root
+    called = set(node.name for node in ir.walk(root) if isinstance(node, ir.Subroutine))
+
+    def convert(node, flags, follow):
+        # follow is the CharSet of what may be matched right after node, or None if not known
+        flags = scoped_flags(node, flags)
+        if isinstance(node, ir.Sequence):
+            items = []
+            for item in reversed(node.items):
+                items.append(convert(item, flags, follow))
+                follow = followed_by(item, flags, follow)
+            return ir.Sequence(tuple(reversed(items)))
+        if isinstance(node, ir.Lookaround) or is_atomic(node):
+            return node
+        if isinstance(node, ir.Group) and node.capture_name in called:
+            follow = None
+        if isinstance(node, ir.Quantifier):
+            body_chars, _ = first_chars(node.body, flags)
+            node = node.map(lambda body: convert(body, flags, union(body_chars, follow)))
+            if (GREEDY_QUANTIFIER_RE.match(node.quantifier) and is_fixed(node.body) and not is_single_char(node.body)
+                    and body_chars is not None and follow is not None
+                    and charset.disjoint(body_chars, follow, flags)):
+                return ir.Quantifier(node.body, node.quantifier + '+')
+            return node
+        return node.map(lambda child: convert(child, flags, follow))
+
+    def is_atomic(node):
+        # The regex engine (as of 2016.12.27) may backtrack into an atomic group or possessive
+        # quantifier that ends with another, e.g. (?:(?:a\d*+)++){2} matches a1b -- so nothing
+        # is made possessive within those. Lookarounds are atomic too, and lookbehinds match
+        # backwards.
+        if isinstance(node, ir.Group):
+            return node.opener == '(?>'
+        if isinstance(node, ir.Quantifier):
+            return len(node.quantifier) > 1 and node.quantifier.endswith('+')
+        return False
+
+    def followed_by(node, flags, follow):
+        chars, nullable = first_chars(node, flags)
+        return union(chars, follow) if nullable else chars
+
+    def union(a, b):
+        return a.union(b) if a is not None and b is not None else None
+
+    return convert(root, root.flags, charset.CharSet())
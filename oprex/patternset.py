@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Thousands of oprex patterns run against the same text, only the ones that may match it being
+# run: the literals every match of a pattern contains (see literals.py) are looked for all at
+# once, by an Aho-Corasick automaton, and a pattern runs only if its literals are all in the text.
+# Patterns requiring no literal always run. Unlike Classifier's combined regex, whose compiling
+# and matching get slower with every pattern added, a pattern's regex is compiled on first use.
+
+from collections import deque
+import regex as regexlib
+from classifier import Classification
+from oprex import oprex
+from prefilter import is_ascii
+
+
+class Automaton:
+    # Aho-Corasick: finds which of the strings occur in a text, in a single pass over it
+    def __init__(self, strings):
+        self.goto = [{}] # per state, the next one by character; state 0 is the root
+        self.outputs = [()] # per state, the indexes of the strings ending there
+        for index, string in enumerate(strings):
+            if string is None: # not looked for
+                continue
+            state = 0
+            for char in string:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = self.goto[state][char] = len(self.goto)
+                    self.goto.append({})
+                    self.outputs.append(())
+                state = next_state
+            self.outputs[state] += (index,)
+
+        # per state, the one for its longest proper suffix that's also a prefix of a string; the
+        # strings ending there end here too
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].iteritems():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_state] = fail
+                self.outputs[next_state] += self.outputs[fail]
+
+    def find(self, text):
+        # the indexes of the strings found in text, as a set
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                found.update(outputs[state])
+        return found
+
+
+class PatternSet:
+    # patterns: a mapping of name to oprex source, or (name, source) pairs; results come in the
+    # same order
+    def __init__(self, patterns, optimize=False):
+        if hasattr(patterns, 'items'):
+            patterns = patterns.items()
+        self.names, self.regexes = [], []
+        self.patterns = [] # compiled on first use
+        literals = {} # literal -> its index in the automaton
+        self.required = [] # per pattern, the indexes of its literals
+        self.byte_required = [] # the same, of its ASCII literals only: those known to be in a str as such
+        for name, source in patterns:
+            result = oprex(source, optimize)
+            self.names.append(name)
+            self.regexes.append(unicode(result)) # not the IR, kept by the result
+            self.patterns.append(None)
+            indexes = dict((literal, literals.setdefault(literal, len(literals)))
+                for literal in result.required_literals)
+            self.required.append(frozenset(indexes.values()))
+            self.byte_required.append(frozenset(index for literal, index in indexes.items() if is_ascii(literal)))
+        self.literals = sorted(literals, key=literals.get)
+        self.automaton = Automaton(self.literals)
+        self.byte_automaton = Automaton([literal.encode('ascii') if is_ascii(literal) else None for literal in self.literals])
+
+        # A pattern is looked up by one of its literals, the longest, and runs if the others
+        # are also found. Those without literals always run.
+        self.keyed, self.always = by_longest_literal(self.required, self.literals)
+        self.byte_keyed, self.byte_always = by_longest_literal(self.byte_required, self.literals)
+
+    def pattern(self, i):
+        pattern = self.patterns[i]
+        if pattern is None:
+            pattern = self.patterns[i] = regexlib.compile(self.regexes[i])
+        return pattern
+
+    def candidates(self, text, pos=None, endpos=None):
+        # the indexes of the patterns that may match in text, in order
+        if pos is not None or endpos is not None:
+            text = text[pos or 0:endpos]
+        if isinstance(text, unicode):
+            automaton, required, keyed, always = self.automaton, self.required, self.keyed, self.always
+        else:
+            automaton, required, keyed, always = self.byte_automaton, self.byte_required, self.byte_keyed, self.byte_always
+        found = automaton.find(text)
+        candidates = list(always)
+        for literal in found:
+            for i in keyed.get(literal, ()):
+                if required[i] <= found:
+                    candidates.append(i)
+        candidates.sort()
+        return candidates
+
+    def classify_all(self, text, pos=None, endpos=None):
+        # the names of every pattern matching in text
+        return [classification.name for classification in self.search_all(text, pos, endpos)]
+
+    def search_all(self, text, pos=None, endpos=None):
+        # a Classification of every pattern matching in text, of its first match
+        classifications = []
+        for i in self.candidates(text, pos, endpos):
+            match = self.pattern(i).search(text, pos, endpos)
+            if match:
+                classifications.append(Classification(self.names[i], match.span(), match.groupdict()))
+        return classifications
+
+
+def by_longest_literal(required, literals):
+    # the patterns by the longest of their literals, and those without any
+    keyed, always = {}, []
+    for i, indexes in enumerate(required):
+        if indexes:
+            key = max(indexes, key=lambda literal: len(literals[literal]))
+            keyed.setdefault(key, []).append(i)
+        else:
+            always.append(i)
+    return keyed, always
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import regex as regexlib
+
+
+class Prefilter:
+    # A compiled Pattern, run only on text containing the literals every match contains (see
+    # literals.py): text lacking any of them, or shorter than the shortest match (see lengths.py),
+    # is rejected without entering the regex engine, and searches start at the first occurrence
+    # of the literal prefix. Anything else is delegated to the Pattern as is.
+    def __init__(self, pattern, required_literals=(), literal_prefix=u'', min_length=0):
+        self.pattern = pattern
+        self.reversed = bool(pattern.flags & regexlib.REVERSE) # match() then anchors at endpos
+        if pattern.flags & (regexlib.IGNORECASE | regexlib.VERBOSE):
+            required_literals, literal_prefix, min_length = (), u'', 0 # given to compile(), not seen by the analysis
+        self.min_length = min_length
+        self.required_literals = tuple(required_literals)
+        self.literal_prefix = literal_prefix
+        # a str is searched a byte at a time, only the ASCII literals are known to be in it as such
+        self.byte_literals = tuple(literal.encode('ascii') for literal in self.required_literals if is_ascii(literal))
+        self.byte_prefix = ascii_prefix(literal_prefix).encode('ascii')
+
+    def __getattr__(self, name):
+        return getattr(self.pattern, name)
+
+    def start(self, text, pos=None, endpos=None):
+        # where a match may start at the earliest, None if text can't match
+        if isinstance(text, unicode):
+            required_literals, literal_prefix = self.required_literals, self.literal_prefix
+        else:
+            required_literals, literal_prefix = self.byte_literals, self.byte_prefix
+        if pos is None and endpos is None: # the whole text, as in most calls
+            if len(text) < self.min_length:
+                return None
+            for literal in required_literals:
+                if literal not in text:
+                    return None
+            pos = 0
+        else:
+            pos = pos or 0
+            if endpos is None:
+                endpos = len(text)
+            if min(endpos, len(text)) - pos < self.min_length:
+                return None
+            for literal in required_literals:
+                if text.find(literal, pos, endpos) < 0:
+                    return None
+        if literal_prefix:
+            pos = text.find(literal_prefix, pos, endpos)
+            if pos < 0:
+                return None
+        return pos
+
+    def might_match(self, text, pos=None, endpos=None):
+        return self.start(text, pos, endpos) is not None
+
+    def might_start_at(self, text, pos=None, endpos=None):
+        # whether a match may start at pos, as match() and fullmatch() require
+        start = self.start(text, pos, endpos)
+        return start is not None and (start == (pos or 0) or self.reversed)
+
+    def search(self, text, pos=None, endpos=None, **kwargs):
+        if kwargs.get('partial'): # a partial match needn't contain the literals
+            return self.pattern.search(text, pos, endpos, **kwargs)
+        start = self.start(text, pos, endpos)
+        if start is None:
+            return None
+        return self.pattern.search(text, start, endpos, **kwargs)
+
+    def match(self, text, pos=None, endpos=None, **kwargs):
+        if not kwargs.get('partial') and not self.might_start_at(text, pos, endpos):
+            return None
+        return self.pattern.match(text, pos, endpos, **kwargs)
+
+    def fullmatch(self, text, pos=None, endpos=None, **kwargs):
+        if not kwargs.get('partial') and not self.might_start_at(text, pos, endpos):
+            return None
+        return self.pattern.fullmatch(text, pos, endpos, **kwargs)
+
+    def finditer(self, text, pos=None, endpos=None, **kwargs):
+        if kwargs.get('partial'):
+            return self.pattern.finditer(text, pos, endpos, **kwargs)
+        start = self.start(text, pos, endpos)
+        if start is None:
+            return iter(())
+        return self.pattern.finditer(text, start, endpos, **kwargs)
+
+    def findall(self, text, pos=None, endpos=None, **kwargs):
+        start = self.start(text, pos, endpos)
+        if start is None:
+            return []
+        return self.pattern.findall(text, start, endpos, **kwargs)
+
+    def filter(self, lines):
+        # the lines with a match, e.g. of a log file; the literals are checked inline, sparing a
+        # method call on each of the lines that lack them
+        search = self.pattern.search
+        required_literals, byte_literals, min_length = self.required_literals, self.byte_literals, self.min_length
+        for line in lines:
+            if len(line) < min_length:
+                continue
+            for literal in (required_literals if isinstance(line, unicode) else byte_literals):
+                if literal not in line:
+                    break
+            else:
+                if search(line):
+                    yield line
+
+
+def is_ascii(text):
+    return all(ord(char) < 0x80 for char in text)
+
+
+def ascii_prefix(text):
+    for i, char in enumerate(text):
+        if ord(char) >= 0x80:
+            return text[:i]
+    return text
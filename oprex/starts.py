@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# The characters a match may start with, found on a compiled regex's IR (see ir.py), for scanning
+# large byte buffers: a 256-entry table marks the bytes that may start a match, the offsets
+# holding them are found in bulk -- by str.translate, or NumPy -- and the regex engine is entered
+# only there, rather than at every byte. It pays off when the engine can't find where to start
+# by itself, e.g. for patterns starting with \m or alternatives: 10-20x faster on rare matches.
+
+import charset, regex as regexlib
+from passes import first_chars
+
+
+DENSE = 0.05 # candidates per byte, above which entering the engine at each costs more than a search
+BLOCK = 1 << 20 # bytes whose candidates are found at once
+
+
+def start_chars(root):
+    # the CharSet of what every match starts with, None if that's not known, or a match may be empty
+    chars, nullable = first_chars(root, getattr(root, 'flags', ''), skip_zero_width=True)
+    return None if nullable else chars
+
+
+def byte_table(chars, flags=0):
+    # The bytes chars may start with, as a bytearray of 0/1 indexed by byte. A str is matched a
+    # byte at a time, each byte taken as the code point of the same value. The opaque items, e.g.
+    # \w, are resolved by the engine, as in a Unicode pattern, a superset of what they match under
+    # the ASCII flag; under the LOCALE flag what they match isn't known until matching.
+    if chars is None:
+        return bytearray([1]) * 256
+    try:
+        if chars.opaques:
+            if flags & regexlib.LOCALE:
+                raise charset.Unfoldable
+            chars = charset.resolve(chars, [(0, 255)], '')
+        intervals = chars.known()
+    except charset.Unfoldable:
+        return bytearray([1]) * 256
+    table = bytearray(256)
+    for lo, hi in intervals:
+        for byte in xrange(lo, min(hi, 255) + 1):
+            table[byte] = 1
+    return table
+
+
+class StartScanner:
+    # Finds a Pattern's matches in a byte buffer (a str, bytearray, mmap...), entering the engine
+    # only at the offsets holding a byte a match can start with. Gives the same matches as the
+    # Pattern's finditer() does. numpy=True finds the offsets with NumPy (an optional dependency)
+    # rather than str.translate, which is about twice as fast on CPython 2 but copies each block.
+    def __init__(self, pattern, start_chars, numpy=False):
+        self.pattern = pattern
+        if pattern.flags & (regexlib.REVERSE | regexlib.IGNORECASE | regexlib.VERBOSE):
+            start_chars = None # matches are found from the end, or flags given to compile() change the characters
+        self.table = byte_table(start_chars, pattern.flags)
+        self.selective = 0 in self.table # else every byte is a candidate
+        self.marks = str(self.table) # for str.translate, the bytes become their own 0/1 marks
+        self.numpy = None
+        if numpy:
+            import numpy
+            self.numpy = numpy
+            self.numpy_table = numpy.frombuffer(self.marks, dtype=numpy.uint8).astype(bool)
+
+    def __getattr__(self, name):
+        return getattr(self.pattern, name)
+
+    def candidates(self, buffer, pos=0, endpos=None):
+        # the offsets within buffer[pos:endpos] holding a byte a match can start with
+        if self.numpy:
+            return self.numpy_candidates(buffer, pos, endpos)
+        return self.translated_candidates(buffer, pos, endpos)
+
+    def numpy_candidates(self, buffer, pos=0, endpos=None):
+        numpy = self.numpy
+        data = numpy.frombuffer(buffer, dtype=numpy.uint8)[pos:endpos]
+        return (numpy.flatnonzero(numpy.take(self.numpy_table, data)) + pos).tolist()
+
+    def translated_candidates(self, buffer, pos=0, endpos=None):
+        marks = str(buffer[pos:endpos]).translate(self.marks)
+        offsets = []
+        offset = marks.find('\1')
+        while offset >= 0:
+            offsets.append(offset + pos)
+            offset = marks.find('\1', offset + 1)
+        return offsets
+
+    def finditer(self, buffer, pos=0, endpos=None):
+        if endpos is None:
+            endpos = len(buffer)
+        if self.selective:
+            first_block = self.candidates(buffer, pos, min(pos + BLOCK, endpos))
+            if len(first_block) <= DENSE * min(BLOCK, endpos - pos):
+                return self.scan(buffer, pos, endpos, first_block)
+        return self.pattern.finditer(buffer, pos, endpos)
+
+    def scan(self, buffer, pos, endpos, first_block):
+        # the matches starting at the candidates, found a block at a time so a huge buffer's
+        # candidates are never all in memory at once
+        match = self.pattern.match
+        end = pos # of the previous match
+        for block in xrange(pos, endpos, BLOCK):
+            block_end = min(block + BLOCK, endpos)
+            if end >= block_end:
+                continue
+            candidates = first_block if block == pos else self.candidates(buffer, max(block, end), block_end)
+            for offset in candidates:
+                if offset < end: # within the previous match
+                    continue
+                found = match(buffer, offset, endpos)
+                if found:
+                    yield found
+                    end = found.end() # never empty, a pattern that may match the empty string has no start_chars
+
+    def search(self, buffer, pos=0, endpos=None):
+        for match in self.finditer(buffer, pos, endpos):
+            return match
+        return None
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import json, sqlite3, time
+from charset import CharSet
+from oprex import CompileCache, OprexResult, grammar_version, oprex, sanitize
+
+
+class PatternStore:
+    # On-disk cache of compiled patterns, shared by every process pointing at the same file.
+    # SQLite does the locking, so concurrent writers are safe. Entries compiled by another
+    # grammar version are dropped on open, the least recently used ones when the store is full:
+    # past max_entries rows, or max_bytes in all -- each row's size is that of its regex, capture
+    # names and metadata as stored (UTF-8 text), so a few huge patterns can't grow the file either.
+    TOUCH_INTERVAL = 60 # seconds; limits last-used bookkeeping writes on hot entries
+    METADATA = ('required_literals', 'literal_prefix', 'start_chars', 'match_lengths', 'definition_lengths', 'variable_lookbehinds') # the OprexResult attributes kept, besides capture_names
+
+    def __init__(self, path, max_entries=10000, max_bytes=1 << 26):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.grammar = grammar_version()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.transaction():
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(patterns)')]
+            if columns and 'size' not in columns: # written by an older version
+                self.db.execute('DROP TABLE patterns')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS patterns (
+                key           TEXT PRIMARY KEY,
+                grammar       TEXT NOT NULL,
+                regex         TEXT NOT NULL,
+                capture_names TEXT NOT NULL,
+                metadata      TEXT NOT NULL,
+                size          INTEGER NOT NULL,
+                last_used     REAL NOT NULL
+            )''')
+            self.db.execute('DELETE FROM patterns WHERE grammar != ?', (self.grammar,))
+
+    def transaction(self):
+        return Transaction(self.db)
+
+    def key(self, source_code):
+        return CompileCache.key(sanitize(source_code), self.grammar)
+
+    def oprex(self, source_code):
+        key = self.key(source_code)
+        result = self.get(key)
+        if result is None:
+            result = oprex(source_code)
+            self.put(key, result)
+        return result
+
+    def get(self, key):
+        row = self.db.execute('SELECT regex, capture_names, metadata, last_used FROM patterns WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        regex, capture_names, metadata, last_used = row
+        now = time.time()
+        if now - last_used > self.TOUCH_INTERVAL:
+            self.db.execute('UPDATE patterns SET last_used = ? WHERE key = ?', (now, key))
+        metadata = dict((str(name), value) for name, value in json.loads(metadata, object_hook=decode).iteritems())
+        return OprexResult(regex, capture_names=json.loads(capture_names), **metadata)
+
+    def put(self, key, result):
+        metadata = dict((name, getattr(result, name)) for name in self.METADATA)
+        columns = unicode(result), json.dumps(result.capture_names), json.dumps(metadata, default=encode)
+        size = sum(len(column.encode('utf-8')) for column in columns)
+        if size > self.max_bytes: # it would only evict everything, itself included
+            return
+        with self.transaction():
+            self.db.execute('INSERT OR REPLACE INTO patterns VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, self.grammar) + columns + (size, time.time()))
+            self.evict()
+
+    def evict(self):
+        # the least recently used first, the first stored of those used at once
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.db.execute('''DELETE FROM patterns WHERE key IN
+                (SELECT key FROM patterns ORDER BY last_used, rowid LIMIT ?)''', (excess,))
+        excess = self.total_size() - self.max_bytes
+        if excess > 0:
+            evicted = []
+            for key, size in self.db.execute('SELECT key, size FROM patterns ORDER BY last_used, rowid').fetchall():
+                if excess <= 0:
+                    break
+                evicted.append((key,))
+                excess -= size
+            self.db.executemany('DELETE FROM patterns WHERE key = ?', evicted)
+
+    def total_size(self): # in bytes, of every row's regex, capture names and metadata
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM patterns').fetchone()[0]
+
+    def clear(self):
+        with self.transaction():
+            self.db.execute('DELETE FROM patterns')
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM patterns').fetchone()[0]
+
+
+def encode(value): # the metadata JSON can't hold as it is
+    if isinstance(value, CharSet):
+        return {'intervals' : value.intervals, 'opaques' : value.opaques}
+    raise TypeError(repr(value))
+
+
+def decode(obj):
+    if 'intervals' in obj:
+        return CharSet(map(tuple, obj['intervals']), obj['opaques'])
+    return obj
+
+
+class Transaction:
+    # BEGIN IMMEDIATE takes the write lock up front, so concurrent writers queue instead of deadlocking
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
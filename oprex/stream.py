@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Matching a Pattern over a stream -- a file object, or any iterable of chunks of text -- that's
+# never read whole, e.g. a 50GB log. The chunks are searched as they come, with what's left of
+# the previous one in front: when the longest text the engine may look at to find a match is
+# known (see lengths.py), only that many characters are carried over, and a match is taken only
+# once what follows it can't change it. Every match is found once, as finditer() would on the
+# whole text. When that length is unbounded, matches are found a line at a time instead, none
+# spanning lines.
+
+import regex as regexlib
+from lengths import UNBOUNDED, reach
+
+
+CHUNK = 1 << 20 # characters read from a file object at once
+
+
+class StreamMatch:
+    # A Match found in a chunk, its positions made relative to the start of the stream. The
+    # rest, e.g. group(), is the Match's; its string is the text searched, not the stream's.
+    def __init__(self, match, offset):
+        self.match = match
+        self.offset = offset
+
+    def __getattr__(self, name):
+        return getattr(self.match, name)
+
+    def __repr__(self):
+        return '<StreamMatch span=%r, match=%r>' % (self.span(), self.match.group())
+
+    def start(self, group=0):
+        start = self.match.start(group)
+        return start + self.offset if start >= 0 else start # -1 for a group that didn't match
+
+    def end(self, group=0):
+        end = self.match.end(group)
+        return end + self.offset if end >= 0 else end
+
+    def span(self, group=0):
+        return self.start(group), self.end(group)
+
+
+class StreamMatcher:
+    # Finds a Pattern's matches in a stream; node is the IR its regex was emitted from.
+    def __init__(self, pattern, node):
+        if pattern.flags & regexlib.REVERSE:
+            raise ValueError("A reversed pattern's matches can't be found as the stream is read")
+        self.pattern = pattern
+        self.behind, self.ahead = reach(node) # characters kept before the search position, needed after a match's start
+        self.by_line = UNBOUNDED in (self.behind, self.ahead)
+
+    def __getattr__(self, name):
+        return getattr(self.pattern, name)
+
+    def finditer(self, stream, chunk_size=CHUNK):
+        chunks = read_chunks(stream, chunk_size) if hasattr(stream, 'read') else stream
+        if self.by_line:
+            return self.line_matches(chunks)
+        return self.chunk_matches(chunks)
+
+    def chunk_matches(self, chunks):
+        behind, ahead = self.behind, self.ahead
+        buffer = None
+        offset = 0 # of buffer in the stream
+        pos = 0 # in buffer, where the search resumes
+        empty = None # the empty match ending where the search resumes, which it finds again
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if buffer is None:
+                buffer = chunk
+            else:
+                keep = max(0, pos - behind)
+                buffer = buffer[keep:] + chunk
+                offset += keep
+                pos -= keep
+                if empty is not None:
+                    empty -= keep
+            # a match is taken if the engine, looking ahead characters past its start, saw no
+            # further than the buffer's end -- nor did it to reject the positions before it
+            decided = len(buffer) - ahead
+            for match in self.pattern.finditer(buffer, pos):
+                start = match.start()
+                if start > decided:
+                    break
+                if match.end() == start == empty:
+                    continue
+                yield StreamMatch(match, offset)
+                pos = match.end()
+                empty = pos if start == pos else None
+            if decided >= pos: # no match starts up to there
+                pos, empty = decided + 1, None
+        if buffer is None:
+            buffer = ''
+        for match in self.pattern.finditer(buffer, pos): # the end of the stream: every match is decided
+            if match.end() == match.start() == empty:
+                continue
+            yield StreamMatch(match, offset)
+
+    def line_matches(self, chunks):
+        # the matches within each line, line break included, searched in the text around it: the
+        # engine sees what's before the line, e.g. for \A and lookbehinds, but not past its end,
+        # so no match spans lines. An empty match at a line's end is left to the next line's
+        # search, which can tell e.g. whether EOS is there.
+        offset = 0 # of text in the stream
+        text = ''
+        pos = 0 # in text, where the next line starts
+        for chunk in chunks:
+            if not chunk:
+                continue
+            keep = self.kept_from(text, pos)
+            text = text[keep:] + chunk
+            offset += keep
+            pos -= keep
+            end = text.rfind('\n') + 1
+            while pos < end:
+                line_end = text.index('\n', pos) + 1
+                for match in self.pattern.finditer(text, pos, line_end):
+                    if match.start() == line_end:
+                        break
+                    yield StreamMatch(match, offset)
+                pos = line_end
+        for match in self.pattern.finditer(text, pos): # the last line, up to the end of the stream
+            yield StreamMatch(match, offset)
+
+    def kept_from(self, text, pos):
+        # where to cut the text before the line at pos: behind characters are what a lookbehind
+        # may look at; when that's unbounded, it sees back to the start of the previous line
+        if self.behind != UNBOUNDED:
+            return max(0, pos - self.behind)
+        return text.rfind('\n', 0, max(0, pos - 1)) + 1
+
+    def search(self, stream, chunk_size=CHUNK):
+        for match in self.finditer(stream, chunk_size):
+            return match
+        return None
+
+
+def read_chunks(stream, chunk_size):
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 
-import unittest, regex
-from app import oprex, OprexSyntaxError
+import unittest, regex, io, itertools, json, os, random, shutil, sqlite3, subprocess, sys, tempfile, threading
+from collections import OrderedDict
+from app import oprex, compile, compile_many, sanitize, OprexError, OprexSyntaxError, OprexCompiler, BatchStats, compile_cache, pattern_cache, compilers, thread_compiler, PatternStore, build_module, BuildError, SourcePositions, ir, passes, backtracking_risks, OprexBacktrackingError, Prefilter, StartScanner, start_scanner, Classifier, Classification, PatternSet, StreamMatch, stream_matcher
+try:
+    import numpy # optional, see StartScanner
+except ImportError:
+    numpy = None
 
 class TestErrorHandling(unittest.TestCase):
     def given(self, oprex_source, expect_error):
@@ -4590,8 +4595,9 @@ class TestOutput(unittest.TestCase):
 class TestMatches(unittest.TestCase):
     def given(self, oprex_source, fn=regex.match, expect_full_match=[], no_match=[], partial_match={}):
         regex_source = oprex(oprex_source)
+        pattern = compile(oprex_source)
         for text in expect_full_match:
-            match = fn(regex_source, text)
+            match = fn(pattern, text)
             partial = match and match.group(0) != text
             if not match or partial:
                 raise AssertionError(u'%s\nis expected to fully match: %s\n%s\nThe regex is: %s' % (
@@ -4602,7 +4608,7 @@ class TestMatches(unittest.TestCase):
                 ))
 
         for text in no_match:
-            match = fn(regex_source, text)
+            match = fn(pattern, text)
             if match:
                 raise AssertionError(u'%s\nis expected NOT to match: %s\n%s\nThe regex is: %s' % (
                     oprex_source or u'(empty string)', 
@@ -4612,7 +4618,7 @@ class TestMatches(unittest.TestCase):
                 ))
 
         for text, partmatch in partial_match.iteritems():
-            match = fn(regex_source, text)
+            match = fn(pattern, text)
             partial = match and match.group(0) != text and match.group(0) == partmatch
             if not match or not partial:
                 if match and match.group(0) == text:
@@ -6196,5 +6202,1582 @@ class TestMatches(unittest.TestCase):
         })
 
 
+class TestCompileCache(unittest.TestCase):
+    def setUp(self):
+        self.maxsize, self.maxchars = compile_cache.maxsize, compile_cache.maxchars
+        compile_cache.clear()
+
+    def tearDown(self):
+        compile_cache.maxsize, compile_cache.maxchars = self.maxsize, self.maxchars
+        compile_cache.clear()
+
+    def test_hit_and_miss(self):
+        source = '''
+            /digit/alpha/
+        '''
+        first = oprex(source)
+        self.assertEqual((compile_cache.hits, compile_cache.misses), (0, 1))
+        second = oprex(source)
+        self.assertEqual((compile_cache.hits, compile_cache.misses), (1, 1))
+        self.assertIs(first, second)
+
+        oprex(source.replace('\n', '\r\n')) # same sanitized source
+        self.assertEqual((compile_cache.hits, compile_cache.misses), (2, 1))
+
+    def test_errors_are_not_cached(self):
+        source = '''
+            undefined
+        '''
+        for _ in range(2):
+            self.assertRaises(OprexSyntaxError, oprex, source)
+        self.assertEqual(len(compile_cache), 0)
+        self.assertEqual(compile_cache.misses, 2)
+
+    def test_eviction(self):
+        compile_cache.maxsize = 2
+        sources = ["\n'%s'\n" % word for word in ('one', 'two', 'three')]
+        for source in sources:
+            oprex(source)
+        self.assertEqual(len(compile_cache), 2)
+        self.assertEqual(compile_cache.evictions, 1)
+
+        oprex(sources[1]) # recently used entries survive
+        self.assertEqual(compile_cache.hits, 1)
+        oprex(sources[0]) # the least recently used one was evicted
+        self.assertEqual(compile_cache.misses, 4)
+
+    def test_size_bound(self): # in the total length of the cached regexes, too
+        compile_cache.maxchars = 30
+        sources = ["\n'%s'\n" % (letter * 8) for letter in 'abc'] # (?V1w)aaaaaaaa: 14 characters each
+        for source in sources:
+            oprex(source)
+        self.assertEqual((len(compile_cache), compile_cache.chars, compile_cache.evictions), (2, 28, 1))
+        oprex(sources[1])
+        self.assertEqual(compile_cache.hits, 1)
+
+        oprex("\n'%s'\n" % ('x' * 30)) # bigger than the whole cache, not kept
+        self.assertEqual((len(compile_cache), compile_cache.chars, compile_cache.evictions), (2, 28, 1))
+        compile_cache.clear()
+        self.assertEqual(compile_cache.chars, 0)
+
+    def test_clear(self):
+        oprex("\n'clear'\n")
+        compile_cache.clear()
+        self.assertEqual(len(compile_cache), 0)
+        self.assertEqual((compile_cache.hits, compile_cache.misses, compile_cache.evictions), (0, 0, 0))
+
+    def test_compiled_pattern(self):
+        source = '''
+            /digit/alpha/
+        '''
+        pattern_cache.clear()
+        pattern = compile(source)
+        self.assertEqual(pattern.pattern, oprex(source))
+        self.assertTrue(pattern.match('1a'))
+        self.assertIs(compile(source), pattern)
+        self.assertEqual((pattern_cache.hits, pattern_cache.misses), (1, 1))
+
+        ignorecase = compile(source, flags=regex.IGNORECASE)
+        self.assertIsNot(ignorecase, pattern)
+        self.assertTrue(ignorecase.match('1A'))
+
+
+class TestPatternStore(unittest.TestCase):
+    source = '''
+        key
+            [key] = @1.. of alpha
+    '''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'patterns.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_shared_across_instances(self):
+        store = PatternStore(self.path)
+        compiled = store.oprex(self.source)
+        self.assertEqual(compiled, oprex(self.source))
+        store.close()
+
+        other = PatternStore(self.path) # e.g. another process
+        key = other.key(self.source)
+        stored = other.get(key)
+        self.assertEqual(stored, compiled)
+        self.assertEqual(stored.capture_names, ('key',))
+        other.close()
+
+    def test_grammar_change_invalidates(self):
+        store = PatternStore(self.path)
+        store.oprex(self.source)
+        store.db.execute("UPDATE patterns SET grammar = 'outdated'")
+        store.close()
+        self.assertEqual(len(PatternStore(self.path)), 0)
+
+    def test_metadata(self):
+        store = PatternStore(self.path)
+        store.oprex(self.source)
+        source = "\n/one/two/\n    one = 'one'\n    two = 1.. <<- of digit\n"
+        store.oprex(source)
+        store.close()
+        other = PatternStore(self.path)
+        stored = other.get(other.key(source))
+        self.assertEqual((stored.required_literals, stored.literal_prefix), ((u'one',), u'one'))
+        self.assertEqual(stored.start_chars.intervals, ((ord('o'), ord('o')),))
+        self.assertEqual((stored.match_lengths, stored.definition_lengths), ((4, float('inf')), {'one' : (3, 3), 'two' : (1, float('inf'))}))
+        stored = other.get(other.key(self.source))
+        self.assertEqual((stored.required_literals, stored.literal_prefix), ((), u''))
+        self.assertEqual(stored.start_chars.intervals, ((ord('A'), ord('Z')), (ord('a'), ord('z'))))
+        other.close()
+
+    def test_older_schema_dropped(self):
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE patterns (key TEXT PRIMARY KEY, grammar TEXT NOT NULL, regex TEXT NOT NULL, capture_names TEXT NOT NULL, last_used REAL NOT NULL)')
+        db.execute("INSERT INTO patterns VALUES ('k', 'g', 'r', '[]', 0)")
+        db.commit()
+        db.close()
+        store = PatternStore(self.path)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.oprex(self.source), oprex(self.source))
+        store.close()
+
+    def test_eviction(self):
+        store = PatternStore(self.path, max_entries=2)
+        for word in ('one', 'two', 'three'):
+            store.oprex("\n'%s'\n" % word)
+        self.assertEqual(len(store), 2)
+        self.assertIsNone(store.get(store.key("\n'one'\n")))
+        store.close()
+
+    def test_size_eviction(self):
+        store = PatternStore(self.path)
+        store.oprex("\n'ddd'\n")
+        row_size = store.total_size() # every word below makes a row as big
+        store.close()
+        store = PatternStore(self.path, max_bytes=row_size * 2 + 1)
+        words = ('eee', 'fff', 'ggg', 'hhh')
+        for word in words:
+            store.oprex("\n'%s'\n" % word)
+        self.assertEqual((len(store), store.total_size()), (2, row_size * 2))
+        for word in ('ddd',) + words[:2]: # the least recently used are gone
+            self.assertIsNone(store.get(store.key("\n'%s'\n" % word)))
+        self.assertEqual(store.get(store.key("\n'hhh'\n")), oprex("\n'hhh'\n"))
+
+        store.oprex("\n'%s'\n" % ('x' * row_size * 2)) # bigger than the whole store, not kept
+        self.assertEqual(len(store), 2)
+        store.close()
+
+
+class TestAheadOfTime(unittest.TestCase):
+    sources = {
+        'greeting.op' : u'''
+            /hello/name/
+                hello = 'Hello, '
+                [name] = @1.. of alpha
+        ''',
+        'net/ip-octet.op' : u'''
+            1..3 <<- of digit
+        ''',
+    }
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        for filename, source in self.sources.iteritems():
+            path = os.path.join(self.tempdir, filename)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(source.encode('utf-8'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_build_module(self):
+        module_source = build_module(self.tempdir)
+        self.assertNotIn('import oprex', module_source)
+        self.assertNotIn('ply', module_source)
+
+        module = {}
+        exec module_source in module
+        self.assertEqual(module['GREETING'], oprex(self.sources['greeting.op']))
+        self.assertEqual(module['GREETING_CAPTURE_NAMES'], ('name',))
+        self.assertEqual(module['GREETING_FLAGS'], 'V1w')
+        self.assertEqual(module['NET_IP_OCTET'], oprex(self.sources['net/ip-octet.op']))
+        self.assertEqual(sorted(module['PATTERNS']), ['GREETING', 'NET_IP_OCTET'])
+
+        pattern = module['pattern']('GREETING')
+        self.assertEqual(pattern.match('Hello, World').group('name'), 'World')
+        self.assertIs(module['pattern']('GREETING'), pattern)
+
+    def run_cli(self, *args):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'oprex', 'aot.py')
+        env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+        process = subprocess.Popen([sys.executable, script] + list(args),
+            cwd=self.tempdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        return process.returncode, output, errors
+
+    def test_command_line(self):
+        self.assertEqual(self.run_cli('.', 'patterns.py'), (0, '', ''))
+        with open(os.path.join(self.tempdir, 'patterns.py')) as f:
+            module_source = f.read()
+        module = {}
+        exec module_source in module
+        self.assertEqual(module['GREETING'], oprex(self.sources['greeting.op']))
+        self.assertEqual(module['pattern']('NET_IP_OCTET').match('255').group(), '255')
+
+        with open(os.path.join(self.tempdir, 'bad.op'), 'w') as f:
+            f.write("\nbad\n")
+        returncode, output, errors = self.run_cli('.', 'broken.py')
+        self.assertEqual(returncode, 1)
+        self.assertEqual(errors, "./bad.op: Line 2: 'bad' is not defined\n")
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'broken.py')))
+
+    def test_build_error(self):
+        with open(os.path.join(self.tempdir, 'bad.op'), 'w') as f:
+            f.write(u"\na\n    a = '\xe9\n".encode('utf-8'))
+        with self.assertRaises(BuildError) as context:
+            build_module(self.tempdir)
+        self.assertEqual(unicode(context.exception),
+            os.path.join(self.tempdir, 'bad.op') + u": Line 3: Syntax error at or near: '\xe9")
+
+    def test_name_clashes(self):
+        def clash(*filenames):
+            sourcedir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, sourcedir)
+            for filename in filenames:
+                with open(os.path.join(sourcedir, filename), 'w') as f:
+                    f.write("\n'a'\n")
+            with self.assertRaises(BuildError) as context:
+                build_module(sourcedir)
+            return unicode(context.exception).replace(sourcedir + os.sep, '')
+
+        self.assertEqual(clash('foo.op', 'foo_capture_names.op'), u"foo_capture_names.op: name 'FOO_CAPTURE_NAMES' clashes with foo.op")
+        self.assertEqual(clash('foo.op', 'foo-flags.op'), u"foo.op: name 'FOO_FLAGS' clashes with foo-flags.op")
+        self.assertEqual(clash('net-ip.op', 'net_ip.op'), u"net_ip.op: name 'NET_IP' clashes with net-ip.op")
+        self.assertEqual(clash('patterns.op'), u"patterns.op: name 'PATTERNS' clashes with the generated module")
+        self.assertEqual(clash('.op'), u'.op: no constant name can be made of the file name')
+
+        with open(os.path.join(self.tempdir, 'pattern.op'), 'w') as f: # PATTERN, not the pattern() helper
+            f.write("\n'a'\n")
+        module = {}
+        exec build_module(self.tempdir) in module
+        self.assertEqual(module['pattern']('PATTERN').match('a').group(), 'a')
+
+
+class TestConcurrency(unittest.TestCase):
+    sources = ['''
+        /prefix/body/suffix/
+            prefix = 'item-%d'
+            suffix = 2 of /dash/=body/
+                dash: -
+            [body] = @1.. of <<|
+                               |digit
+                               |alpha
+    ''' % n for n in range(20)] + ['''
+        (unicode)
+        /word/
+            word: alpha not upper
+    ''', '''
+        <<|
+          |(ignorecase) 'abc'
+          |any
+    ''']
+
+    def setUp(self):
+        self.checkinterval = sys.getcheckinterval()
+        sys.setcheckinterval(10) # switch threads often, to interleave the compiles
+
+    def tearDown(self):
+        sys.setcheckinterval(self.checkinterval)
+
+    def test_compilers_are_independent(self):
+        expected = [OprexCompiler().oprex(source) for source in self.sources]
+        results = {}
+        def worker(n):
+            compiler = OprexCompiler()
+            results[n] = [compiler.oprex(source) for _ in range(5) for source in self.sources]
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for n in range(8):
+            self.assertEqual(results[n], expected * 5)
+
+    def test_checked_flagsets_per_compiler(self):
+        first, second = OprexCompiler(), OprexCompiler()
+        first.oprex(u"\n(ignorecase) 'abc'\n")
+        self.assertEqual(len(first.checked_flagsets), 1)
+        self.assertEqual(second.checked_flagsets, set())
+
+    def test_oprex_from_threads(self):
+        maxsize = compile_cache.maxsize
+        compile_cache.maxsize = 0 # make every call really compile
+        try:
+            expected = map(oprex, self.sources)
+            errors = []
+            def worker():
+                for _ in range(5):
+                    if map(oprex, self.sources) != expected:
+                        errors.append(threading.current_thread().name)
+
+            threads = [threading.Thread(target=worker) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+        finally:
+            compile_cache.maxsize = maxsize
+
+
+class TestBatchCompile(unittest.TestCase):
+    def test_results_and_errors(self):
+        sources = [
+            "\n'first'\n",
+            "\nundefined\n",
+            "\n/digit/alpha/\n",
+            "no leading blank line",
+        ]
+        stats = BatchStats()
+        results = list(compile_many(sources, stats))
+
+        self.assertEqual([r.index for r in results], [0, 1, 2, 3])
+        self.assertEqual([r.source for r in results], sources)
+        self.assertEqual(results[0].result, oprex(sources[0]))
+        self.assertEqual(results[2].result, oprex(sources[2]))
+        self.assertIsNone(results[0].error)
+
+        self.assertIsNone(results[1].result)
+        self.assertIsInstance(results[1].error, OprexSyntaxError)
+        self.assertIn("'undefined' is not defined", str(results[1].error))
+        self.assertIsInstance(results[3].error, OprexSyntaxError)
+
+        self.assertEqual((stats.compiled, stats.failed), (2, 2))
+        self.assertTrue(stats.elapsed > 0)
+        self.assertTrue(stats.throughput > 0)
+
+    def test_is_lazy(self):
+        def sources():
+            yield "\n'one'\n"
+            raise AssertionError('consumed too eagerly')
+        results = OprexCompiler().compile_many(sources())
+        self.assertEqual(next(results).result, oprex("\n'one'\n"))
+
+    def test_consumed_on_another_thread(self): # by that thread's compiler, not the creator's
+        used = []
+        class RecordingCompiler(OprexCompiler):
+            def batch_result(self, *args):
+                used.append(self)
+                return OprexCompiler.batch_result(self, *args)
+
+        results = compile_many(["\n'one'\n", "\n'two'\n"])
+        def consume():
+            compilers.current = RecordingCompiler()
+            self.consumed = [result.result for result in results]
+            self.compiler = compilers.current
+        thread = threading.Thread(target=consume)
+        thread.start()
+        thread.join()
+        self.assertEqual(self.consumed, [oprex("\n'one'\n"), oprex("\n'two'\n")])
+        self.assertEqual(used, [self.compiler] * 2)
+
+
+class TestLazyImport(unittest.TestCase):
+    def test_import_builds_nothing(self):
+        probe = '''
+import sys, regex
+compiles = []
+compile = regex.compile
+regex.compile = lambda *args, **kwargs: compiles.append(args) or compile(*args, **kwargs)
+import oprex
+print sys.modules['oprex.oprex'].parser is None, 'ply' in sys.modules, 'argparse' in sys.modules, len(compiles)
+oprex.oprex('\\n/digit/\\n')
+print sys.modules['oprex.oprex'].parser is None, 'ply' in sys.modules, 'argparse' in sys.modules
+'''
+        tempdir = tempfile.mkdtemp() # read-only installs: nothing may get written
+        try:
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)), PYTHONDONTWRITEBYTECODE='1')
+            output = subprocess.check_output([sys.executable, '-c', probe], cwd=tempdir, env=env)
+            self.assertEqual(output.split('\n')[:2], ['True False False 0', 'False True False'])
+            self.assertEqual(os.listdir(tempdir), [])
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class TestCommandLine(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tempdir, 'sub'))
+        for filename, source in [
+            ('a.op', "\n'a'\n"),
+            ('c.op', "\nbad\n"),
+            ('sub/b.op', "\n/x/\n    x = digit\n"),
+            ('notes.txt', "\n'not oprex'\n"),
+        ]:
+            with open(os.path.join(self.tempdir, filename), 'w') as f:
+                f.write(source)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def run_cli(self, *args):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'oprex', 'oprex.py')
+        env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+        process = subprocess.Popen([sys.executable, script] + list(args),
+            cwd=self.tempdir, env=env, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+    def test_single_file(self):
+        self.assertEqual(self.run_cli('a.op'), (0, '(?V1w)a\n'))
+
+    def test_directory(self):
+        for jobs in ['1', '2']:
+            returncode, output = self.run_cli('.', '--jobs', jobs)
+            self.assertEqual(returncode, 1)
+            records = [json.loads(line) for line in output.splitlines()]
+            self.assertEqual([record['path'] for record in records], ['./a.op', './c.op', './sub/b.op'])
+            self.assertEqual([record['regex'] for record in records], ['(?V1w)a', None, '(?V1w)\\d'])
+            self.assertEqual(records[0]['capture_names'], [])
+            self.assertEqual(records[1]['error'], "Line 2: 'bad' is not defined")
+            self.assertTrue(all(record['time'] >= 0 for record in records))
+
+    def test_glob(self):
+        returncode, output = self.run_cli('sub/*.op', '--jsonl')
+        self.assertEqual(returncode, 0)
+        record = json.loads(output)
+        self.assertEqual((record['path'], record['regex'], record['error']), ('sub/b.op', '(?V1w)\\d', None))
+
+
+    def test_strict(self):
+        with open(os.path.join(self.tempdir, 'd.op'), 'w') as f:
+            f.write("\n/a/b/\n    a = 1.. <<- of digit\n    b = 1.. <<- of digit\n")
+        self.assertEqual(self.run_cli('d.op')[0], 0)
+        returncode, output = self.run_cli('.', '--strict')
+        self.assertEqual(returncode, 1)
+        records = dict((record['path'], record) for record in map(json.loads, output.splitlines()))
+        self.assertEqual(records['./a.op']['error'], None)
+        self.assertEqual(records['./d.op']['error'],
+            "Line 2: The expression may backtrack polynomially: consecutive repeats over the same characters")
+
+    def test_non_ascii_error(self):
+        with open(os.path.join(self.tempdir, 'e.op'), 'w') as f:
+            f.write(u"\na\n    a = '\xe9\n".encode('utf-8'))
+        returncode, output = self.run_cli('e.op', '--jsonl')
+        self.assertEqual(returncode, 1)
+        self.assertEqual(json.loads(output)['error'], u"Line 3: Syntax error at or near: '\xe9")
+
+
+class TestBacktracking(unittest.TestCase):
+    def given(self, source_code, expect_risks):
+        self.assertEqual([(risk.name, risk.lineno, risk.kind) for risk in backtracking_risks(source_code)], expect_risks)
+
+    def test_nested_repeats(self):
+        self.given(u'''
+/nums/x/
+    nums = 1.. <<- of num
+        num = /digits/sp?/
+            digits = 1.. <<- of digit
+            sp = ' '
+    x = 'x'
+''', [('nums', 3, 'exponentially')])
+
+        self.given(u'''
+/nums/x/
+    [nums] = 1.. <<- of num
+        num = /digits/sp?/
+            [digits] = 1.. <<- of digit
+            sp = ' '
+    x = 'x'
+''', [('nums', 3, 'exponentially')])
+
+    def test_possessive_not_reported(self):
+        self.given(u'''
+/nums/x/
+    nums = 1.. <<- of num
+        num = /digits/sp?/
+            digits = @1.. of digit
+            sp = ' '
+    x = 'x'
+''', [])
+
+    def test_told_apart(self):
+        self.given(u'''
+/ids/colon/
+    ids = 1.. <<- of id
+        id = /alpha/digits/
+            digits = 1.. <<- of digit
+    colon = ':'
+''', [])
+
+    def test_ambiguous_alternatives(self):
+        self.given(u'''
+1.. <<- of choice
+    choice = <<|
+               |wordchar
+               |digit
+
+''', [(None, 2, 'exponentially')])
+
+        self.given(u'''
+1.. <<- of choice
+    choice = <<|
+               |'a'
+               |'aa'
+
+''', [(None, 2, 'exponentially')])
+
+        self.given(u'''
+1.. <<- of choice
+    choice = <<|
+               |'a'
+               |'ab'
+
+''', [])
+
+    def test_adjacent_repeats(self):
+        self.given(u'''
+/a/b/
+    a = 1.. <<- of digit
+    b = 1.. <<- of digit
+''', [(None, 2, 'polynomially')])
+
+        self.given(u'''
+/a/b/
+    a = 1.. <<- of digit
+    b = 1.. <<- of alpha
+''', [])
+
+        nested = u'''
+/a/b/
+    a = 1.. <<- of digit
+    b = /c/d/
+        c = 1.. <<- of digit
+        d = digit
+'''
+        self.assertEqual(oprex(nested), r'(?V1w)\d+\d+\d')
+        self.given(nested, [(None, 2, 'polynomially')])
+
+        self.given(u'''
+/b/a/
+    b = /d/c/
+        d = digit
+        c = 1.. <<- of digit
+    a = 1.. <<- of digit
+''', [(None, 2, 'polynomially')])
+
+        self.given(u'''
+/a/b/
+    a = 1.. <<- of digit
+    b = /c/d/
+        c = 1.. <<- of alpha
+        d = 1.. <<- of digit
+''', [])
+
+    def test_strict(self):
+        source_code = u'''
+/nums/x/
+    nums = 1.. <<- of num
+        num = /digits/sp?/
+            digits = 1.. <<- of digit
+            sp = ' '
+    x = 'x'
+'''
+        self.assertTrue(oprex(source_code))
+        with self.assertRaises(OprexBacktrackingError) as context:
+            oprex(source_code, strict=True)
+        self.assertEqual([risk.name for risk in context.exception.risks], ['nums'])
+        self.assertEqual(str(context.exception),
+            "\nLine 3: 'nums' may backtrack exponentially: a repeat within a repeat, over the same characters")
+        with self.assertRaises(OprexBacktrackingError):
+            compile(source_code, strict=True)
+        self.assertEqual(oprex(u"\n'a'\n", strict=True), '(?V1w)a')
+
+    def test_strict_parses_once(self): # the risks are found in the IR the compile parsed
+        parsed = []
+        class CountingCompiler(OprexCompiler):
+            def parse_lines(self, source_lines, tracking):
+                parsed.append(tracking)
+                return OprexCompiler.parse_lines(self, source_lines, tracking)
+
+        source_code = u"\n/nums/\n    nums = 1.. <<- of num\n        num = /digits/sp?/\n            digits = 1.. <<- of digit\n            sp = ' '\n"
+        default_compiler = thread_compiler()
+        compilers.current = CountingCompiler()
+        compile_cache.clear()
+        try:
+            with self.assertRaises(OprexBacktrackingError) as context:
+                oprex(source_code, optimize=True, strict=True)
+            self.assertEqual(parsed, [False])
+            self.assertEqual([risk.name for risk in context.exception.risks], ['nums'])
+            self.assertRaises(OprexBacktrackingError, compile, source_code, optimize=True, strict=True) # cached
+            self.assertEqual(parsed, [False])
+        finally:
+            compilers.current = default_compiler
+            compile_cache.clear()
+
+
+class TestPrefilter(unittest.TestCase):
+    def given(self, source_code, expect_literals, expect_prefix, optimize=False):
+        result = oprex(source_code, optimize=optimize)
+        self.assertEqual((result.required_literals, result.literal_prefix), (expect_literals, expect_prefix))
+
+    def test_required_literals(self):
+        self.given(u'''
+/error/digits/colon/
+    error = 'ERROR'
+    digits = 1.. <<- of digit
+    colon = ':'
+''', (u'ERROR', u':'), u'ERROR')
+
+        self.given(u'''
+/scheme/sep/host/
+    scheme = <<|
+               |'http'
+               |'https'
+               |'ftp'
+
+    sep = '://'
+    host = 1.. <<- of alnum
+''', (u'://',), u'')
+
+        self.given(u'''
+/ab/x?/tab/cd/
+    ab = 'a.b'
+    x = 'x'
+    cd = 'cd'
+''', (u'\tcd', u'a.b'), u'a.b')
+
+        self.given(u'''
+/key/eq/value/
+    key = 2 of 'ab'
+    eq = <<|
+           |' = '
+           |' =  '
+
+    value = @1.. of alnum
+''', (u'abab = ',), u'abab = ')
+
+        self.given(u'''
+/BOL/level/space?/colon/
+    level = <<|
+              |'ERROR'
+              |'ERR'
+
+    colon = ':'
+''', (u'ERR', u':'), u'ERR')
+
+    def test_unknown(self):
+        self.given(u'''
+<@>
+    |word|
+         |colon>
+
+    word = 1.. <<- of alpha
+    colon = ':'
+''', (), u'')
+
+        self.given(u'''
+/error/x/
+    error = (ignorecase) 'ERROR'
+    x = 'x'
+''', (u'x',), u'')
+
+        self.given(u'''
+(ignorecase)
+'ERROR'
+''', (), u'')
+
+        self.given(u'''
+/word/space/=word/
+    [word] = 1.. <<- of alpha
+''', (u' ',), u'')
+
+    def test_optimized(self):
+        self.given(u'''
+/level/colon/
+    level = <<|
+              |'ERROR: '
+              |'ERROR '
+
+    colon = ':'
+''', (u'ERROR', u' :'), u'ERROR', optimize=True)
+
+    def test_matches(self):
+        source_code = u'''
+/level/space/code/colon/
+    level = <<|
+              |'ERROR'
+              |'ERRNO'
+
+    code = 1.. <<- of digit
+    colon = ':'
+'''
+        pattern = compile(source_code)
+        prefiltered = compile(source_code, prefilter=True)
+        self.assertIsInstance(prefiltered, Prefilter)
+        self.assertEqual(prefiltered.required_literals, (u'ERR', u' ', u':'))
+        self.assertEqual(prefiltered.min_length, 8)
+        lines = [
+            u'ERROR 42: disk full', u'x ERRNO 7:', u'ERROR: 42', u'ok', u'ERROR 42', u'12: ERR',
+            u'caf\xe9 ERROR 1:', u'ERRNO 1: ERROR 2:', u'',
+        ]
+        lines += [line.encode('utf-8') for line in lines]
+        span = lambda match: match and match.span()
+        for line in lines:
+            for pos, endpos in [(None, None), (0, None), (2, None), (0, 8), (6, 9)]:
+                self.assertEqual(span(prefiltered.search(line, pos, endpos)), span(pattern.search(line, pos, endpos)))
+                self.assertEqual(span(prefiltered.match(line, pos, endpos)), span(pattern.match(line, pos, endpos)))
+                self.assertEqual(span(prefiltered.fullmatch(line, pos, endpos)), span(pattern.fullmatch(line, pos, endpos)))
+                self.assertEqual(prefiltered.findall(line, pos, endpos), pattern.findall(line, pos, endpos))
+                self.assertEqual(map(span, prefiltered.finditer(line, pos, endpos)), map(span, pattern.finditer(line, pos, endpos)))
+            text = line.decode('utf-8') if isinstance(line, str) else line
+            self.assertEqual(prefiltered.might_match(line), len(line) >= 8 and all(literal in text for literal in (u'ERR', u' ', u':')))
+        self.assertEqual(list(prefiltered.filter(lines)), [line for line in lines if pattern.search(line)])
+        self.assertEqual(prefiltered.sub('-', u'x ERRNO 7: y'), u'x - y')
+        self.assertEqual(span(prefiltered.search(u'ERR', partial=True)), (0, 3))
+
+    def test_compile_flags(self):
+        source_code = u"\n/error/space/\n    error = 'ERROR'\n"
+        prefiltered = compile(source_code, prefilter=True, flags=regex.IGNORECASE)
+        self.assertEqual((prefiltered.required_literals, prefiltered.literal_prefix, prefiltered.min_length), ((), u'', 0))
+        self.assertTrue(prefiltered.search(u'error '))
+
+        span = lambda match: match and match.span()
+        reverse = Prefilter(regex.compile(u'(?r)ab\\d'), (u'ab',), u'ab')
+        for line in [u'ab1', u'xab1', u'ab1 ab2', u'ab']:
+            self.assertEqual(span(reverse.match(line)), span(reverse.pattern.match(line)))
+            self.assertEqual(reverse.findall(line), reverse.pattern.findall(line))
+
+
+class TestStartScanner(unittest.TestCase):
+    def given(self, source_code, expect_intervals, expect_opaques=()):
+        chars = oprex(source_code).start_chars
+        if expect_intervals is None:
+            self.assertIsNone(chars)
+        else:
+            self.assertEqual((chars.intervals, chars.opaques), (expect_intervals, expect_opaques))
+
+    def test_start_chars(self):
+        self.given(u'''
+/BOW/project/dash/number/
+    project = 2.. <<- of upper
+    dash = '-'
+    number = 1.. <<- of digit
+''', ((65, 90),))
+
+        self.given(u'''
+/hash?/number/
+    hash = '#'
+    number = 1.. <<- of digit
+''', ((35, 35),), (r'\d',))
+
+        self.given(u'''
+/level/colon/
+    level = <<|
+              |'ERROR'
+              |'FATAL'
+
+    colon = ':'
+''', ((69, 70),))
+
+        self.given(u'''
+<@>
+    <space|
+          |digits|
+
+    digits = 1.. <<- of digit
+''', (), (r'\d',))
+
+    def test_unknown(self):
+        self.given(u'''
+/hash?/number?/
+    hash = '#'
+    number = 1.. <<- of digit
+''', None)
+
+        self.given(u'''
+(ignorecase)
+'ERROR'
+''', None)
+
+    def test_finditer(self):
+        source_code = u'''
+/BOW/project/dash/number/
+    project = 2.. <<- of upper
+    dash = '-'
+    number = 1.. <<- of digit
+'''
+        scanner = start_scanner(source_code)
+        self.assertIsInstance(scanner, StartScanner)
+        words = ['see', 'JIRA-12', 'XJIRA-3', 'A-1', 'OPS-', 'AB-9x', 'the', 'queue', 'disk', 'worker', 'retry']
+        rng = random.Random(21)
+        texts = [
+            ' '.join(rng.choice(words) if rng.random() < 0.1 else 'word' for _ in range(count))
+            for count in (0, 1, 50, 300000) # the last one spans several blocks
+        ]
+        span = lambda match: match.span()
+        for text in texts:
+            for buffer in (text, bytearray(text)):
+                for pos, endpos in [(0, None), (3, None), (0, len(text) // 2), (5, 5)]:
+                    self.assertEqual(
+                        map(span, scanner.finditer(buffer, pos, endpos)),
+                        map(span, scanner.pattern.finditer(buffer, pos, endpos if endpos is not None else len(buffer))))
+        self.assertEqual(scanner.candidates('a JIRA-1 b'), [2, 3, 4, 5])
+        self.assertEqual(scanner.search('x AB-1 CD-2').group(), 'AB-1')
+
+    def test_flags(self):
+        pattern = compile(u"\n'ab'\n", flags=regex.IGNORECASE)
+        scanner = StartScanner(pattern, oprex(u"\n'ab'\n").start_chars)
+        self.assertFalse(scanner.selective)
+        self.assertEqual(scanner.findall('xAB ab'), ['AB', 'ab'])
+
+        scanner = start_scanner(u"\n/wordchar/colon/\n    colon = ':'\n")
+        self.assertEqual(scanner.candidates('a:\xe9: -'), [0, 2]) # \xe9 is a \w in a Unicode pattern
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_numpy(self):
+        source_code = u"\n/hash?/number/\n    hash = '#'\n    number = 1.. <<- of digit\n"
+        scanner = start_scanner(source_code, numpy=True)
+        text = 'a #12 b 3 ##4' * 1000
+        self.assertEqual(scanner.numpy_candidates(text, 3, 400), scanner.translated_candidates(text, 3, 400))
+        self.assertEqual(map(lambda match: match.span(), scanner.finditer(text)),
+            map(lambda match: match.span(), scanner.pattern.finditer(text)))
+
+
+class TestClassifier(unittest.TestCase):
+    patterns = OrderedDict([
+        ('error', u'''
+/level/colon/space/message/
+    level = 'ERROR'
+    colon = ':'
+    [message] = 1.. <<- of alpha
+'''),
+        ('level', u'''
+/message/colon/
+    [message] = 1.. <<- of upper
+    colon = ':'
+'''),
+        ('repeat', u'''
+/word/space/=word/
+    [word] = 1.. <<- of lower
+'''),
+        ('disk', u'''
+(ignorecase)
+'disk'
+'''),
+    ])
+
+    def test_combined(self):
+        classifier = Classifier(self.patterns)
+        self.assertEqual(classifier.regex,
+            u'(?V1w)(?:(?P<p0>ERROR: (?P<p0_message>[a-zA-Z]+))|(?P<p1>(?P<p1_message>[A-Z]+):)'
+            u'|(?P<p2>(?P<p2_word>[a-z]+) (?P=p2_word))|(?P<p3>(?i:disk)))')
+        self.assertEqual(classifier.classify('ERROR: full'), 'error')
+        self.assertEqual(classifier.classify('WARN: full'), 'level')
+        self.assertEqual(classifier.classify('Full DISK'), 'disk')
+        self.assertIsNone(classifier.classify('full Disc'))
+        self.assertEqual(classifier.search('x ERROR: full'), Classification('error', (2, 13), {'message': 'full'}))
+        self.assertEqual(classifier.search('so so DISK'), Classification('repeat', (0, 5), {'word': 'so'}))
+
+    def test_all(self):
+        classifier = Classifier(self.patterns.items())
+        self.assertEqual(classifier.search_all('the the ERROR: Disk'), [
+            Classification('error', (8, 19), {'message': 'Disk'}),
+            Classification('level', (8, 14), {'message': 'ERROR'}), # at the same position as error's
+            Classification('repeat', (0, 7), {'word': 'the'}),
+            Classification('disk', (15, 19), {}),
+        ])
+        patterns = [(name, compile(source)) for name, source in self.patterns.items()]
+        words = ['ERROR:', 'WARN:', 'disk', 'DISK', 'the', 'full', ' ', ':']
+        rng = random.Random(22)
+        for _ in range(200):
+            text = ''.join(rng.choice(words) for _ in range(rng.randint(0, 8)))
+            self.assertEqual(classifier.classify_all(text), [name for name, pattern in patterns if pattern.search(text)])
+
+    def test_flags(self):
+        classifier = Classifier([
+            ('verbose', u'\n(verbose)\n/space/\n'),
+            ('plain', u"\n'a b'\n"),
+        ])
+        self.assertEqual(classifier.classify_all('a b'), ['verbose', 'plain'])
+
+        classifier = Classifier([('unword', u"\n(-word)\nlinechar\n"), ('word', u"\n/BOW/x/\n    x = 'x'\n")])
+        self.assertEqual(classifier.regex, u'(?V1)(?:(?P<p0>(?-w:\\n))|(?P<p1>(?w:\\mx)))')
+        for text in ['\r\n x', '\n x', 'yx', u'\u2028x', '']:
+            self.assertEqual(classifier.classify_all(text), [name for name, source in
+                [('unword', u"\n(-word)\nlinechar\n"), ('word', u"\n/BOW/x/\n    x = 'x'\n")] if compile(source).search(text)])
+        self.assertRaisesRegexp(ValueError, "Patterns 'plain' and 'best' have different global flags: V1 and V1b",
+            Classifier, [('plain', u"\n'a'\n"), ('best', u"\n(bestmatch)\n'b'\n")])
+        self.assertRaisesRegexp(ValueError, "Patterns 'ascii' and 'unicode' have different global flags: V1a and V1u",
+            Classifier, [('ascii', u"\n(ascii)\n'a'\n"), ('unicode', u"\n(unicode)\n'b'\n")])
+        classifier = Classifier([('one', u"\n(ascii)\n'a'\n"), ('other', u"\n(ascii)\n'b'\n")])
+        self.assertEqual(classifier.regex, u'(?V1aw)(?:(?P<p0>a)|(?P<p1>b))')
+        self.assertRaisesRegexp(ValueError, "Pattern 'reversed' is reversed",
+            Classifier, [('reversed', u"\n(reverse)\n'a'\n")])
+
+
+class TestPatternSet(unittest.TestCase):
+    patterns = [
+        ('he', u"\n'he'\n"),
+        ('she', u"\n'she'\n"),
+        ('his', u"\n/his/digits/\n    his = 'his'\n    digits = 1.. <<- of digit\n"),
+        ('hers', u"\n'hers'\n"),
+        ('cafe', u"\n'caf\xe9'\n"),
+        ('any', u"\n(ignorecase)\n'HE'\n"),
+    ]
+
+    def test_automaton(self):
+        patterns = PatternSet(self.patterns)
+        found = lambda text: sorted(patterns.literals[i] for i in patterns.automaton.find(text))
+        self.assertEqual(found(u'ushers'), [u'he', u'hers', u'she'])
+        self.assertEqual(found(u'his1 caf\xe9'), [u'caf\xe9', u'his'])
+        self.assertEqual(found(u''), [])
+
+    def test_candidates(self):
+        patterns = PatternSet(self.patterns)
+        self.assertEqual(patterns.always, [5]) # ignorecase, no literals
+        self.assertEqual(patterns.candidates(u'ushers'), [0, 1, 3, 5])
+        self.assertEqual(patterns.candidates(u'caf\xe9 his'), [2, 4, 5])
+        self.assertEqual(patterns.candidates('caf\xe9 his'), [2, 4, 5]) # a str's bytes aren't looked for
+        self.assertEqual(patterns.candidates(u'ushers', 2), [0, 3, 5])
+        self.assertEqual(patterns.classify_all(u'ushers she his2'), ['he', 'she', 'his', 'hers', 'any'])
+        self.assertEqual(patterns.search_all(u'a his42'), [Classification('his', (2, 7), {})])
+
+    def test_same_as_searches(self):
+        patterns = PatternSet(self.patterns)
+        compiled = [(name, compile(source)) for name, source in self.patterns]
+        words = [u'he', u'she', u'his', u'rs', u'caf\xe9', u'HE', u' ', u'7']
+        rng = random.Random(23)
+        for _ in range(300):
+            text = u''.join(rng.choice(words) for _ in range(rng.randint(0, 6)))
+            for text in (text, text.encode('latin-1')):
+                self.assertEqual(patterns.classify_all(text), [name for name, pattern in compiled if pattern.search(text)])
+
+
+class TestStreamMatcher(unittest.TestCase):
+    sources = [u'''
+/year/dash/month/
+    year = 4 of digit
+    dash = '-'
+    month = 2 of digit
+''', u'''
+<@>
+    <space|
+          |digits|
+                 |colon>
+
+    digits = 1..5 <<- of digit
+    colon = ':'
+''', u'''
+/word/space/=word/
+    [word] = 1..3 <<- of lower
+''', u'''
+/BOW/digits/EOW/
+    digits = 1..4 <<- of digit
+''', u'''
+/digits?/
+    digits = 1..3 <<- of digit
+''', u'''
+/digit/EOS/
+''']
+
+    def chunked(self, rng, text):
+        cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, rng.randint(0, 6))))
+        return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+    def test_chunks(self):
+        rng = random.Random(24)
+        words = ['1', '22', '333', ' ', ':', 'ab', 'ab ab', '\n', '2016-12', 'x']
+        span = lambda match: match.span()
+        for source in self.sources:
+            matcher = stream_matcher(source)
+            self.assertFalse(matcher.by_line)
+            for _ in range(200):
+                text = ''.join(rng.choice(words) for _ in range(rng.randint(0, 40)))
+                self.assertEqual(map(span, matcher.finditer(self.chunked(rng, text))), map(span, matcher.pattern.finditer(text)))
+
+    def test_file(self):
+        matcher = stream_matcher(self.sources[2])
+        self.assertEqual((matcher.behind, matcher.ahead), (1, 8))
+        text = 'so so ' * 1000 + 'fin'
+        matches = list(matcher.finditer(io.BytesIO(text), chunk_size=7))
+        self.assertEqual(len(matches), 1000)
+        self.assertIsInstance(matches[-1], StreamMatch)
+        self.assertEqual((matches[-1].span(), matches[-1].span('word'), matches[-1].group('word')), ((5994, 5999), (5994, 5996), 'so'))
+        self.assertIsNone(matcher.search(io.BytesIO('')))
+
+    def test_by_line(self):
+        matcher = stream_matcher(u'''
+/BOW/digits/
+    digits = 1.. <<- of digit
+''')
+        self.assertTrue(matcher.by_line) # unbounded
+        chunks = [u'12 3', u'45\n6', u'\n', u'78']
+        self.assertEqual([(match.span(), match.group()) for match in matcher.finditer(iter(chunks))],
+            [((0, 2), u'12'), ((3, 6), u'345'), ((7, 8), u'6'), ((9, 11), u'78')])
+        self.assertRaises(ValueError, stream_matcher, u"\n(reverse)\n'a'\n")
+
+    def test_by_line_context(self):
+        # each line is searched in the text around it: anchors, lookbehinds and empty matches at
+        # line breaks come out as they do on the whole text
+        sources = [u'''
+/BOS/digits/
+    digits = 1.. <<- of digit
+''', u'''
+/digits/EOS/
+    digits = 1.. <<- of digit
+''', u'''
+/digits/EOS/
+    digits = 0.. <<- of digit
+''', u'''
+/BOL/digits/EOL/
+    digits = 0.. <<- of digit
+''', u'''
+<@>
+    <linechar|
+             |digits|
+                    |linechar>
+
+    digits = 0.. <<- of digit
+''', u'''
+0.. <<- of digit
+''']
+        rng = random.Random(24)
+        words = [u'1', u'22', u'x', u' ', u'\n']
+        span = lambda match: match.span()
+        for source in sources:
+            matcher = stream_matcher(source)
+            self.assertTrue(matcher.by_line)
+            for _ in range(200):
+                text = u''.join(rng.choice(words) for _ in range(rng.randint(0, 20)))
+                self.assertEqual(map(span, matcher.finditer(self.chunked(rng, text))), map(span, matcher.pattern.finditer(text)))
+        self.assertEqual(map(span, stream_matcher(sources[0]).finditer([u'1\n22\nx3\n'])), [(0, 1)])
+        self.assertEqual(map(span, stream_matcher(sources[5]).finditer([u'a\nb'])), [(0, 0), (1, 1), (2, 2), (3, 3)])
+
+
+class TestMatchLengths(unittest.TestCase):
+    def given(self, source_code, expect_lengths, expect_definitions=None):
+        result = oprex(source_code)
+        self.assertEqual(result.match_lengths, expect_lengths)
+        if expect_definitions is not None:
+            self.assertEqual(result.definition_lengths, expect_definitions)
+
+    def test_lengths(self):
+        self.given(u'''
+/date/space/word/space/=word/
+    date = /year/dash/month/
+        year = 4 of digit
+        dash = '-'
+        month = 1..2 <<- of digit
+    [word] = 1..3 <<- of lower
+''', (10, 15), {'date' : (6, 7), 'year' : (4, 4), 'dash' : (1, 1), 'month' : (1, 2), 'word' : (1, 3)})
+
+        self.given(u'''
+/level/colon/
+    level = <<|
+              |'ERROR'
+              |'WARN'
+
+    colon = ':'
+''', (5, 6), {'level' : (4, 5), 'colon' : (1, 1)})
+
+        self.given(u'''
+<@>
+    <space|
+          |digits|
+                 |colon>
+
+    digits = 1..5 <<- of digit
+    colon = ':'
+''', (1, 5)) # lookarounds match nothing
+
+        self.given(u'''
+/BOW/digits/
+    digits = 1.. <<- of digit
+''', (1, float('inf')), {'digits' : (1, float('inf'))})
+
+        self.given(u'''
+(ignorecase)
+'ab'
+''', (1, 6)) # full case-folding may match e.g. ss to a single character
+
+    def test_scoped_flags(self): # a definition is measured under the flags where it's used
+        self.given(u'''
+(ignorecase) x
+    x = 'ß'
+''', (1, 3), {'x' : (1, 3)}) # matches e.g. SS
+        self.assertTrue(regex.match(oprex(u"\n(ignorecase) x\n    x = 'ß'\n"), u'SS'))
+
+        self.given(u'''
+/x/y/
+    x = 'ab'
+    y = (ignorecase) /x/
+''', (3, 8), {'x' : (1, 6), 'y' : (1, 6)})
+
+    def test_recursion(self):
+        self.given(u'''
+./palindrome/.
+    palindrome = <<|
+                   |/letter/palindrome/=letter/
+                   |/letter/=letter/
+                   |alpha
+
+        [letter]: alpha
+''', (1, float('inf')), {'palindrome' : (1, float('inf')), 'letter' : (1, 1)})
+
+    def test_lookbehinds(self):
+        self.assertEqual(oprex(u'''
+<@>
+    <digits|
+           |alpha|
+
+    digits = 1.. <<- of digit
+''').variable_lookbehinds, (u'(?<=\\d+)',))
+        self.assertEqual(oprex(u'''
+<@>
+    <colon|
+          |alpha|
+
+    colon = ':'
+''').variable_lookbehinds, ())
+
+    def test_prefilter(self):
+        prefiltered = compile(u"\n/year/dash/month/\n    year = 4 of digit\n    dash = '-'\n    month = 2 of digit\n", prefilter=True)
+        self.assertEqual(prefiltered.min_length, 7)
+        self.assertFalse(prefiltered.might_match(u'2016-1'))
+        self.assertTrue(prefiltered.might_match(u'2016-12'))
+        self.assertFalse(prefiltered.might_match(u'x 2016-12', 3))
+
+
+def run_suite_with(testcase, compiler, cases=None, min_tests=80):
+    # runs the output and error tests with `compiler` as the thread's compiler
+    compile_cache.clear()
+    pattern_cache.clear()
+    default_compiler = thread_compiler()
+    compilers.current = compiler
+    try:
+        suite = unittest.TestSuite(unittest.defaultTestLoader.loadTestsFromTestCase(case)
+            for case in cases or (TestErrorHandling, TestOutput, TestMatches))
+        result = unittest.TestResult()
+        suite.run(result)
+        testcase.assertEqual(result.failures + result.errors, [])
+        testcase.assertTrue(result.testsRun > min_tests)
+    finally:
+        compilers.current = default_compiler
+        compile_cache.clear()
+        pattern_cache.clear()
+
+
+class TestScanner(unittest.TestCase):
+    sources = [
+        '''
+            /subject/predicate/object/
+                subject = /article/adjective/noun/
+*)                  article = 'the'
+*)                  adjective = /speed/color/ -- comment
+                        speed = "quick\\"er"
+                        color = 'brown\\t'
+
+*)                  noun = 'fox'
+                predicate = @1..3 <<- of verb
+                    verb = 'jumps'
+                object = (ignorecase -word) 1 of: a-z not: x :EM_DASH /Lu +vowel \\x41 \\u00e9 nothing and 12 é .
+                    [vowel]: a i u e o
+        ''',
+        '''
+            <<|
+              |'alpha'
+              |[name]? /x/ of x
+              |
+
+            @|
+             |non-alpha
+             |FAIL!
+        ''',
+        '''
+            /lookaround/_/
+                lookaround = <@>
+                    |!/allowed/>
+                    <of|  |of>
+
+                allowed = 2 of digit
+        ''',
+        '\n\tx\n\t\ty = 1\n\t\t\tz\n',
+        '\n(unknown) x\n',
+        '\n/x/\n    x = *)\n',
+        '\n/x/\n  x\t = 1\n',
+        '\n/x/\n    x = 1\n  y\n',
+        '\n/x/ *)\n',
+        '\nx\r\n',
+        '\n# x\n',
+        "\n'unterminated\n",
+        '\n1 of: \\N{x}\n',
+        '\n1 of: \\q\n',
+        '\nx\ry\n',
+    ]
+
+    def tokens(self, lexer, source):
+        lexer = OprexCompiler(lexer=lexer).build_lexer(sanitize(source))
+        tokens = []
+        try:
+            while True:
+                token = lexer.token()
+                if token is None:
+                    return tokens
+                tokens.append((token.type, token.value, token.lineno, token.lexpos, lexer.lexpos))
+        except OprexError as e:
+            tokens.append(str(e))
+            return tokens
+
+    def test_same_tokens_as_ply(self):
+        for source in self.sources:
+            self.assertEqual(self.tokens('scanner', source), self.tokens('ply', source), source)
+
+    def test_suite_with_ply_lexer(self):
+        run_suite_with(self, OprexCompiler(lexer='ply'))
+
+    def test_unknown_lexer(self):
+        self.assertRaises(ValueError, OprexCompiler, lexer='lex')
+
+
+class TestDescentParser(unittest.TestCase):
+    def test_suite_with_descent_parser(self):
+        run_suite_with(self, OprexCompiler(parser='descent'))
+
+    def test_long_lists(self):
+        lalr, descent = OprexCompiler(), OprexCompiler(parser='descent')
+        source = '\n'.join(['', '/alts/chain/', '    alts = <<|'] +
+            ["             |'x%d'" % n for n in range(3000)] + ['',
+            '    chain = /%s/' % '/'.join('v%d' % n for n in range(1000))] +
+            ['        v%d = 1 of: %s' % (n, ' '.join(str(digit) for digit in range(10))) for n in range(1000)] + [''])
+        self.assertEqual(descent.oprex(source), lalr.oprex(source))
+
+    def test_deep_nesting(self): # deeper than it can recurse, handed over to the LALR parser
+        depth = sys.getrecursionlimit()
+        lines = ['', 'v0']
+        for level in range(depth):
+            lines.append(' ' * (level + 1) + 'v%d = v%d' % (level, level + 1))
+        lines.append(' ' * (depth + 1) + "v%d = 'x'" % depth)
+        source = '\n'.join(lines + [''])
+        self.assertEqual(OprexCompiler(parser='descent').oprex(source), OprexCompiler().oprex(source))
+
+    def test_unknown_parser(self):
+        self.assertRaises(ValueError, OprexCompiler, parser='lr')
+
+    def test_unexpected_token_after_expression(self):
+        for source in ['\nx\n/\n', "\n/x/\n    x = 'x'\n/\n"]:
+            errors = []
+            for compiler in OprexCompiler(), OprexCompiler(parser='descent'):
+                try:
+                    compiler.oprex(source)
+                except OprexSyntaxError as e:
+                    errors.append(str(e))
+            self.assertEqual(len(errors), 2)
+            self.assertEqual(errors[0], errors[1])
+        self.assertTrue(errors[0].startswith('\nLine 4: Unexpected SLASH'))
+
+    def test_untracked_positions(self): # nonterminals have none, as with the LALR parser
+        source_lines = sanitize(u"\n<@>\n    |x>\n     <y|\n\n    x = 'x'\n    y = 'y'\n")
+        for tracking, expect_error in [(False, '\nMisaligned |'), (True, '\nLine 4: Misaligned |')]:
+            for compiler in OprexCompiler(), OprexCompiler(parser='descent'):
+                with self.assertRaises(OprexSyntaxError) as context:
+                    compiler.compile_lines_with(source_lines, tracking)
+                self.assertEqual(str(context.exception), expect_error)
+
+    def test_oprex_parser_option(self):
+        compile_cache.clear()
+        source = "\n/x/y/\n    x = 'x'\n    y = 1.. <<- of digit\n"
+        self.assertEqual(oprex(source, parser='descent'), r'(?V1w)x\d+')
+        self.assertEqual(thread_compiler('descent').parser.__class__.__name__, 'DescentParser')
+        compile_cache.clear()
+        self.assertRaises(ValueError, oprex, source, parser='lr')
+
+
+class TestTracking(unittest.TestCase):
+    def compiler_recording_parses(self):
+        compiler = OprexCompiler()
+        compiler.trackings = []
+        parse = compiler.parse
+        def recording_parse(lexer, tracking=True):
+            compiler.trackings.append(tracking)
+            return parse(lexer, tracking)
+        compiler.parse = recording_parse
+        return compiler
+
+    def test_success_is_untracked(self):
+        compiler = self.compiler_recording_parses()
+        compiler.oprex('''
+            /greeting/name/
+                greeting = 'hello'
+                [name]: capital lower
+                    capital: A..Z
+            ''')
+        self.assertEqual(compiler.trackings, [False])
+
+    def test_error_is_reparsed_tracked(self):
+        compiler = self.compiler_recording_parses()
+        with self.assertRaises(OprexSyntaxError) as cm:
+            compiler.oprex('''
+                /greeting/name/
+                    greeting = 'hello'
+                    name = 'world'
+                    name = 'moon'
+                ''')
+        self.assertEqual(compiler.trackings, [False, True])
+        self.assertEqual(str(cm.exception), "\nLine 5: Names must be unique within a scope, 'name' is already defined (previous definition at line 4)")
+
+    def test_deferred_charclass_checks(self): # the rejected item is found by the engine's error offset
+        source_lines = sanitize('''
+            x
+                x: a..f /Lu :LATIN_SMALL_LETTER_BOGUS f..a
+            ''')
+        with self.assertRaises(OprexSyntaxError) as deferred:
+            OprexCompiler().compile_lines_with(source_lines, tracking=False)
+        with self.assertRaises(OprexSyntaxError) as eager:
+            OprexCompiler().compile_lines_with(source_lines, tracking=True)
+        self.assertEqual(str(deferred.exception), str(eager.exception))
+        self.assertIn(':LATIN_SMALL_LETTER_BOGUS compiles to', str(deferred.exception))
+
+
+class TestSourcePositions(unittest.TestCase):
+    def test_lookups(self):
+        positions = SourcePositions('\n/x/\n    x = <<|\n             |1\n')
+        self.assertEqual(positions.line_starts, [0, 1, 5, 17, 33])
+        self.assertEqual(positions.lineno(0), 1)
+        self.assertEqual(positions.lineno(4), 2)
+        self.assertEqual(positions.lineno(18), 4)
+        self.assertEqual(positions.column(30), 14)
+        self.assertEqual(positions.column(30, lineno=4), 14)
+        self.assertEqual(positions.column(30, lineno=3), 14) # a lagging lineno is looked up instead
+        self.assertEqual(positions.column(33, lineno=5), 1)
+        self.assertEqual(positions.column(0), 0)
+
+    def test_column_after_multiline_token(self): # the columns on the lines after an unclosed string
+        for source, column in [("\nx\n    x = 'AM\n  'b'\n", 4), ("\nx\n    x = 'AM\n    y = 'b' /\n", 10)]:
+            with self.assertRaises(OprexSyntaxError) as cm:
+                oprex(source)
+            self.assertTrue(str(cm.exception).endswith('\n' + ' ' * (column - 1) + '^'))
+
+
+class EmittingCompiler(OprexCompiler):
+    # always emits the regex from its IR, through the flatten pass which doesn't change it
+    def compile_lines(self, source_lines, pipeline=(), strict=False):
+        return OprexCompiler.compile_lines(self, source_lines, pipeline or ('flatten',), strict)
+
+
+class OptimizingCompiler(OprexCompiler):
+    # always runs every optimization pass
+    def compile_lines(self, source_lines, pipeline=(), strict=False):
+        return OprexCompiler.compile_lines(self, source_lines, pipeline or passes.pipeline(True), strict)
+
+
+class TestIR(unittest.TestCase):
+    def test_suite_emitted_from_ir(self):
+        run_suite_with(self, EmittingCompiler())
+
+    def test_suite_matches_optimized(self): # the same matches, with every pass run
+        run_suite_with(self, OptimizingCompiler(), cases=[TestMatches], min_tests=20)
+
+    def test_tree(self):
+        compiler = OprexCompiler()
+        regex = compiler.parse(compiler.build_lexer(sanitize('''
+            /BOL/digits?/name/
+                digits = @1.. of digit
+                [name]: a..z
+            ''')))
+        self.assertEqual(regex.node, ir.Root(u'V1w', ir.Sequence((
+            ir.Group('(?m:', ir.Anchor('^')),
+            ir.Quantifier(ir.CharClass('\\d'), '*+'),
+            ir.Group('(?P<name>', ir.CharClass('[a-z]')),
+        ))))
+        self.assertEqual(ir.emit(regex.node), regex)
+
+    def test_custom_pass(self):
+        @passes.register('shout')
+        def shout(root):
+            def upper(node):
+                return ir.Literal(node.text.upper()) if isinstance(node, ir.Literal) else node
+            return ir.transform(root, upper)
+        try:
+            self.assertEqual(oprex("\n'hello'\n", optimize=['shout']), '(?V1w)HELLO')
+            self.assertEqual(oprex("\n'hello'\n"), '(?V1w)hello') # cached apart
+        finally:
+            del passes.PASSES['shout']
+
+    def test_unknown_pass(self):
+        self.assertRaises(ValueError, oprex, "\n'x'\n", optimize=['inline'])
+
+
+class TestTrie(unittest.TestCase):
+    def test_trie(self):
+        def trie(source):
+            return oprex(source, optimize=['flatten', 'trie'])
+        self.assertEqual(trie('''
+            <<|
+              |'the'
+              |'then'
+              |'a'
+              |'there'
+              |'an'
+            '''), '(?V1w)the(?:|n|re)|a(?:|n)')
+        self.assertEqual(trie(''' -- an empty branch, or a non-literal one, isn't moved across
+            <<|
+              |'ab'
+              |
+              |'ac'
+              |digit
+              |'ad'
+              |'ae'
+            '''), '(?V1w)ab||ac|\\d|a(?:d|e)')
+        self.assertEqual(trie(''' -- only adjacent branches when case-insensitive
+            (ignorecase) <<|
+                           |'ab'
+                           |'ba'
+                           |'ac'
+                           |'ad'
+            '''), '(?V1w)(?i:ab|ba|a(?:c|d))')
+
+    def test_trie_matches(self):
+        keywords = [''.join(letters) for letters in itertools.product('abc.', repeat=3)][::3]
+        source = '\n'.join(['', '/BOW/word/EOW/', '    word = <<|'] + ["             |'%s'" % kw for kw in keywords] + ['', ''])
+        plain, optimized = oprex(source), oprex(source, optimize=True)
+        self.assertNotEqual(plain, optimized)
+        text = ' '.join(''.join(letters) for letters in itertools.product('abc.', repeat=4))
+        self.assertEqual(regex.findall(plain, text), regex.findall(optimized, text))
+
+
+class TestCharClassAlgebra(unittest.TestCase):
+    def test_charclass(self):
+        def folded(source):
+            return oprex(source, optimize=['charclass'])
+        self.assertEqual(folded('''
+            consonant
+                consonant: a..z A..Z not a e i o u A E I O U
+            '''), '(?V1w)[B-DF-HJ-NP-TV-Zb-df-hj-np-tv-z]')
+        self.assertEqual(folded(''' -- merged, and a single character is written as itself
+            /abcd/x/
+                abcd: a b c d b..e
+                x: x X not X
+            '''), '(?V1w)[a-e]x')
+        self.assertEqual(folded(''' -- \\p{...} is tested by the engine against the other, known side
+            xb123
+                xb123: X x +hex not c..f C..D :LATIN_CAPITAL_LETTER_F +vowel and 1 2 3 /Alphabetic
+                    hex: 0..9 a..f A..F
+                    vowel: a i u e o A I U E O
+            '''), '(?V1w)[1-3BXbx]')
+        self.assertEqual(folded('''
+            otherz
+                otherz: not: +nonz
+                    nonz: not: z
+            '''), '(?V1w)z')
+        self.assertEqual(folded(''' -- the shorter of a class and its complement
+            nonz
+                nonz: +nonletter a..y
+                    nonletter: not: a..z
+            '''), '(?V1w)[^z]')
+        self.assertEqual(folded(''' -- case-insensitive classes are only merged
+            (ignorecase) abcd
+                abcd: a b c d b..e
+            '''), '(?V1w)(?i:[a-e])')
+
+    def test_charclass_matches(self):
+        source = '''
+            /consonant/nonhex/vowel/
+                consonant: a..z A..Z not a e i o u A E I O U
+                nonhex: not: +hex
+                    hex: 0..9 a..f A..F
+                vowel: +letter and a e i o u A E I O U
+                    letter: /Alphabetic not /Lu
+            '''
+        plain, optimized = oprex(source), oprex(source, optimize=True)
+        self.assertNotEqual(plain, optimized)
+        text = ''.join(map(chr, range(128))) * 3
+        self.assertEqual(regex.findall(plain, text), regex.findall(optimized, text))
+
+
+class TestPossessive(unittest.TestCase):
+    def test_possessive(self):
+        def possessive(source):
+            return oprex(source, optimize=['possessive'])
+        self.assertEqual(possessive('''
+            /bytes/end/
+                bytes = 1.. <<- of hexbyte
+                    hexbyte = /hex/hex/
+                        hex: 0..9 a..f
+                end = <<|
+                        |';'
+                        |' end'
+            '''), '(?V1w)(?:[0-9a-f][0-9a-f])++(?:;| end)')
+        self.assertEqual(possessive(''' -- a digit may follow, kept
+            /bytes/suffix/
+                bytes = 1.. <<- of hexbyte
+                    hexbyte = 2 of hex
+                        hex: 0..9 a..f
+                suffix = 0.. <<- of alnum
+            '''), '(?V1w)(?:[0-9a-f]{2})+[a-zA-Z0-9]*')
+        self.assertEqual(possessive(''' -- nothing follows at the end of the regex
+            /key/sep/pairs/
+                key = 1.. <<- of lower
+                sep = ':'
+                pairs = 0.. <<- of pair
+                    pair = /alpha/digit/
+            '''), '(?V1w)[a-z]+:(?:[a-zA-Z]\\d)*+')
+        self.assertEqual(possessive(''' -- nor single characters, the engine handles those
+            /num/unit/
+                num = 1.. <<- of digit
+                unit = 'ms'
+            '''), '(?V1w)\\d+ms')
+        self.assertEqual(possessive(''' -- what follows an anchor isn't known
+            /pairs/EOW/
+                pairs = 1.. <<- of pair
+                    pair = /alpha/digit/
+            '''), '(?V1w)(?:[a-zA-Z]\\d)+\\M')
+        self.assertEqual(possessive(''' -- nor case-insensitively
+            /pairs/num/
+                pairs = (ignorecase) 1.. <<- of pair
+                    pair = /lower/dash/
+                        dash = '-'
+                num = 1.. <<- of digit
+            '''), '(?V1w)(?i:(?:[a-z]-)+)\\d+')
+
+    def test_possessive_matches(self):
+        source = '''
+            /BOL/date/space/level/space/id/colon/space/message/
+                date = /year/dash/month/dash/day/
+                    year = 4 of digit
+                    month = 2 of digit
+                    day = 2 of digit
+                    dash = '-'
+                level = 1.. <<- of upper
+                id = 1.. <<- of hexbyte
+                    hexbyte = 2 of hex
+                        hex: 0..9 a..f
+                colon = ':'
+                message = 0.. <<- of nonlf
+                    nonlf: not: \\n
+            '''
+        plain, optimized = compile(source), compile(source, optimize=['possessive'])
+        self.assertNotEqual(plain.pattern, optimized.pattern)
+        lines = [
+            '2016-12-27 ERROR 0a1b2c: connection lost',
+            '2016-12-27 WARN ff: ',
+            '2016-12-27 INFO 0a1b2 odd digits: nope',
+            '2016-12-27 INFO 0a1b2c request done',
+            '2016-12-27 12 0a: not a level',
+            '2016-12-27 INFO  0a: double space',
+            'x 2016-12-27 INFO 0a: offset',
+            '2016-1-27 INFO 0a: short month',
+            '2016-12-27 DEBUG ' + '0a' * 100 + '!',
+        ]
+        for line in lines:
+            self.assertEqual(
+                [(m.span(), m.groups()) for m in plain.finditer(line)],
+                [(m.span(), m.groups()) for m in optimized.finditer(line)])
+
+
 if __name__ == '__main__':
     unittest.main()
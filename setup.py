@@ -32,4 +32,9 @@ setup(
 		"ply>=3.4",
 		"regex>=2014.12.24",
     ],
+
+    # Optional dependencies, e.g. pip install oprex[numpy]
+    extras_require={
+        "numpy": ["numpy"], # StartScanner(numpy=True)
+    },
 )
\ No newline at end of file